@@ -134,6 +134,15 @@ class FileConvertAnalyzer(BaseAnalyzer):
         mime_type = self._clean_content_type(doc["content_type"])
         logger.debug(f"Get converter for {mime_type}.")
         converter = CONVERTERS.get(mime_type, CONVERTERS["default"])
+        if converter.deferred:
+            # the content is converted on request, see `Elastic.open_content`.
+            extracted = converter.cached_extract(doc["raw_content"])
+            return {
+                "content": None,
+                "content_type": mime_type,
+                "text": extracted["text"],
+                "metadata": extracted["metadata"]
+            }
         return {
             "content": converter(doc["raw_content"]),
             "content_type": mime_type,
@@ -0,0 +1,110 @@
+"""This module provides a pool for running conversion tools as subprocesses.
+
+The tools (like `pdftotext` or `pdfinfo`) read the document from stdin and
+write their results to stdout, hence no temporary files are needed.
+The pool caps the number of concurrent processes and kills processes, which
+exceed their timeout.
+"""
+import logging
+import subprocess
+import threading
+
+try:
+    import resource
+except ImportError:  # pragma: nocover
+    # not available on windows.
+    resource = None
+
+import utility
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionError(IOError):
+    """Raised, when a conversion tool fails or times out."""
+
+
+class ConversionPool():
+    """Runs conversion tools, at most `max_workers` at the same time."""
+
+    def __init__(self, max_workers=4, **kwargs):
+        """Initializes the pool.
+
+        Args:
+            max_workers (int): the maximum number of concurrent processes.
+            **kwargs (dict): keyword arguments to update the defaults,
+                `timeout` (seconds per conversion) and `memory_limit`
+                (bytes of address space per process, None for no limit).
+        """
+        self.max_workers = max_workers
+        self.slots = threading.BoundedSemaphore(max_workers)
+        self.defaults = utility.DefaultDict(dict({
+            "timeout": 120,
+            "memory_limit": 2 * 1024 ** 3
+        }, **kwargs))
+
+    def _limit(self, memory_limit):
+        """Returns a function limiting the memory of the child process."""
+        if resource is None or memory_limit is None:
+            return None
+
+        def _set_limit():
+            resource.setrlimit(resource.RLIMIT_AS,
+                               (memory_limit, memory_limit))
+        return _set_limit
+
+    def run(self, arguments, content=None, **kwargs):
+        """Runs a tool, passing content via stdin and returning its stdout.
+
+        Blocks until a slot in the pool is free.
+
+        Args:
+            arguments (list): the executable and its arguments.
+            content (bytes): the input of the tool. Defaults to None.
+            **kwargs (dict): keyword arguments to override the defaults,
+                `timeout` and `memory_limit`.
+
+        Returns:
+            bytes: the output of the tool.
+
+        Raises:
+            ConversionError: if the tool fails or times out.
+        """
+        timeout = self.defaults.other(kwargs).timeout()
+        memory_limit = self.defaults.other(kwargs).memory_limit()
+
+        with self.slots:
+            process = subprocess.Popen(arguments, stdin=subprocess.PIPE,
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       preexec_fn=self._limit(memory_limit))
+            try:
+                out, err = process.communicate(content, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.communicate()
+                raise ConversionError(f"'{arguments[0]}' timed out after "
+                                      f"{timeout}s.")
+
+        if process.returncode != 0:
+            raise ConversionError(f"'{arguments[0]}' failed with "
+                                  f"{process.returncode}: "
+                                  f"{err.decode('utf-8', 'replace')[:200]}")
+        return out
+
+
+POOL = ConversionPool()
+"""The pool shared by all analyzers and converters."""
+
+
+def configure(max_workers=None, **kwargs):
+    """Replaces the shared pool by one with the given options.
+
+    Args:
+        max_workers (int): the maximum number of concurrent processes.
+        **kwargs (dict): the defaults of the pool, see `ConversionPool`.
+    """
+    global POOL
+    if max_workers is None:
+        max_workers = POOL.max_workers
+    POOL = ConversionPool(max_workers, **kwargs)
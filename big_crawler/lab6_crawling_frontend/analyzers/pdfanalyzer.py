@@ -6,17 +6,24 @@ and process it such that it fits into our elasticsearch db.
 Author: Johannes Mueller <j.mueller@reply.de>
 """
 import io
+import math
 import os
-import subprocess
+import re
 import tempfile
 import datetime as dt
 import logging
 import shutil
+from concurrent import futures
 import xml  # just for that one stupid error :/
+import xml.etree.ElementTree as ET
 from PyPDF2 import PdfFileReader
 
 import utility
 from analyzers.analyzer import BaseAnalyzer
+from analyzers import conversion
+from converters import cache
+
+logger = logging.getLogger(__name__)
 
 XMP_NAMESPACES = {
     "http://purl.org/dc/elements/1.1/": "dc",
@@ -26,6 +33,15 @@ XMP_NAMESPACES = {
     "http://ns.adobe.com/xap/1.0/t/pg/": "xmpTPg"
 }
 
+RDF_NAMESPACE = "http://www.w3.org/1999/02/22-rdf-syntax-ns#"
+
+XMP_START = re.compile(r"<\?xpacket|<x:xmpmeta|<rdf:RDF")
+"""The start of the XMP metadata in the output of `pdfinfo -meta`."""
+
+INFO_KEYS = ["Title", "Subject", "Keywords", "Author", "Creator", "Producer",
+             "CreationDate", "ModDate"]
+"""The keys of the document info, as printed by `pdfinfo`."""
+
 
 def _datetime_from_meta_string(datestring):
     """Returs a datetime from a string as given in the PDFs metadata.
@@ -57,10 +73,63 @@ def _datetime_from_meta_string(datestring):
     return this_date
 
 
+def _parse_xmp(xmp):
+    """Returns the properties of XMP metadata, like `PdfFileReader` does.
+
+    The keys are prefixed by the namespaces in `XMP_NAMESPACES`, e.g.
+    `dc:title`. Of alternatives only the first (default) value is kept,
+    bags and sequences become lists.
+
+    Args:
+        xmp (str): the XMP metadata (XML).
+
+    Returns:
+        dict: the cleaned values by prefixed key.
+    """
+    try:
+        root = ET.fromstring(xmp)
+    except ET.ParseError as e:
+        logger.debug(f"Couldn't parse the XMP metadata. {e}")
+        return {}
+
+    def split(tag):
+        namespace, _, name = tag[1:].partition("}")
+        return XMP_NAMESPACES.get(namespace, "meta"), namespace, name
+
+    metadata = {}
+    for desc in root.iter(f"{{{RDF_NAMESPACE}}}Description"):
+        values = list(desc.attrib.items())
+        for child in desc:
+            container = child.find("*")
+            items = [li.text.strip()
+                     for li in child.iter(f"{{{RDF_NAMESPACE}}}li")
+                     if li.text and li.text.strip()]
+            if container is None:
+                values.append((child.tag, (child.text or "").strip()))
+            elif container.tag == f"{{{RDF_NAMESPACE}}}Alt":
+                values.append((child.tag, items[:1]))
+            else:
+                values.append((child.tag, items))
+
+        for tag, value in values:
+            if not tag.startswith("{"):
+                continue
+            prefix, namespace, name = split(tag)
+            if namespace == RDF_NAMESPACE:
+                continue
+            val = utility.clean_value(value)
+            if val is not None and val != "":
+                metadata[f"{prefix}:{name}"] = val
+    return metadata
+
+
 class PDFAnalyzer(BaseAnalyzer):
 
     required = ["content"]
 
+    version = 1
+    """The version of the extracted texts, see `converters.cache`."""
+
     def __init__(self, **kwargs):
         """Initializes the PDFAnalyzer with an `elastic.Elastic` instance.
 
@@ -72,60 +141,184 @@ class PDFAnalyzer(BaseAnalyzer):
         """
         super().__init__()
         self.defaults = utility.DefaultDict({
-            "bin_path": utility.path_in_project("pdftotext", True)
+            "bin_path": utility.path_in_project("pdftotext", True),
+            "info_path": utility.path_in_project("pdfinfo", True),
+            "page_threshold": 50,
+            "min_range": 10
         }, **kwargs)
 
-    def _convert_pdf(self, content, exc, tmp_pdf, tmp_txt, **kwargs):
-        """Converts a binary pdf-stream to text, by using xpdf utilties.
+    def _run(self, path_to_exc, content, arguments=None, output=None,
+             **kwargs):
+        """Runs a poppler tool on the PDF in the shared conversion pool.
 
-        Saves the `stream` in `tmp_pdf` and converts to `tmp_txt`."""
-        # get a password if saved
-        password = self.defaults.other(kwargs).password()
-        # save the stream to the temporary files
-        with open(tmp_pdf, "wb") as fl:
-            fl.write(content)
+        Args:
+            path_to_exc (str): the path to the executable.
+            content (bytes): the PDF.
+            arguments (list): further arguments of the tool.
+            output (str): the output argument of the tool, if it takes one.
+            **kwargs (dict): the options of the analysis, `password` and
+                `timeout`.
 
-        arguments = [exc, "-enc", "UTF-8"]
-        if password is not None:
-            arguments += ["-upw", password]
-        process = subprocess.Popen(arguments + [tmp_pdf, tmp_txt])
-        ret = process.wait()
-        if ret != 0:
-            raise IOError("Couldn't extract any text information.")
-        return ret
-
-    def _pdftotext(self, content, **kwargs):
-        """Returns the contained text of the PDF-File."""
-        # get the path to the executable
-        path_to_exc = self.defaults.bin_path()
+        Returns:
+            bytes: the output of the tool.
+        """
         if not (os.path.exists(path_to_exc) or shutil.which(path_to_exc)):
             raise ValueError(f"The current path '{path_to_exc}' does not lead "
                              " to an actual file.")
-        text = None
-        # get the temporary paths
+        # get a password if saved
+        password = self.defaults.other(kwargs).password()
+        # use the timeout of the pool, if none is given.
+        options = {}
+        if self.defaults.other(kwargs).timeout() is not None:
+            options["timeout"] = self.defaults.other(kwargs).timeout()
+
+        command = [path_to_exc] + (arguments or [])
+        if password is not None:
+            command += ["-upw", password]
+        output = [output] if output is not None else []
+
+        if utility.PLATFORM != "win32":
+            return conversion.POOL.run(command + ["-"] + output, content,
+                                       **options)
+        # xpdf can't read from stdin.
+        with tempfile.TemporaryDirectory(prefix=".pdfconv_") as tmp_dir:
+            tmp_pdf = os.path.join(tmp_dir, "input.pdf")
+            with open(tmp_pdf, "wb") as fl:
+                fl.write(content)
+            return conversion.POOL.run(command + [tmp_pdf] + output,
+                                       **options)
+
+    def _pdfinfo(self, content, **kwargs):
+        """Returns the fields printed by `pdfinfo`.
+
+        `pdfinfo` only reads the trailer, the xref table, the info
+        dictionary and the XMP metadata, instead of parsing the whole PDF.
+
+        Returns:
+            dict: the fields (str) by name or None, if `pdfinfo` failed.
+                The XMP metadata (XML) is kept as `Metadata`.
+        """
         try:
-            with tempfile.TemporaryDirectory(prefix=".pdfconv_") as tmp_dir:
-                tmp_pdf = os.path.join(tmp_dir, "input.pdf")
-                tmp_txt = os.path.join(tmp_dir, "output.txt")
-
-                self._convert_pdf(content, path_to_exc, tmp_pdf, tmp_txt,
-                                  **kwargs)
-
-                # read back the write results
-                try:
-                    with open(tmp_txt, "r", encoding="utf-8") as fl:
-                        text = fl.read()
-                except UnicodeDecodeError as e:
-                    with open(tmp_txt, "r", encoding="latin-1") as fl:
-                        text = fl.read()
-        # handle an OSError (could surface because of AntiVir)
-        except OSError as ose:
-            logging.error("Supressed an OSError while handling the "
-                          " temp-folder.")
-        return text
-
-    def _getpdfmeta(self, content, **kwargs):
-        """Returns a dict containing the pdfs-metadata."""
+            out = self._run(self.defaults.info_path(), content,
+                            ["-enc", "UTF-8", "-rawdates", "-meta"],
+                            **kwargs)
+        except (conversion.ConversionError, ValueError) as e:
+            logger.warning(f"Couldn't read the info of the PDF. {e}")
+            return None
+
+        out = out.decode("utf-8", "replace")
+        info = {}
+        # the metadata is printed after the fields.
+        xmp_start = XMP_START.search(out)
+        if xmp_start is not None:
+            info["Metadata"] = out[xmp_start.start():]
+            out = out[:xmp_start.start()]
+        for line in out.splitlines():
+            key, sep, value = line.partition(":")
+            if sep:
+                info[key.strip()] = value.strip()
+        return info
+
+    def _page_count(self, info):
+        """Returns the number of pages in the `pdfinfo` or None."""
+        try:
+            return int(info["Pages"])
+        except (TypeError, KeyError, ValueError):
+            return None
+
+    def _page_ranges(self, pages, **kwargs):
+        """Splits the pages into one range per worker of the pool.
+
+        Args:
+            pages (int): the number of pages.
+            **kwargs (dict): the options of the analysis, `min_range` is the
+                minimum number of pages of a range.
+
+        Returns:
+            list: the first and last page (tuple) of each range, 1-based.
+        """
+        min_range = self.defaults.other(kwargs).min_range()
+        count = max(1, min(conversion.POOL.max_workers,
+                           math.ceil(pages / min_range)))
+        size = math.ceil(pages / count)
+        return [(first, min(first + size - 1, pages))
+                for first in range(1, pages + 1, size)]
+
+    def _extract(self, content, first=None, last=None, **kwargs):
+        """Returns the text of the given page range of the PDF.
+
+        Returns:
+            str: the text or None, if `pdftotext` failed.
+        """
+        arguments = ["-enc", "UTF-8"]
+        if first is not None:
+            arguments += ["-f", str(first), "-l", str(last)]
+        try:
+            out = self._run(self.defaults.bin_path(), content, arguments,
+                            output="-", **kwargs)
+        except (conversion.ConversionError, ValueError) as e:
+            pages = "" if first is None else f" of the pages {first}-{last}"
+            logger.warning(f"Couldn't extract the text{pages}. {e}")
+            return None
+        try:
+            return out.decode("utf-8")
+        except UnicodeDecodeError:
+            return out.decode("latin-1")
+
+    def _pdftotext(self, content, info=None, **kwargs):
+        """Returns the contained text of the PDF-File.
+
+        Large PDFs are split into page ranges, which are extracted in
+        parallel. Each page ends with a form feed, like in the output of a
+        single `pdftotext` run. The text of failed ranges is left out.
+
+        Returns:
+            tuple: the text (str) and whether all pages were extracted.
+        """
+        if info is None:
+            info = self._pdfinfo(content, **kwargs)
+        pages = self._page_count(info)
+        threshold = self.defaults.other(kwargs).page_threshold()
+        if pages is None or pages < threshold:
+            text = self._extract(content, **kwargs)
+            return text or "", text is not None
+
+        ranges = self._page_ranges(pages, **kwargs)
+        with futures.ThreadPoolExecutor(len(ranges)) as executor:
+            texts = list(executor.map(
+                lambda pr: self._extract(content, *pr, **kwargs), ranges))
+        return ("".join(text for text in texts if text is not None),
+                None not in texts)
+
+    def _getpdfmeta(self, content, info=None, **kwargs):
+        """Returns a dict containing the pdfs-metadata.
+
+        Reads the document info and the XMP metadata from the output of
+        `pdfinfo` and only falls back to parsing the PDF with PyPDF2, if
+        `pdfinfo` failed.
+        """
+        if info is None:
+            info = self._pdfinfo(content, **kwargs)
+        if not info:
+            return self._getpypdfmeta(content, **kwargs)
+
+        filename = self.defaults.other(kwargs).filename("No Filename")
+        metadata = {
+            "filename": filename,
+        }
+        for key in INFO_KEYS:
+            if key not in info:
+                continue
+            if "Date" in key:
+                metadata[key] = _datetime_from_meta_string(info[key])
+            else:
+                metadata[key] = info[key]
+        if info.get("Metadata"):
+            metadata.update(_parse_xmp(info["Metadata"]))
+        return metadata
+
+    def _getpypdfmeta(self, content, **kwargs):
+        """Returns a dict containing the pdfs-metadata, read by PyPDF2."""
         # other possible implementations
         # https://stackoverflow.com/questions/14209214/reading-the-pdf-properties-metadata-in-python
         # http://blog.matt-swain.com/post/25650072381/a-lightweight-xmp-parser-for-extracting-pdf
@@ -177,8 +370,26 @@ class PDFAnalyzer(BaseAnalyzer):
         # skip empty documents
         if doc["content"] is None:
             return doc
-        meta = self._getpdfmeta(doc["content"], **kwargs)
-        text = self._pdftotext(doc["content"], **kwargs)
+        # run pdfinfo once for the metadata and the page count.
+        info = self._pdfinfo(doc["content"], **kwargs) or {}
+        meta = self._getpdfmeta(doc["content"], info, **kwargs)
+        # incomplete texts aren't cached, but still returned.
+        partial = {}
+
+        def pdftotext():
+            text, complete = self._pdftotext(doc["content"], info, **kwargs)
+            if complete:
+                return text
+            partial["text"] = text
+            return None
+
+        text = cache.cached(
+            "PDFAnalyzer.pdftotext", self.version, doc["content"],
+            pdftotext,
+            options={"password": self.defaults.other(kwargs).password()},
+            text=True)
+        if text is None:
+            text = partial.get("text", "")
 
         merge_doc = {
             "text": text,
@@ -1,20 +1,21 @@
 from .converter import EmptyConverter, DummyConverter
 
 from .html_converter import HTMLConverter
-# from .office_converter import OfficeConverter
+from .office_converter import OfficeConverter
 
 CONVERTERS = {
     "default": EmptyConverter(),
     "application/pdf": DummyConverter(),
     "text/html": HTMLConverter(),
-    # "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-    #     OfficeConverter(),
-    # "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
-    #     OfficeConverter(),
-    # "application/msword": OfficeConverter(),
-    # "application/msexcel": OfficeConverter(),
-    # "application/mspowerpoint": OfficeConverter(),
-    # "application/vnd.oasis.opendocument.text": OfficeConverter(),
-    # "application/vnd.oasis.opendocument.spreadsheet": OfficeConverter(),
-    # "application/vnd.oasis.opendocument.presentation": OfficeConverter(),
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
+        OfficeConverter(".xlsx"),
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document":
+        OfficeConverter(".docx"),
+    "application/msword": OfficeConverter(".doc"),
+    "application/msexcel": OfficeConverter(".xls"),
+    "application/mspowerpoint": OfficeConverter(".ppt"),
+    "application/vnd.oasis.opendocument.text": OfficeConverter(".odt"),
+    "application/vnd.oasis.opendocument.spreadsheet": OfficeConverter(".ods"),
+    "application/vnd.oasis.opendocument.presentation":
+        OfficeConverter(".odp"),
 }
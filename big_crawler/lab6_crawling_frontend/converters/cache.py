@@ -0,0 +1,196 @@
+"""This module defines a cache for the results of conversions.
+
+A result is keyed by the sha256 of the converted content, the name and
+version of the converter and its options, such that the same content is
+converted once only. The results are saved in the `FileStore`, named after
+their key.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConversionCache():
+    """A least recently used cache of conversion results in a filestore.
+
+    Each result is saved under its key in the `conversions` substore, such
+    that the cache survives restarts and is shared by all processes using
+    the filestore. Hits renew the modification time of a result, `evict`
+    removes the least recently used results, once their total size exceeds
+    the maximum. It's meant to run periodically, see
+    `collector.BlobCollector.add_cache`.
+    """
+
+    def __init__(self, fs, max_size=512 * 1024 ** 2):
+        """Initializes the cache.
+
+        Args:
+            fs (filestore.FileStore): the filestore holding the results in a
+                substore.
+            max_size (int): the maximum total size of the results in bytes.
+        """
+        self.fs = fs.substore("conversions")
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, name, version, content, options=None):
+        """Returns the key of a conversion.
+
+        Args:
+            name (str): the name of the converter.
+            version (int): the version of the converter, which should be
+                increased, when its results change.
+            content (bytes): the converted content.
+            options (dict): the options of the conversion.
+
+        Returns:
+            str: the key.
+        """
+        digest = hashlib.sha256(content).hexdigest()
+        params = json.dumps([name, version, options or {}], sort_keys=True,
+                            default=str)
+        raw_key = f"{digest}:{params}".encode("utf-8")
+        return hashlib.sha256(raw_key).hexdigest()
+
+    def get(self, key, text=False):
+        """Returns the cached result.
+
+        Args:
+            key (str): the key of the conversion, see `key`.
+            text (bool): whether the result is a text.
+
+        Returns:
+            bytes: the result (str for texts) or None on a miss.
+        """
+        value = self.fs.get(key, mode="t" if text else "b")
+        if value is not None:
+            try:
+                # renews the entry for the eviction.
+                os.utime(self.fs.path(key))
+            except (TypeError, OSError):
+                # evicted in the meantime.
+                pass
+
+        with self.lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value, text=False, content_type=None):
+        """Saves a result.
+
+        Args:
+            key (str): the key of the conversion, see `key`.
+            value (bytes): the result (str for texts).
+            text (bool): whether the result is a text.
+            content_type (str): the mimetype of the result.
+        """
+        if text:
+            value = value.encode("utf-8")
+            content_type = "text/plain"
+        self.fs.put(key, value, content_type=content_type)
+
+    def _entries(self):
+        """Returns the modification time, size and key of all results."""
+        entries = []
+        for shard in self.fs.shards():
+            for key, mtime in self.fs.list(shard):
+                try:
+                    size = os.path.getsize(self.fs.path(key))
+                except (TypeError, OSError):
+                    continue
+                entries.append((mtime, size, key))
+        return entries
+
+    def evict(self):
+        """Removes the least recently used results above the maximum size.
+
+        Returns:
+            int: the number of removed results.
+        """
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+        removed = 0
+        for _, entry_size, key in entries:
+            if size <= self.max_size:
+                break
+            if self.fs.remove(key):
+                removed += 1
+            size -= entry_size
+        with self.lock:
+            self.evictions += removed
+        if removed:
+            logger.info(f"Evicted {removed} conversion results.")
+        return removed
+
+    def stats(self):
+        """Returns the counters of the cache.
+
+        Returns:
+            dict: the `hits`, `misses`, `evictions` of this process, the
+                number of `entries` and their total `size`.
+        """
+        entries = self._entries()
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(entries),
+                "size": sum(entry[1] for entry in entries)
+            }
+
+
+CACHE = None
+"""The cache shared by all converters, None until it is configured."""
+
+
+def configure(fs, **kwargs):
+    """Sets up the shared cache.
+
+    Args:
+        fs (filestore.FileStore): the filestore holding the results.
+        **kwargs (dict): the options of the cache, see `ConversionCache`.
+    """
+    global CACHE
+    CACHE = ConversionCache(fs, **kwargs)
+
+
+def cached(name, version, content, func, options=None, text=False,
+           content_type=None):
+    """Returns the result of a conversion from the shared cache.
+
+    Calls `func` on a miss and caches its result, unless it's None.
+
+    Args:
+        name (str): the name of the converter.
+        version (int): the version of the converter.
+        content (bytes): the converted content.
+        func (callable): the conversion, called without arguments.
+        options (dict): the options of the conversion.
+        text (bool): whether the result is a text.
+        content_type (str): the mimetype of the result.
+
+    Returns:
+        bytes: the result (str for texts).
+    """
+    cache = CACHE
+    if cache is None or content is None:
+        return func()
+    key = cache.key(name, version, content, options)
+    value = cache.get(key, text)
+    if value is not None:
+        return value
+    value = func()
+    if value is not None:
+        cache.set(key, value, text, content_type)
+    return value
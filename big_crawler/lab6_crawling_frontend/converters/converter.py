@@ -3,11 +3,22 @@ content to pdf.
 
 Author: Johannes Mueller <j.mueller@reply.de>
 """
+import json
 from abc import abstractmethod
 
+from converters import cache
+
 
 class BaseConverter:
 
+    deferred = False
+    """Whether the conversion is deferred until the content is requested,
+    see `DeferredConverter`."""
+
+    version = 1
+    """The version of the results, increase it when they change. Results of
+    converters with version None are not cached."""
+
     def __init__(self):
         super(BaseConverter, self).__init__()
 
@@ -24,9 +35,19 @@ class BaseConverter:
             bytes: content in a different format.
         """
 
+    def options(self):
+        """Returns the options of the converter, which affect its results.
+
+        Returns:
+            dict: the options, used to key the cached results.
+        """
+        return {}
+
     def __call__(self, content, **additional_args):
         """Converts the content into another format.
 
+        The results are cached, see `converters.cache`.
+
         Args:
             content (bytes): some content.
             **additional_args (dict): additional args to pass to the convert
@@ -35,20 +56,71 @@ class BaseConverter:
         Returns:
             bytes: content in a different format.
         """
-        ret = self.convert(content, **additional_args)
+        if self.version is None:
+            return self.convert(content, **additional_args)
+        ret = cache.cached(
+            type(self).__name__, self.version, content,
+            lambda: self.convert(content, **additional_args),
+            options=dict(self.options(), **additional_args),
+            content_type="application/pdf")
         return ret
 
 
+class DeferredConverter(BaseConverter):
+    """Base Class for converters, whose conversion is deferred.
+
+    The text and metadata are extracted at ingest time via `extract`, the
+    content is converted, once it's requested.
+    """
+
+    deferred = True
+
+    @abstractmethod
+    def extract(self, content, **kwargs):
+        """Extracts the text and metadata without converting the content.
+
+        Args:
+            content (bytes): some content.
+            **kwargs (dict): additional parameters used in the implementations
+                extract method.
+
+        Returns:
+            dict: the `text` (str) and `metadata` (dict) of the content.
+        """
+
+    def cached_extract(self, content, **kwargs):
+        """Extracts the text and metadata, using the conversion cache.
+
+        Args:
+            content (bytes): some content.
+            **kwargs (dict): additional args to pass to the extract function.
+
+        Returns:
+            dict: the `text` (str) and `metadata` (dict) of the content.
+        """
+        if self.version is None:
+            return self.extract(content, **kwargs)
+        extracted = cache.cached(
+            f"{type(self).__name__}.extract", self.version, content,
+            lambda: json.dumps(self.extract(content, **kwargs)),
+            options=dict(self.options(), **kwargs), text=True)
+        return json.loads(extracted)
+
+
 class DummyConverter(BaseConverter):
     """Simple Converter for the pdf-mimetype.
 
     Just fetches the content and returns it.
     """
+    version = None
+
     def convert(self, content, **kwargs):
         return content
 
 
 class EmptyConverter(BaseConverter):
     """Converter that just returns None."""
+    version = None
+
     def convert(self, content, **kwargs):
         return None
@@ -13,17 +13,37 @@ import utility
 import logging
 
 from crawlers.plugin import XPathResource
-from converters.converter import BaseConverter
+from converters.converter import DeferredConverter
 
 
 logger = logging.getLogger(__name__)
 
+LINE_TAGS = ["address", "article", "aside", "br", "dd", "div", "dt",
+             "figcaption", "footer", "header", "hr", "li", "section", "td",
+             "th", "tr"]
+"""Tags, which are put on a line of their own in the extracted text."""
 
-class HTMLConverter(BaseConverter):
+PARAGRAPH_TAGS = ["blockquote", "dl", "h1", "h2", "h3", "h4", "h5", "h6", "ol",
+                  "p", "pre", "table", "ul"]
+"""Tags, which are put in a paragraph of their own in the extracted text."""
+
+META_KEYS = {
+    "description": "Subject",
+    "keywords": "Keywords",
+    "author": "Author",
+    "generator": "Producer"
+}
+"""Names of html meta tags and their keys in the metadata (as in PDFs)."""
+
+
+class HTMLConverter(DeferredConverter):
     """Simple Converter for the html mime-type.
 
-    Just fetches the content and converts it using wkhtmltopdf.
+    The text and metadata are extracted from the html tree directly, the
+    conversion to pdf using wkhtmltopdf is deferred until the pdf is
+    requested.
     """
+
     def __init__(self, content_xpath=None):
         """Initializes the HTML converter.
 
@@ -87,6 +107,52 @@ class HTMLConverter(BaseConverter):
                     etree.XML(f"<link rel='stylesheet' href='{link}' />")
                 )
 
+    def options(self):
+        return {"content_xpath": self.content_xpath.xpath.path}
+
+    def _text(self, part):
+        """Returns the text of an html element, keeping paragraphs.
+
+        Args:
+            part (lxml.etree): An html-ETree.
+
+        Returns:
+            str: the text, with one line per block and empty lines between
+                paragraphs.
+        """
+        etree.strip_elements(part, "script", "style", "noscript",
+                             with_tail=False)
+        # line breaks in the html source have no meaning.
+        for elem in part.iter():
+            elem.text = elem.text and re.sub(r"\s+", " ", elem.text)
+            elem.tail = elem.tail and re.sub(r"\s+", " ", elem.tail)
+        for tags, brk in [(LINE_TAGS, "\n"), (PARAGRAPH_TAGS, "\n\n")]:
+            for elem in part.iter(*tags):
+                elem.text = brk + (elem.text or "")
+                elem.tail = brk + (elem.tail or "")
+        lines = [line.strip() for line in part.text_content().split("\n")]
+        return re.sub(r"\n{3,}", "\n\n", "\n".join(lines)).strip()
+
+    def extract(self, content, **kwargs):
+        tree = html.fromstring(content)
+        text = "\n\n".join([self._text(part)
+                            for part in self.content_xpath(tree)])
+
+        metadata = {}
+        title = tree.findtext(".//head/title")
+        if title and title.strip():
+            metadata["Title"] = " ".join(title.split())
+        for elem in tree.xpath("//head/meta[@name and @content]"):
+            key = META_KEYS.get(elem.attrib["name"].lower())
+            value = " ".join(elem.attrib["content"].split())
+            if key is not None and value:
+                metadata[key] = value
+
+        return {
+            "text": text,
+            "metadata": metadata
+        }
+
     def convert(self, content, **kwargs):
         tree = html.fromstring(content)
         # retrieve base url from kwargs
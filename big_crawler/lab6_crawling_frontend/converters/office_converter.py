@@ -1,12 +1,24 @@
 """This module defines a converter for converting a arbitrary office file to
 pdf.
 
+The conversions run in a small pool of long-lived headless LibreOffice
+instances. Each instance is driven by its own `unoserver` daemon, which
+keeps LibreOffice running and is reached over XML-RPC on a local port, so
+this process needs neither the python UNO bindings nor a cold start of
+LibreOffice per document.
+
 Author: Johannes Mueller <j.mueller@reply.de>
 """
+import atexit
 import os
+import queue
 import shutil
+import signal
+import socket
 import subprocess
 import tempfile
+import time
+import xmlrpc.client
 
 import utility
 import logging
@@ -17,48 +29,276 @@ from converters.converter import BaseConverter
 logger = logging.getLogger(__name__)
 
 
+def _free_port():
+    """Returns a local port, that is currently unused."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _TimeoutTransport(xmlrpc.client.Transport):
+    """An XML-RPC transport, whose connections time out."""
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def make_connection(self, host):
+        connection = super().make_connection(host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class OfficeInstance():
+    """A headless LibreOffice process with its own user profile.
+
+    The process is run by an `unoserver` daemon, which is started on first
+    use and restarted after it died or was killed, because a conversion
+    timed out.
+    """
+
+    def __init__(self, executable, unoserver, **kwargs):
+        """Initializes the instance.
+
+        Args:
+            executable (str): the path to the `soffice` executable.
+            unoserver (str): the path to the `unoserver` executable.
+            **kwargs (dict): keyword arguments to update the defaults,
+                `startup_timeout` (seconds).
+        """
+        self.executable = executable
+        self.unoserver = unoserver
+        self.defaults = utility.DefaultDict(dict({
+            "startup_timeout": 30
+        }, **kwargs))
+        self.profile = None
+        self.process = None
+        self.port = None
+        self.started = 0
+        self.ready = False
+
+    def alive(self):
+        """Returns whether the daemon is running."""
+        return self.process is not None and self.process.poll() is None
+
+    def _proxy(self, timeout):
+        """Returns an XML-RPC proxy of the daemon."""
+        return xmlrpc.client.ServerProxy(
+            f"http://127.0.0.1:{self.port}", allow_none=True,
+            transport=_TimeoutTransport(timeout))
+
+    def start(self):
+        """Starts the daemon and waits until it accepts requests.
+
+        Raises:
+            IOError: if the daemon didn't accept requests in time.
+        """
+        self.stop()
+        if self.profile is None:
+            # kept between restarts, such that LibreOffice starts warm.
+            self.profile = tempfile.mkdtemp(prefix=".officeprofile_")
+        self.port = _free_port()
+        # a session of its own, such that LibreOffice is killed with it.
+        self.process = subprocess.Popen(
+            [self.unoserver, "--interface", "127.0.0.1",
+             "--port", str(self.port), "--uno-port", str(_free_port()),
+             "--executable", self.executable,
+             "--user-installation", self.profile],
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            start_new_session=True)
+        self.started = time.time()
+        self.ready = False
+
+        deadline = self.started + self.defaults.startup_timeout()
+        while time.time() < deadline and self.alive():
+            try:
+                self._proxy(5).system.listMethods()
+            except (OSError, xmlrpc.client.Error):
+                time.sleep(0.5)
+                continue
+            logger.info(f"Started unoserver on port {self.port}.")
+            return
+        port = self.port
+        self.stop()
+        raise IOError(f"unoserver on port {port} didn't start.")
+
+    def stop(self):
+        """Stops the daemon and LibreOffice, killing them if necessary."""
+        if self.process is None:
+            return
+        try:
+            os.killpg(self.process.pid, signal.SIGTERM)
+            self.process.wait(5)
+        except subprocess.TimeoutExpired:
+            os.killpg(self.process.pid, signal.SIGKILL)
+            self.process.wait()
+        except ProcessLookupError:
+            self.process.wait()
+        self.process = None
+
+    def convert(self, content, timeout):
+        """Converts an office file to pdf.
+
+        A conversion, that takes longer than `timeout`, is aborted by
+        killing the instance.
+
+        Args:
+            content (bytes): the office file.
+            timeout (float): the maximum duration in seconds.
+
+        Returns:
+            bytes: the pdf.
+
+        Raises:
+            IOError: if the conversion failed.
+        """
+        if not self.alive():
+            self.start()
+        # the daemon serves requests before LibreOffice accepts them.
+        deadline = self.started + self.defaults.startup_timeout()
+        while True:
+            try:
+                result = self._proxy(timeout).convert(
+                    None, xmlrpc.client.Binary(content), None, "pdf")
+                self.ready = True
+                break
+            except xmlrpc.client.Fault as fault:
+                # once ready, a fault is a failure of the document.
+                if self.ready or time.time() >= deadline or not self.alive():
+                    raise IOError(f"LibreOffice failed. {fault.faultString}")
+                time.sleep(0.5)
+            except (OSError, xmlrpc.client.Error) as e:
+                # timed out or the daemon died, it is restarted on next use.
+                self.stop()
+                raise IOError(f"LibreOffice failed. {e}")
+        if result is None:
+            raise IOError("LibreOffice didn't return the pdf.")
+        return result.data
+
+
+class OfficePool():
+    """A pool of LibreOffice instances, which queues the conversions."""
+
+    def __init__(self, instances=2, **kwargs):
+        """Initializes the pool, the instances are started on first use.
+
+        Args:
+            instances (int): the number of LibreOffice instances.
+            **kwargs (dict): keyword arguments to update the defaults,
+                `timeout` (seconds per conversion), `queue_timeout`
+                (seconds to wait for an idle instance), `startup_timeout`,
+                `executable` and `unoserver`.
+        """
+        self.defaults = utility.DefaultDict(dict({
+            "timeout": 120,
+            "queue_timeout": 300,
+            "startup_timeout": 30,
+            "executable": utility.path_in_project("soffice", True),
+            "unoserver": utility.path_in_project("unoserver", True)
+        }, **kwargs))
+        self.instances = [
+            OfficeInstance(self.defaults.executable(),
+                           self.defaults.unoserver(),
+                           startup_timeout=self.defaults.startup_timeout())
+            for _ in range(instances)
+        ]
+        self.idle = queue.Queue()
+        for instance in self.instances:
+            self.idle.put(instance)
+
+    def available(self):
+        """Returns whether LibreOffice and unoserver are installed."""
+        return all(os.path.exists(executable) or bool(shutil.which(executable))
+                   for executable in (self.defaults.executable(),
+                                      self.defaults.unoserver()))
+
+    def convert(self, content, extension="", **kwargs):
+        """Converts an office file to pdf.
+
+        Blocks until an instance is idle.
+
+        Args:
+            content (bytes): the office file.
+            extension (str): the file extension, only used for logging, as
+                LibreOffice detects the format from the content.
+            **kwargs (dict): keyword arguments to override the defaults,
+                `timeout` and `queue_timeout`.
+
+        Returns:
+            bytes: the pdf.
+
+        Raises:
+            IOError: if the conversion failed or timed out.
+        """
+        options = self.defaults.other(kwargs)
+        try:
+            instance = self.idle.get(timeout=options.queue_timeout())
+        except queue.Empty:
+            raise IOError("No LibreOffice instance got idle in time.")
+
+        try:
+            logger.debug(f"Converting a {extension or 'office'} file to pdf.")
+            return instance.convert(content, options.timeout())
+        finally:
+            self.idle.put(instance)
+
+    def stop(self):
+        """Stops all instances and removes their profiles."""
+        for instance in self.instances:
+            instance.stop()
+            if instance.profile is not None:
+                shutil.rmtree(instance.profile, ignore_errors=True)
+                instance.profile = None
+
+
+POOL = OfficePool()
+"""The pool shared by all office converters."""
+
+
+def configure(instances=None, **kwargs):
+    """Replaces the shared pool by one with the given options.
+
+    Args:
+        instances (int): the number of LibreOffice instances.
+        **kwargs (dict): the options of the pool, see `OfficePool`.
+    """
+    global POOL
+    if instances is None:
+        instances = len(POOL.instances)
+    POOL.stop()
+    POOL = OfficePool(instances, **kwargs)
+
+
+@atexit.register
+def _stop_pool():
+    POOL.stop()
+
+
 class OfficeConverter(BaseConverter):
     """Simple Converter for all LibreOffice-Supported formats.
 
-    Uses an headless libreoffice executable.
+    Uses the shared pool of headless LibreOffice instances.
     """
-    def convert(self, content, **kwargs):
-        path_to_exc = utility.path_in_project("soffice", True)
-        if not (os.path.exists(path_to_exc) or shutil.which(path_to_exc)):
-            raise ValueError(f"The current path '{path_to_exc}' does not lead "
-                             " to an actual file.")
+    def __init__(self, extension=""):
+        """Initializes the office converter.
 
-        pdf = None
+        Args:
+            extension (str): the file extension of the converted format,
+                e.g. ".docx".
+        """
+        super().__init__()
+        self.extension = extension
+
+    def options(self):
+        return {"extension": self.extension}
+
+    def convert(self, content, **kwargs):
+        if not POOL.available():
+            logger.warning("Skipped a document, LibreOffice isn't installed.")
+            return None
         try:
-            with tempfile.TemporaryDirectory(prefix=".officeconv_") as tmp_dir:
-                tmp_off = os.path.join(tmp_dir, "office")
-
-                pdf = self._convert_to_pdf(content, path_to_exc, tmp_off,
-                                           **kwargs)
-        # catch oserrors caused by anti-virus software.
-        except OSError as ose:
-            logging.error("Supressed an OSError while handling the "
-                          " temp-folder.")
-        return pdf
-
-    def _convert_to_pdf(self, content, executable, tmp_off, **kwargs):
-        with open(tmp_off, "wb") as in_file:
-            in_file.write(content)
-
-        command = [executable,
-                   "-convert-to pdf",  # target format
-                   "-headless",  # headless mode for conversion
-                   tmp_off]
-
-        logging.info(f"Running command '{' '.join(command)}'")
-        process = subprocess.Popen(command)
-
-        ret = process.wait()
-        if ret != 0:
-            raise IOError("Couldn't extract any text information.")
-
-        content = None
-        tmp_pdf = f"{tmp_off}.pdf"
-        with open(tmp_pdf, "rb") as out_file:
-            content = out_file.read()
-        return content
+            return POOL.convert(content, self.extension)
+        except IOError as ioe:
+            logger.warning(f"Skipped a document due to LibreOffice failure. "
+                           f"{ioe}")
+            return None
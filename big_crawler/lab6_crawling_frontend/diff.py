@@ -1,26 +1,29 @@
 """Provides some functions for creating a html-diff view between two texts.
 
-It relies heavily on difflib and the function used most will be `get_diff`.
+The function used most will be `get_unified_diff`. It interns the lines to
+integers and diffs them by patience anchors and Myers' algorithm, bounded by
+a time and a size budget. Texts exceeding the size budget are compared by
+paragraphs instead of lines.
 
 Author: Johannes Mueller <j.mueller@reply.de>
 """
 
+import collections
 import difflib
-import re
+import bisect
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
-CONTEXT_LINE_REGEX = r"^@@ ([+-])(\d+,)?(\d+) ([+-])(\d+,)?(\d+) @@\s*$"
-IDENTIFIER_MAP = {"+ ": 2, "- ": 1, "  ": 0}
-
-
-def _get_unified_diff(doc, other):
-    """Simple wrapper method for getting the unified diff."""
-    current_text = doc["text"].splitlines()
-    former_text = other["text"].splitlines()
+MAX_LINES = 20000
+"""Number of lines of both texts, above which paragraphs are compared."""
+MAX_EDITS = 1000
+"""Maximum number of edits Myers' algorithm searches for in a region."""
+TIMEOUT = 2.0
+"""Seconds after which unmatched regions count as replaced."""
 
-    return difflib.unified_diff(former_text, current_text)
+IDENTIFIER_MAP = {"+ ": 2, "- ": 1, "  ": 0}
 
 
 def _get_diff(doc, other):
@@ -33,105 +36,6 @@ def _get_diff(doc, other):
     return difflib.ndiff(current_text, former_text)
 
 
-def _parse_context_line(line):
-    """Parse the context line of the diff (the one that starts with @@).
-
-    Returns a dict with the following structure:
-
-    `{"+": {"start": 1, "length": 7},
-      "-": {"start": 1, "length": 4}}`
-
-    Args:
-        line (str): the context_line.
-
-    Returns:
-        dict: a dict as specified above.
-    """
-    match = re.match(CONTEXT_LINE_REGEX, line)
-    if match is None:
-        raise ValueError(f"The line: '{line}' seems to be no context line!")
-    groupings = []
-    for group in match.groups():
-        if group in ["+", "-"]:
-            groupings.append([group])
-        elif group[-1] == ",":
-            groupings[-1].append(int(group[:-1]))
-        else:
-            groupings[-1].append(int(group))
-
-    for g in groupings:
-        if len(g) < 3:
-            g.append(1)
-    ret = {g[0]: {"start": g[1], "length": g[2]} for g in groupings}
-    return ret
-
-
-def _not(sign):
-    """Little utility, to reverse a sign."""
-    if sign == "+":
-        return "-"
-    return "+"
-
-
-def _process_unified_diff(deltas):
-    """Process a unified diff to get a well-processable output.
-
-    The output will be a list of blocks, where each block is represented by a
-    dict. The dict-keys stand for the two versions '+' (right) and '-' (left).
-    The values of these versions are arrays in the following format:
-
-    `[{"num": 1, "mark": "highlight", "line": "text of first line"},
-      {"num": 2, "mark": "highlight", "line": "text of second line"},
-      {"num": '.', "mark": "crossout", "line": ""},
-      {"num": '.', "mark": "crossout", "line": ""},
-      {"num": '.', "mark": "crossout", "line": ""},
-      {"num": 3, "mark": "", "line": "text of third line"}]`
-
-    Args:
-        deltas (str): the lines of the context diff.
-
-    Returns:
-        tuple: a list of dicts in the given format and a dict holding the
-            changes.
-    """
-    blocks = []
-    line_nums = {"+": 0, "-": 0}
-    change = {"+": 0, "-": 0}
-    cur_dict = None
-
-    # skip the first two lines that contain +++ and --- respectively
-    try:
-        next(deltas)
-        next(deltas)
-    # there might be a StopIteration Exception, when there is no diff.
-    except StopIteration:
-        return blocks, change
-
-    for d in deltas:
-        if d[0] == "@":
-            # a new block was found, create a new tuple
-            if cur_dict is not None:
-                blocks.append(cur_dict)
-            cur_dict = {"+": [], "-": []}
-            for s, vals in _parse_context_line(d).items():
-                line_nums[s] = vals["start"]
-        if d[0] == " ":
-            for s in ["+", "-"]:
-                # do it for both files.
-                line_nums[s] += 1
-                cur_dict[s].append({"num": line_nums[s], "mark": "",
-                                    "line": d[1:]})
-        elif d[0] in ["+", "-"]:
-            s = d[0]
-            line_nums[s] += 1
-            change[s] += 1
-            cur_dict[s].append({"num": line_nums[s], "mark": "highlight",
-                                "line": d[1:]})
-            cur_dict[_not(s)].append({"num": 0, "mark": "crossout",
-                                      "line": " "})
-    return blocks, change
-
-
 def get_diff(doc, other):
     """DEPRECATED
     Creates a diff-list between two documents in the following format.
@@ -203,7 +107,302 @@ def get_diff_texts(doc, other):
     return ret
 
 
-def get_unified_diff(doc, other):
+def _intern(former, current):
+    """Maps equal lines of both texts to equal integers.
+
+    Args:
+        former (list): the lines of the former text.
+        current (list): the lines of the current text.
+
+    Returns:
+        tuple: two lists of integers.
+    """
+    ids = {}
+    return ([ids.setdefault(line, len(ids)) for line in former],
+            [ids.setdefault(line, len(ids)) for line in current])
+
+
+def _paragraphs(lines):
+    """Returns the start indices of the paragraphs in a list of lines."""
+    starts = [0]
+    for num, line in enumerate(lines[:-1], 1):
+        if not line.strip() and lines[num].strip():
+            starts.append(num)
+    return starts
+
+
+def _myers(a, b, deadline, max_edits=MAX_EDITS):
+    """Returns the matching positions of two sequences by Myers' algorithm.
+
+    Args:
+        a (list): the first sequence.
+        b (list): the second sequence.
+        deadline (float): the time after which the search is cancelled.
+        max_edits (int): the maximum edit distance to search for.
+
+    Returns:
+        list: tuples of matching indices in `a` and `b` or None, if the
+            budget was exceeded.
+    """
+    n, m = len(a), len(b)
+    max_d = min(n + m, max_edits)
+    offset = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+    for d in range(max_d + 1):
+        if time.time() > deadline:
+            return None
+        trace.append(list(v))
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m, offset)
+    return None
+
+
+def _backtrack(trace, x, y, offset):
+    """Walks the trace of `_myers` back and collects the matches."""
+    matches = []
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[offset + prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        x, y = prev_x, prev_y
+    matches.reverse()
+    return matches
+
+
+def _unique_anchors(a, b, alo, ahi, blo, bhi):
+    """Returns the longest increasing run of lines unique in both regions.
+
+    Returns:
+        list: tuples of matching indices in `a` and `b`.
+    """
+    count_a = collections.Counter(a[alo:ahi])
+    count_b = collections.Counter(b[blo:bhi])
+    pos_b = {b[j]: j for j in range(blo, bhi) if count_b[b[j]] == 1}
+    pairs = [(i, pos_b[a[i]]) for i in range(alo, ahi)
+             if count_a[a[i]] == 1 and a[i] in pos_b]
+
+    # patience sorting for the longest increasing subsequence.
+    tails, tail_idx, prev = [], [], [None] * len(pairs)
+    for idx, (_, j) in enumerate(pairs):
+        pos = bisect.bisect_left(tails, j)
+        if pos > 0:
+            prev[idx] = tail_idx[pos - 1]
+        if pos == len(tails):
+            tails.append(j)
+            tail_idx.append(idx)
+        else:
+            tails[pos] = j
+            tail_idx[pos] = idx
+
+    anchors = []
+    idx = tail_idx[-1] if tail_idx else None
+    while idx is not None:
+        anchors.append(pairs[idx])
+        idx = prev[idx]
+    anchors.reverse()
+    return anchors
+
+
+def _match(a, b, deadline):
+    """Returns all matching positions of two sequences.
+
+    Common pre- and suffixes are matched first, the remaining regions are
+    split at lines, which are unique in both regions (patience diff).
+    Regions without such lines are matched by Myers' algorithm.
+
+    Args:
+        a (list): the first sequence.
+        b (list): the second sequence.
+        deadline (float): the time after which regions aren't matched
+            anymore.
+
+    Returns:
+        list: sorted tuples of matching indices in `a` and `b`.
+    """
+    matches = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        alo, ahi, blo, bhi = regions.pop()
+        while alo < ahi and blo < bhi and a[alo] == b[blo]:
+            matches.append((alo, blo))
+            alo += 1
+            blo += 1
+        while alo < ahi and blo < bhi and a[ahi - 1] == b[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+            matches.append((ahi, bhi))
+        if alo == ahi or blo == bhi:
+            continue
+        if time.time() > deadline:
+            logger.debug("Diff timed out, regions count as replaced.")
+            continue
+
+        anchors = _unique_anchors(a, b, alo, ahi, blo, bhi)
+        if anchors:
+            matches.extend(anchors)
+            bounds = [(alo - 1, blo - 1)] + anchors + [(ahi, bhi)]
+            for (i1, j1), (i2, j2) in zip(bounds, bounds[1:]):
+                regions.append((i1 + 1, i2, j1 + 1, j2))
+            continue
+
+        found = _myers(a[alo:ahi], b[blo:bhi], deadline)
+        if found is not None:
+            matches.extend((i + alo, j + blo) for i, j in found)
+    matches.sort()
+    return matches
+
+
+def _opcodes(matches, n, m):
+    """Transforms matching positions into opcodes as used by difflib.
+
+    Returns:
+        list: tuples of `(tag, i1, i2, j1, j2)`, where tag is one of
+            "equal", "replace", "delete" or "insert".
+    """
+    opcodes = []
+    i = j = 0
+    for mi, mj in matches + [(n, m)]:
+        if i < mi or j < mj:
+            tag = "replace"
+            if i == mi:
+                tag = "insert"
+            elif j == mj:
+                tag = "delete"
+            opcodes.append((tag, i, mi, j, mj))
+        if mi < n:
+            # merge consecutive matches.
+            if opcodes and opcodes[-1][0] == "equal" and \
+                    opcodes[-1][2] == mi and opcodes[-1][4] == mj:
+                opcodes[-1] = ("equal", opcodes[-1][1], mi + 1,
+                               opcodes[-1][3], mj + 1)
+            else:
+                opcodes.append(("equal", mi, mi + 1, mj, mj + 1))
+        i, j = mi + 1, mj + 1
+    return opcodes
+
+
+def diff_lines(former, current, max_lines=MAX_LINES, timeout=TIMEOUT):
+    """Diffs two lists of lines.
+
+    Args:
+        former (list): the lines of the former text.
+        current (list): the lines of the current text.
+        max_lines (int): the number of lines of both texts, above which
+            whole paragraphs are compared. Defaults to `MAX_LINES`.
+        timeout (float): seconds, after which unmatched regions count as
+            replaced. Defaults to `TIMEOUT`.
+
+    Returns:
+        list: opcodes as returned by `difflib.SequenceMatcher.get_opcodes`.
+    """
+    deadline = time.time() + timeout
+    if len(former) + len(current) <= max_lines:
+        a, b = _intern(former, current)
+        return _opcodes(_match(a, b, deadline), len(a), len(b))
+
+    # coarse fallback, compare whole paragraphs and expand them to lines.
+    logger.debug("Texts too long, comparing paragraphs.")
+    starts_a, starts_b = _paragraphs(former), _paragraphs(current)
+    bounds_a = starts_a + [len(former)]
+    bounds_b = starts_b + [len(current)]
+    a, b = _intern(["\n".join(former[s:e]) for s, e in zip(bounds_a,
+                                                             bounds_a[1:])],
+                   ["\n".join(current[s:e]) for s, e in zip(bounds_b,
+                                                              bounds_b[1:])])
+    return [(tag, bounds_a[i1], bounds_a[i2], bounds_b[j1], bounds_b[j2])
+            for tag, i1, i2, j1, j2 in _opcodes(_match(a, b, deadline),
+                                                len(a), len(b))]
+
+
+def _group_opcodes(opcodes, context=3):
+    """Groups opcodes into hunks with `context` lines around each change.
+
+    Works like `difflib.SequenceMatcher.get_grouped_opcodes`.
+    """
+    if not any(op[0] != "equal" for op in opcodes):
+        return
+    codes = list(opcodes)
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - context), i2, max(j1, j2 - context), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + context), j1, min(j2, j1 + context)
+
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        # split at large unchanged ranges.
+        if tag == "equal" and i2 - i1 > 2 * context:
+            group.append((tag, i1, min(i2, i1 + context),
+                          j1, min(j2, j1 + context)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - context), max(j1, j2 - context)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _block(group, former, current):
+    """Renders a hunk of opcodes into a block for `diff.html`."""
+    block = {"+": [], "-": []}
+    for tag, i1, i2, j1, j2 in group:
+        if tag == "equal":
+            for i, j in zip(range(i1, i2), range(j1, j2)):
+                block["-"].append({"num": i + 1, "mark": "",
+                                   "line": former[i]})
+                block["+"].append({"num": j + 1, "mark": "",
+                                   "line": current[j]})
+            continue
+        # removed lines first, the added ones below.
+        for i in range(i1, i2):
+            block["-"].append({"num": i + 1, "mark": "highlight",
+                               "line": former[i]})
+            block["+"].append({"num": 0, "mark": "crossout", "line": " "})
+        for j in range(j1, j2):
+            block["+"].append({"num": j + 1, "mark": "highlight",
+                               "line": current[j]})
+            block["-"].append({"num": 0, "mark": "crossout", "line": " "})
+    return block
+
+
+def iter_blocks(former, current, opcodes, context=3):
+    """Yields the blocks of a diff one by one.
+
+    Args:
+        former (list): the lines of the former text.
+        current (list): the lines of the current text.
+        opcodes (list): the opcodes as returned by `diff_lines`.
+        context (int): the number of unchanged lines around each change.
+
+    Yields:
+        dict: a block, see `get_unified_diff`.
+    """
+    for group in _group_opcodes(opcodes, context):
+        yield _block(group, former, current)
+
+
+def get_unified_diff(doc, other, context=3, lazy=False, **kwargs):
     """Return a unified diff as a well-processable output.
 
     The output will be a list of blocks, where each block is represented by a
@@ -212,17 +411,36 @@ def get_unified_diff(doc, other):
 
     `[{"num": 1, "mark": "highlight", "line": "text of first line"},
       {"num": 2, "mark": "highlight", "line": "text of second line"},
-      {"num": '.', "mark": "crossout", "line": ""},
-      {"num": '.', "mark": "crossout", "line": ""},
-      {"num": '.', "mark": "crossout", "line": ""},
+      {"num": 0, "mark": "crossout", "line": " "},
+      {"num": 0, "mark": "crossout", "line": " "},
+      {"num": 0, "mark": "crossout", "line": " "},
       {"num": 3, "mark": "", "line": "text of third line"}]`
 
     Args:
         doc (dict): the left document of this comparison.
         other (dict): the right document of this comparison.
+        context (int): the number of unchanged lines around each change.
+            Defaults to 3.
+        lazy (bool): whether the blocks should be returned as a generator,
+            such that they are only built while rendering.
+        **kwargs (dict): the budget `max_lines` and `timeout`, see
+            `diff_lines`.
 
     Returns:
-        tuple: a list of dicts in the given format, and a dict of changes.
+        tuple: a list (or generator) of dicts in the given format, and a
+            dict of changes.
     """
-    deltas = _get_unified_diff(doc, other)
-    return _process_unified_diff(deltas)
+    current = doc["text"].splitlines()
+    former = other["text"].splitlines()
+
+    opcodes = diff_lines(former, current, **kwargs)
+    change = {"+": 0, "-": 0}
+    for tag, i1, i2, j1, j2 in opcodes:
+        if tag != "equal":
+            change["-"] += i2 - i1
+            change["+"] += j2 - j1
+
+    blocks = iter_blocks(former, current, opcodes, context)
+    if not lazy:
+        blocks = list(blocks)
+    return blocks, change
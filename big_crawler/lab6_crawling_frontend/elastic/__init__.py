@@ -1,4 +1,5 @@
 from .elastic import Elastic
+from .ingest import IngestQueue
 
-# expose Elastic only
-__all__ = [Elastic]
+# expose Elastic and IngestQueue only
+__all__ = [Elastic, IngestQueue]
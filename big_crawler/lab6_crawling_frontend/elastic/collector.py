@@ -0,0 +1,158 @@
+"""Garbage collection module, which removes unreferenced filestore blobs.
+
+Documents reference their blobs by hash (see `BLOB_FIELDS`), several
+documents may share a blob. Other indices, e.g. the ingest jobs, register
+their references with `BlobCollector.add_references`. Instead of counting
+references on every write, a mark-and-sweep collector runs in the
+background: it marks all hashes referenced by documents of a filestore
+shard and removes the remaining blobs, once they are older than a grace
+period.
+"""
+import logging
+import time
+
+from elasticsearch import helpers as es_helpers
+
+import utility
+
+logger = logging.getLogger(__name__)
+
+BLOB_FIELDS = ["hash", "content", "text_hash", "diff"]
+"""Document fields, which reference filestore blobs."""
+
+
+class BlobCollector():
+    """Collects the blobs of a filestore, which no document references.
+
+    Each run handles a few shards only and continues with the next shards
+    on the next run, such that it can run periodically on a live system.
+    """
+
+    def __init__(self, client, fs, index, **kwargs):
+        """Initializes the collector for the given docs index and filestore.
+
+        Args:
+            client (elasticsearch.Elasticsearch): the elasticsearch client.
+            fs (filestore.FileStore): the filestore to clean up.
+            index (str): the docs index (or alias).
+            **kwargs (dict): keyword arguments to update the defaults,
+                `grace_period` (seconds, younger blobs are kept, as their
+                document might not be indexed yet), `shards_per_run`,
+                `max_deletes` (per run) and `delete_rate` (per second).
+        """
+        self.es = client
+        self.fs = fs
+        self.defaults = utility.DefaultDict(dict({
+            "index": index,
+            "grace_period": 24 * 60 * 60,
+            "shards_per_run": 16,
+            "max_deletes": 1000,
+            "delete_rate": 50
+        }, **kwargs))
+        self.position = 0
+        self.references = [(index, BLOB_FIELDS, None)]
+        self.caches = []
+
+    def add_references(self, index, fields, query_filter=None):
+        """Registers further documents, which reference blobs.
+
+        E.g. the ingest jobs reference their uploads, until they are
+        inserted, see `ingest.IngestQueue`.
+
+        Args:
+            index (str): the index of the referencing documents.
+            fields (list): the fields, which hold the hashes.
+            query_filter (dict): a filter context, restricting the documents,
+                whose references are live. Defaults to None, all documents.
+        """
+        self.references.append((index, fields, query_filter))
+
+    def add_cache(self, cache):
+        """Registers a cache, whose entries are evicted on every run.
+
+        Caches keep their entries outside of the shards, as no document
+        references them, see `converters.cache.ConversionCache`.
+
+        Args:
+            cache (object): a cache providing `evict()`.
+        """
+        self.caches.append(cache)
+
+    def mark(self, shard):
+        """Returns all hashes of the shard, which are referenced.
+
+        Args:
+            shard (str): the shard, a two character hash prefix.
+
+        Returns:
+            set: the referenced hashes.
+        """
+        live = set()
+        for index, fields, query_filter in self.references:
+            query = {
+                "query": {
+                    "bool": {
+                        "should": [{"prefix": {field: shard}}
+                                   for field in fields],
+                        "minimum_should_match": 1,
+                        "filter": query_filter or []
+                    }
+                }
+            }
+            for hit in es_helpers.scan(self.es, index=index, query=query,
+                                       _source=fields):
+                source = hit.get("_source", {})
+                live.update(source[field] for field in fields
+                            if source.get(field))
+        return live
+
+    def sweep(self, shard, live, max_deletes=None):
+        """Removes the unreferenced blobs of the shard.
+
+        Args:
+            shard (str): the shard, a two character hash prefix.
+            live (set): the referenced hashes, see `mark`.
+            max_deletes (int): the maximum number of removed blobs.
+
+        Returns:
+            int: the number of removed blobs.
+        """
+        if max_deletes is None:
+            max_deletes = self.defaults.max_deletes()
+        deadline = time.time() - self.defaults.grace_period()
+        interval = 1 / self.defaults.delete_rate()
+
+        removed = 0
+        for filename, mtime in self.fs.list(shard):
+            if removed >= max_deletes:
+                break
+            if filename in live or mtime > deadline:
+                continue
+            if self.fs.remove(filename):
+                removed += 1
+                time.sleep(interval)
+        return removed
+
+    def run(self):
+        """Collects the garbage of the next `shards_per_run` shards.
+
+        Evicts the registered caches afterwards.
+
+        Returns:
+            int: the number of removed blobs.
+        """
+        shards = self.fs.shards()
+        removed = 0
+        for _ in range(self.defaults.shards_per_run()):
+            max_deletes = self.defaults.max_deletes() - removed
+            if max_deletes <= 0:
+                break
+            shard = shards[self.position]
+            live = self.mark(shard)
+            removed += self.sweep(shard, live, max_deletes)
+            self.position = (self.position + 1) % len(shards)
+        if removed:
+            logger.info(f"Removed {removed} unreferenced blobs.")
+        for cache in self.caches:
+            cache.evict()
+        return removed
@@ -6,15 +6,24 @@ Author: Johannes Mueller <j.mueller@reply.de>
 """
 import logging
 import time
+import datetime as dt
 import ssl
 import os
+import threading
+from concurrent import futures
 
 import elasticsearch as es
+from elasticsearch import helpers as es_helpers
 
 import utility
 import analyzers
+import diff
+from converters import CONVERTERS
 from . import transforms as etrans
 from . import filestore
+from . import schema
+from . import lineage
+from . import collector
 
 
 logger = logging.getLogger(__name__)
@@ -25,6 +34,27 @@ sda = utility.safe_dict_access
 
 
 class Elastic():
+    SCHEMA_VERSION = 10
+    """Version of scripts, mappings and settings, increase on every change."""
+
+    DOC_MAPPING_VERSION = 3
+    """Version of `DOC_MAPPING`, increase on changes that need a reindex."""
+
+    PARTITIONS = {
+        "month": {
+            "format": "%Y.%m",
+            "length": 7,
+            "next": lambda d: dt.datetime(d.year + d.month // 12,
+                                          d.month % 12 + 1, 1)
+        },
+        "year": {
+            "format": "%Y",
+            "length": 4,
+            "next": lambda d: dt.datetime(d.year + 1, 1, 1)
+        }
+    }
+    """Supported time partitions of the docs index, keyed by `date`."""
+
     SETTINGS = {
         "index": {
             "mapping.ignore_malformed": "true"
@@ -34,6 +64,8 @@ class Elastic():
     DOC_MAPPING = {
         "properties": {
             "hash": {"type": "keyword"},
+            # a copy of the `_id`, which has no doc values to sort by.
+            "doc_id": {"type": "keyword"},
             "version": {"type": "double"},
             "document": {"type": "keyword"},
             "date": {"type": "date"},
@@ -43,7 +75,10 @@ class Elastic():
                     "name": {"type": "keyword"},
                 }
             },
-            "text": {"type": "text"},
+            # term vectors make highlighting cheap for long documents.
+            "text": {"type": "text",
+                     "term_vector": "with_positions_offsets"},
+            "text_hash": {"type": "keyword"},
             "content_type": {"type": "keyword"},
             "content": {"type": "keyword"},
             "tags": {"type": "keyword"},
@@ -76,6 +111,11 @@ class Elastic():
             "category": {"type": "keyword"},
             "fingerprint": {"type": "keyword"},
             "version_key": {"type": "keyword"},
+            # all versions of a document share its lineage (the source url).
+            "lineage": {"type": "keyword"},
+            "predecessor": {"type": "keyword"},
+            # the filename of the cached diff to the predecessor.
+            "diff": {"type": "keyword"},
             "connections": {
                 "type": "object",
                 "properties": {
@@ -87,6 +127,38 @@ class Elastic():
         }
     }
 
+    SOURCE_EXCLUDES = ["text"]
+    """Fields kept in the `_source` (updates and reindexing need them),
+    which aren't returned, unless they are asked for explicitly."""
+
+    PASSAGE_MAPPING = {
+        "properties": {
+            "parent": {"type": "keyword"},
+            "page": {"type": "integer"},
+            "text": {"type": "text",
+                     "term_vector": "with_positions_offsets"},
+            # copied from the parent, such that passages can be filtered.
+            "date": {"type": "date"},
+            "type": {"type": "keyword"},
+            "category": {"type": "keyword"},
+            "source": {
+                "properties": {
+                    "name": {"type": "keyword"}
+                }
+            }
+        }
+    }
+
+    PASSAGE_FIELDS = ["date", "type", "category", "source"]
+    """Fields of the parent, that are copied to each passage."""
+
+    LOCATION_MAPPING = {
+        "properties": {
+            "index": {"type": "keyword"}
+        }
+    }
+    """Maps document ids to their partition, see `_locate_documents`."""
+
     SEED_MAPPING = {
         "properties": {
             "url": {"type": "keyword"},
@@ -156,6 +228,20 @@ class Elastic():
                 "source": ("doc['fingerprint'].value - params.fingerprint"),
             }
         },
+        "partition_index": {
+            "script": {
+                "lang": "painless",
+                "source": """
+                    String date = ctx._source.date;
+                    if (date == null || date.length() < params.length) {
+                        ctx._index = params.fallback;
+                    } else {
+                        ctx._index = params.prefix +
+                            date.substring(0, params.length).replace("-", ".");
+                    }
+                """
+            }
+        },
         "update_body": {
             "script": {
                 "lang": "painless",
@@ -165,6 +251,43 @@ class Elastic():
                     }
                 """
             }
+        },
+        "mutate_document": {
+            "script": {
+                "lang": "painless",
+                "source": """
+                    if (!params.remove_tags.isEmpty() ||
+                        !params.add_tags.isEmpty()) {
+                        if (ctx._source.tags == null) {
+                            ctx._source.tags = [];
+                        }
+                        ctx._source.tags.removeAll(params.remove_tags);
+                        for (t in params.add_tags) {
+                            if (!ctx._source.tags.contains(t)) {
+                                ctx._source.tags.add(t);
+                            }
+                        }
+                    }
+                    // only existing properties may be changed.
+                    for (k in params.body.keySet()) {
+                        if (ctx._source.containsKey(k)) {
+                            ctx._source[k] = params.body[k];
+                        }
+                    }
+                    // keep the weights of the remaining map keys.
+                    for (k in params.map_keys.keySet()) {
+                        if (ctx._source.containsKey(k)) {
+                            def old = ctx._source[k];
+                            Map updated = new HashMap();
+                            for (v in params.map_keys[k]) {
+                                updated[v] = (old == null) ? 1 :
+                                    old.getOrDefault(v, 1);
+                            }
+                            ctx._source[k] = updated;
+                        }
+                    }
+                """
+            }
         }
     }
 
@@ -181,6 +304,9 @@ class Elastic():
             cert (path): a path to a self-signed certificate as used by
                 ibmcloud.
             **kwargs (dict): keyword arguments that updates the defaults.
+                `partition` ("month" or "year") splits the docs index into
+                time partitions by `date`, read through the `docs_index`
+                alias.
 
         Returns:
             Elastic: a new elasticsearch client.
@@ -192,8 +318,21 @@ class Elastic():
             "doc_type": "nutch",
             "seed_type": "seed",
             "search_type": "search",
+            "schema_index": "schema",
+            "passages_index": "passages",
+            "passage_type": "passage",
+            "passage_size": 3000,
+            "render_workers": 2,
+            "render_wait": 5,
+            "locations_index": "locations",
+            "location_type": "location",
             "size": 10
         }, **kwargs))
+        if self.defaults.partition() not in self.PARTITIONS:
+            if self.defaults.partition():
+                logger.error(f"Unknown partition '{self.defaults.partition()}'"
+                             ", the docs index won't be partitioned.")
+            self.defaults["partition"] = None
 
         context = None
         if cert:
@@ -206,26 +345,131 @@ class Elastic():
                                    use_ssl=True, ssl_context=context,
                                    timeout=60)
         self.fs = filestore.FileStore(self.defaults.fs_dir(None))
+        self.lineage = lineage.Lineage(self.es, self.fs,
+                                       self.defaults.docs_index(),
+                                       self.defaults.doc_type())
+        self.collector = collector.BlobCollector(
+            self.es, self.fs, self.defaults.docs_index(),
+            **self.defaults.gc({}))
+        # deferred conversions run in the background, see `_render_async`.
+        self.renderer = futures.ThreadPoolExecutor(
+            self.defaults.render_workers(), thread_name_prefix="render")
+        self.renders = {}
+        self.renders_lock = threading.Lock()
+
+        # a single lookup, unless the schema of the code is newer.
+        self.schema = schema.SchemaRegistry(self.es,
+                                            self.defaults.schema_index())
+        entry = self.schema.ensure(self.defaults.docs_index(),
+                                   self.SCHEMA_VERSION, self._migrate_schema)
+
+        partition = entry.get("partition")
+        if partition != self.defaults.partition():
+            if partition is None:
+                logger.warning("The docs index is not partitioned yet, call "
+                               "`migrate_to_partitions` to partition it.")
+            else:
+                logger.warning(f"The docs index is partitioned by "
+                               f"'{partition}', using it.")
+        self.defaults["partition"] = partition
+
+        if entry.get("mapping_version", 1) < self.DOC_MAPPING_VERSION:
+            logger.warning("The docs index uses an outdated mapping, call "
+                           "`reindex_documents` to update it.")
+
+    def _migrate_schema(self, entry):
+        """Puts all scripts, mappings and settings into the database.
+
+        Runs only when the registered schema version is older than
+        `SCHEMA_VERSION`, see `schema.SchemaRegistry.ensure`.
+
+        Args:
+            entry (dict): the current registry entry of the docs index.
 
+        Returns:
+            dict: the properties, that should be registered.
+        """
         for script_id, script_body in self.SCRIPTS.items():
             self.es.put_script(id=script_id, body=script_body)
 
-        # check whether the document index exists, if not create it.
-        self._create_index(self.defaults.docs_index(),
-                           self.defaults.doc_type(),
-                           self.DOC_MAPPING)
+        # the registered partitioning wins over the configured one.
+        if "partition" in entry:
+            self.defaults["partition"] = entry["partition"]
+        # new indices are created with the current mapping.
+        mapping_version = self.DOC_MAPPING_VERSION
+        if self.es.indices.exists(index=self.defaults.docs_index()):
+            mapping_version = entry.get("mapping_version", 1)
+
         self._create_index(self.defaults.seeds_index(),
                            self.defaults.seed_type(),
                            self.SEED_MAPPING)
         self._create_index(self.defaults.search_index(),
                            self.defaults.search_type(),
                            self.SEARCH_MAPPING)
-        self.es.indices.close(index=self.defaults.docs_index())
-        self.es.indices.put_settings(index=self.defaults.docs_index(),
-                                     body=self.SETTINGS)
-        self.es.indices.open(index=self.defaults.docs_index())
+        self._create_index(self.defaults.passages_index(),
+                           self.defaults.passage_type(),
+                           self.PASSAGE_MAPPING, update=True)
+
+        if self.defaults.partition() is not None:
+            if not self._is_legacy_index():
+                self._create_partition_template()
+                self._create_current_partition()
+                self._create_locations()
+                if self.es.indices.exists(index=self.defaults.docs_index()):
+                    self._put_new_fields(self.defaults.docs_index(),
+                                         self.defaults.doc_type(),
+                                         self.DOC_MAPPING)
+                    self._fill_doc_ids()
+                return {"partition": self.defaults.partition(),
+                        "mapping_version": mapping_version}
 
-    def _create_index(self, index, doc_type, mapping):
+        # check whether the document index exists, if not create it.
+        self._create_index(self.defaults.docs_index(),
+                           self.defaults.doc_type(),
+                           self.DOC_MAPPING, update=True)
+        self._put_static_settings(self.defaults.docs_index(), self.SETTINGS)
+        self._fill_doc_ids()
+        return {"partition": None, "mapping_version": mapping_version}
+
+    def _fill_doc_ids(self):
+        """Copies the `_id` into `doc_id` of documents, which lack it.
+
+        Cursors break ties by `doc_id`, see
+        `transforms.transform_cursor_sort`. Runs in the background.
+        """
+        self.es.update_by_query(
+            index=self.defaults.docs_index(),
+            doc_type=self.defaults.doc_type(),
+            body={
+                "query": {"bool": {
+                    "must_not": {"exists": {"field": "doc_id"}}
+                }},
+                "script": {"lang": "painless",
+                           "source": "ctx._source.doc_id = ctx._id"}
+            },
+            conflicts="proceed", wait_for_completion=False)
+
+    def _put_static_settings(self, index, settings):
+        """Puts static settings, closing the index only if they differ.
+
+        Args:
+            index (str): the index, whose settings should be changed.
+            settings (dict): the settings in the form `{"index": {...}}`.
+        """
+        current = self.es.indices.get_settings(index=index, flat_settings=True)
+        wanted = {f"index.{k}": v for k, v in settings["index"].items()}
+        # aliases return the settings of all their indices.
+        if all(sda(idx, ["settings", k]) == v
+               for idx in current.values() for k, v in wanted.items()):
+            return
+
+        self.es.indices.close(index=index)
+        try:
+            self.es.indices.put_settings(index=index, body=settings)
+        finally:
+            self.es.indices.open(index=index)
+
+    def _create_index(self, index, doc_type, mapping, update=False):
         """Checks whether an index is present, if not, creates it.
 
         Uses the mapping provided.
@@ -234,12 +478,376 @@ class Elastic():
             index (str): the index that should be used.
             doc_type (str): the doc_type for the mapping.
             mapping (dict): the elastic-mapping that should be used.
+            update (bool): whether the mapping of an existing index should
+                be updated (new fields only). Defaults to False.
         """
         if not self.es.indices.exists(index=index):
             self.es.indices.create(index=index)
             # put the mapping into the docs index
             self.es.indices.put_mapping(index=index, doc_type=doc_type,
                                         body=mapping)
+        elif update:
+            self._put_new_fields(index, doc_type, mapping)
+
+    def _put_new_fields(self, index, doc_type, mapping):
+        """Adds the fields of mapping, which an existing index is missing.
+
+        Changes to existing fields or the `_source` can't be applied to an
+        existing index, they need a reindex.
+
+        Args:
+            index (str): the index (or alias) that should be updated.
+            doc_type (str): the doc_type for the mapping.
+            mapping (dict): the elastic-mapping that should be used.
+        """
+        current = self.es.indices.get_mapping(index=index, doc_type=doc_type)
+        known = set()
+        for idx_mapping in current.values():
+            known.update(sda(idx_mapping, ["mappings", doc_type,
+                                           "properties"], {}).keys())
+
+        new_fields = {k: v for k, v in mapping["properties"].items()
+                      if k not in known}
+        if new_fields:
+            self.es.indices.put_mapping(index=index, doc_type=doc_type,
+                                        body={"properties": new_fields})
+
+    def _create_partition_template(self, alias=True):
+        """Puts the index template for the time partitions of the docs index.
+
+        New partitions are created on their first write, the template
+        provides the settings, mapping and the read alias (`docs_index`).
+
+        Args:
+            alias (bool): whether new partitions join the read alias.
+                Defaults to True.
+        """
+        index = self.defaults.docs_index()
+        template = {
+            "index_patterns": [f"{index}-*"],
+            "settings": self.SETTINGS,
+            "mappings": {self.defaults.doc_type(): self.DOC_MAPPING},
+        }
+        if alias:
+            template["aliases"] = {index: {}}
+        self.es.indices.put_template(name=index, body=template)
+
+    def _create_current_partition(self):
+        """Creates the partition of today, unless the read alias exists.
+
+        Otherwise no index would join the alias before the first write and
+        reads of a fresh installation would fail with `index_not_found`.
+        """
+        if self.es.indices.exists_alias(name=self.defaults.docs_index()):
+            return
+        # the template provides the mapping and the alias.
+        index = self._partition_index(utility.from_date())
+        # raced by another instance, if it exists already.
+        self.es.indices.create(index=index, ignore=400)
+
+    def _is_legacy_index(self):
+        """Returns whether the docs index is a concrete, unpartitioned index.
+
+        Returns:
+            bool: True if `docs_index` names an index instead of an alias.
+        """
+        index = self.defaults.docs_index()
+        return (self.es.indices.exists(index=index) and
+                not self.es.indices.exists_alias(name=index))
+
+    def _partition_index(self, date):
+        """Returns the index, a document with the given date belongs to.
+
+        Args:
+            date (datetime.datetime): the document's date.
+
+        Returns:
+            str: the name of the partition or `docs_index`, when the index
+                isn't partitioned.
+        """
+        index = self.defaults.docs_index()
+        partition = self.PARTITIONS.get(self.defaults.partition())
+        if partition is None:
+            return index
+        date = utility.date_from_string(date)
+        return f"{index}-{date.strftime(partition['format'])}"
+
+    def _date_indices(self, start, end):
+        """Returns the indices, which hold documents between start and end.
+
+        Args:
+            start (datetime.datetime): the start of the date range.
+            end (datetime.datetime): the end of the date range (included).
+
+        Returns:
+            str: a comma separated list of partitions or `docs_index`, when
+                the index isn't partitioned.
+        """
+        partition = self.PARTITIONS.get(self.defaults.partition())
+        if partition is None:
+            return self.defaults.docs_index()
+
+        end = utility.date_from_string(end)
+        cur_date = utility.date_from_string(start)
+        if self.defaults.partition() == "month":
+            cur_date = cur_date.replace(day=1)
+        else:
+            cur_date = cur_date.replace(month=1, day=1)
+
+        indices = []
+        while cur_date <= end:
+            indices.append(self._partition_index(cur_date))
+            cur_date = partition["next"](cur_date)
+        return ",".join(indices)
+
+    def _locate_documents(self, doc_ids, **kwargs):
+        """Returns the concrete indices holding the given documents.
+
+        Unpartitioned indices are resolved without a request, partitions by
+        a single realtime `mget` on the locations index, such that fresh
+        documents are found immediately.
+
+        Args:
+            doc_ids (list): a list of document ids.
+
+        Returns:
+            dict: a dict mapping the found ids to their index.
+        """
+        index = self.defaults.other(kwargs).docs_index()
+        if self.defaults.partition() is None:
+            return {doc_id: index for doc_id in doc_ids}
+        if not doc_ids:
+            return {}
+
+        results = self.es.mget(index=self.defaults.locations_index(),
+                               doc_type=self.defaults.location_type(),
+                               body={"ids": list(doc_ids)})
+        return {doc["_id"]: sda(doc, ["_source", "index"])
+                for doc in results.get("docs", []) if doc.get("found")}
+
+    def _create_locations(self):
+        """Creates the locations index and fills it, if it doesn't exist."""
+        index = self.defaults.locations_index()
+        if self.es.indices.exists(index=index):
+            return
+        self._create_index(index, self.defaults.location_type(),
+                           self.LOCATION_MAPPING)
+        if self.es.indices.exists(index=self.defaults.docs_index()):
+            self.rebuild_locations()
+
+    def rebuild_locations(self):
+        """Records the partition of every document in the locations index.
+
+        Repairs the locations after documents were moved by hand or an
+        insert died between claiming its id and creating the document.
+
+        Returns:
+            int: the number of recorded locations.
+        """
+        actions = ({
+            "_index": self.defaults.locations_index(),
+            "_type": self.defaults.location_type(),
+            "_id": hit["_id"],
+            "_source": {"index": hit["_index"]}
+        } for hit in es_helpers.scan(self.es,
+                                     index=self.defaults.docs_index(),
+                                     _source=False,
+                                     query={"query": {"match_all": {}}}))
+        success, _ = es_helpers.bulk(self.es, actions)
+        return success
+
+    def _claim_location(self, doc_id, index):
+        """Records the partition of a new document, unless the id is taken.
+
+        Ids are only unique within a single partition, the locations index
+        makes them unique across all partitions.
+
+        Args:
+            doc_id (str): the id of the new document.
+            index (str): the partition of the new document.
+
+        Returns:
+            bool: False, if the id already belongs to a document.
+        """
+        if self.defaults.partition() is None:
+            return True
+        try:
+            self.es.create(index=self.defaults.locations_index(),
+                           doc_type=self.defaults.location_type(),
+                           id=doc_id, body={"index": index})
+        except es.ConflictError:
+            return False
+        return True
+
+    def _release_location(self, doc_id):
+        """Removes the recorded partition of a document."""
+        if self.defaults.partition() is None:
+            return
+        self.es.delete(index=self.defaults.locations_index(),
+                       doc_type=self.defaults.location_type(),
+                       id=doc_id, ignore=404)
+
+    def _move_document(self, doc_id, index, new_index, **kwargs):
+        """Moves a document to another partition, e.g. after its date changed.
+
+        Args:
+            doc_id (str): the id of the document.
+            index (str): the partition holding the document.
+            new_index (str): the partition the document belongs to.
+        """
+        doc_type = self.defaults.other(kwargs).doc_type()
+        result = self.es.get(index=index, doc_type=doc_type, id=doc_id)
+        self.es.index(index=new_index, doc_type=doc_type, id=doc_id,
+                      body=result["_source"])
+        self.es.index(index=self.defaults.locations_index(),
+                      doc_type=self.defaults.location_type(), id=doc_id,
+                      body={"index": new_index})
+        self.es.delete(index=index, doc_type=doc_type, id=doc_id)
+
+    def migrate_to_partitions(self, partition="month"):
+        """Moves the documents of an unpartitioned docs index to partitions.
+
+        Reindexes all documents into the partitions matching their `date`,
+        deletes the old index and puts the read alias in its place.
+        The index is unavailable in between, hence run it during downtime.
+
+        Args:
+            partition (str): "month" or "year". Defaults to "month".
+
+        Returns:
+            dict: the response of the reindex operation.
+        """
+        index = self.defaults.docs_index()
+        if partition not in self.PARTITIONS:
+            raise ValueError(f"Unknown partition '{partition}'.")
+
+        self.defaults["partition"] = partition
+        if not self._is_legacy_index():
+            self._create_partition_template()
+            self._create_current_partition()
+            self._create_locations()
+            self.schema.update(index, partition=partition)
+            return {"result": "noop"}
+
+        # the alias can't be created while the old index has its name.
+        self._create_partition_template(alias=False)
+
+        fallback = self._partition_index(utility.from_date())
+        body = {
+            "source": {"index": index},
+            "dest": {"index": fallback},
+            "script": {
+                "id": "partition_index",
+                "params": {
+                    "prefix": f"{index}-",
+                    "length": self.PARTITIONS[partition]["length"],
+                    "fallback": fallback
+                }
+            }
+        }
+        result = self.es.reindex(body=body, wait_for_completion=True,
+                                 request_timeout=3600)
+        if result.get("failures"):
+            logger.error(f"Reindexing failed, keeping '{index}'.")
+            return result
+
+        self.es.indices.delete(index=index)
+        self.es.indices.put_alias(index=f"{index}-*", name=index)
+        self._create_partition_template()
+        self._create_locations()
+        self.schema.update(index, partition=partition)
+        return result
+
+    def reindex_documents(self):
+        """Rebuilds all docs indices with the current `DOC_MAPPING`.
+
+        Each index is copied to a temporary index, recreated with the
+        current mapping and filled again. The texts, which older mappings
+        kept out of the `_source`, are restored from the filestore on the
+        way. The documents are unavailable in between, run it during
+        downtime.
+
+        Returns:
+            list: the names of the rebuilt indices.
+        """
+        index = self.defaults.docs_index()
+        doc_type = self.defaults.doc_type()
+        body = {
+            "settings": self.SETTINGS,
+            "mappings": {doc_type: self.DOC_MAPPING}
+        }
+
+        concrete = sorted(self.es.indices.get(index=index))
+        for cur_index in concrete:
+            tmp_index = f"reindex_{cur_index}"
+            logger.info(f"Reindexing '{cur_index}' via '{tmp_index}'.")
+            self.es.indices.create(index=tmp_index, body=body)
+            es_helpers.bulk(self.es, self._restore_texts(cur_index,
+                                                         tmp_index))
+            self.es.indices.refresh(index=tmp_index)
+
+            self.es.indices.delete(index=cur_index)
+            self.es.indices.create(index=cur_index, body=body)
+            self.es.reindex(body={"source": {"index": tmp_index},
+                                  "dest": {"index": cur_index}},
+                            wait_for_completion=True, request_timeout=3600)
+            self.es.indices.delete(index=tmp_index)
+
+        self.schema.update(index, mapping_version=self.DOC_MAPPING_VERSION)
+        return concrete
+
+    def _restore_texts(self, source, dest):
+        """Yields bulk actions copying `source` to `dest` including texts.
+
+        Args:
+            source (str): the index to read from.
+            dest (str): the index to write to.
+
+        Yields:
+            dict: a bulk index action.
+        """
+        for hit in es_helpers.scan(self.es, index=source,
+                                   query={"query": {"match_all": {}}}):
+            doc = hit["_source"]
+            if "text" not in doc:
+                doc["text"] = self.fs.get_text(doc.get("text_hash")) or ""
+            yield {
+                "_index": dest,
+                "_type": hit["_type"],
+                "_id": hit["_id"],
+                "_source": doc
+            }
+
+    def optimize_partitions(self, before, read_only=False):
+        """Force-merges all partitions that end before the given date.
+
+        Old partitions don't change anymore, a single segment makes them
+        cheaper to search and to keep.
+
+        Args:
+            before (datetime.datetime): partitions containing this date or
+                later are not touched.
+            read_only (bool): whether the partitions should additionally be
+                write-blocked. Careful, this also blocks status or tag
+                changes. Defaults to False.
+
+        Returns:
+            list: the names of the optimized partitions.
+        """
+        index = self.defaults.docs_index()
+        if self.defaults.partition() is None:
+            return []
+
+        current = self._partition_index(before)
+        partitions = sorted(p for p in self.es.indices.get_alias(name=index)
+                            if p < current)
+        for partition in partitions:
+            if read_only:
+                self.es.indices.put_settings(
+                    index=partition, body={"index.blocks.write": True})
+            self.es.indices.forcemerge(index=partition, max_num_segments=1,
+                                       request_timeout=3600)
+        return partitions
 
     def _prepare_document(self, doc):
         """Prepares a document for insertion by constructing features.
@@ -264,22 +872,119 @@ class Elastic():
         for step in pipeline:
             new_doc = step(new_doc)
 
-        doc_hash = self.fs.set(doc.get("raw_content", None))
-
-        doc_timestamp = time.time()
-        doc_id = f"{doc_hash}_{doc_timestamp}"
+        doc_hash = self.fs.set(doc.get("raw_content", None),
+                               content_type=new_doc.get("content_type"))
+        # the same content always yields the same id.
+        doc_id = doc_hash
 
         new_doc["hash"] = doc_hash
         new_doc["raw_content"] = doc_hash
-        new_doc["version"] = doc_timestamp
-        new_doc["version_key"] = doc_id
+        # the text is only indexed, the filestore keeps the original.
+        new_doc["text_hash"] = self.fs.set_text(new_doc.get("text"))
+        new_doc["version"] = time.time()
+        new_doc["lineage"] = sda(new_doc, ["source", "url"]) or doc_hash
 
         if new_doc["content"]:
-            content_hash = self.fs.set(new_doc.get("content", None))
+            content_hash = self.fs.set(new_doc.get("content", None),
+                                       content_type="application/pdf")
             new_doc["content"] = content_hash
 
         return new_doc, doc_id
 
+    def _prepare_passages(self, doc, doc_id):
+        """Yields bulk actions for the passages of a prepared document.
+
+        Args:
+            doc (dict): the prepared document, see `_prepare_document`.
+            doc_id (str): the id of the document.
+
+        Yields:
+            dict: a bulk index action for each passage.
+        """
+        parent = {k: doc[k] for k in self.PASSAGE_FIELDS if k in doc}
+        if "source" in parent:
+            parent["source"] = {"name": sda(parent, ["source", "name"])}
+
+        passages = utility.split_passages(doc.get("text"),
+                                          self.defaults.passage_size())
+        for page, text in passages:
+            yield {
+                "_index": self.defaults.passages_index(),
+                "_type": self.defaults.passage_type(),
+                "_id": f"{doc_id}_{page}",
+                "_source": dict(parent, parent=doc_id, page=page, text=text)
+            }
+
+    def _insert_passages(self, doc, doc_id):
+        """Indexes the passages of a prepared document.
+
+        Args:
+            doc (dict): the prepared document, see `_prepare_document`.
+            doc_id (str): the id of the document.
+
+        Returns:
+            int: the number of indexed passages.
+        """
+        success, errors = es_helpers.bulk(
+            self.es, self._prepare_passages(doc, doc_id), raise_on_error=False)
+        if errors:
+            logger.warning(f"Couldn't index {len(errors)} passages of "
+                           f"'{doc_id}'.")
+        return success
+
+    def rebuild_passages(self, **kwargs):
+        """Splits all existing documents into passages again.
+
+        Used to fill the passages index for documents, that were inserted
+        before it existed. The texts are loaded from the filestore.
+
+        Returns:
+            int: the number of indexed passages.
+        """
+        index = self.defaults.other(kwargs).docs_index()
+        fields = ["text_hash"] + self.PASSAGE_FIELDS
+        count = 0
+        for hit in es_helpers.scan(self.es, index=index, _source=fields,
+                                   query={"query": {"match_all": {}}}):
+            doc = hit["_source"]
+            doc["text"] = self.fs.get_text(doc.get("text_hash"))
+            self._remove_passages(hit["_id"])
+            count += self._insert_passages(doc, hit["_id"])
+        return count
+
+    def _update_passages(self, doc_ids, body):
+        """Applies property changes of the given documents to their passages.
+
+        Args:
+            doc_ids (list): the ids of the changed documents.
+            body (dict): the checked property changes, see
+                `transforms.transform_mutation`, only `PASSAGE_FIELDS` are
+                applied.
+        """
+        parent = {k: body[k] for k in self.PASSAGE_FIELDS if k in body}
+        if not parent or not doc_ids:
+            return
+        if "source" in parent:
+            parent["source"] = {"name": sda(parent, ["source", "name"])}
+
+        params = {"add_tags": [], "remove_tags": [], "body": parent,
+                  "map_keys": {}}
+        self.es.update_by_query(index=self.defaults.passages_index(),
+                                doc_type=self.defaults.passage_type(),
+                                body={
+                                    "query": {"terms": {"parent": doc_ids}},
+                                    "script": {"id": "mutate_document",
+                                               "params": params}
+                                },
+                                conflicts="proceed")
+
+    def _remove_passages(self, doc_id):
+        """Removes all passages of the given document."""
+        self.es.delete_by_query(index=self.defaults.passages_index(),
+                                doc_type=self.defaults.passage_type(),
+                                body={"query": {"term": {"parent": doc_id}}},
+                                conflicts="proceed")
+
     def insert_document(self, doc, doc_id=None):
         """Inserts a document into the index `index` under `doc_id`
 
@@ -287,46 +992,71 @@ class Elastic():
             doc (dict): the document to insert.
             doc_id (str): the document id, defaults to None.
 
+        Existing documents are detected atomically by their content derived
+        id, then `{"result": "existing", "_id": ...}` is returned.
+
         Returns:
             es.Response: the response object of elastic search
         """
         new_doc, new_doc_id = self._prepare_document(doc)
-        # check whether a document with this hash already exists in the db.
-        ex_id = self.exist_document(doc_hash=new_doc["hash"])
-        if ex_id is not None:
-            return {"result": "existing", "_id": ex_id}
-
         if doc_id is None:
             doc_id = new_doc_id
-        res = self.es.index(index=self.defaults.docs_index(),
-                            doc_type=self.defaults.doc_type(),
-                            id=doc_id, body=new_doc)
+        new_doc["doc_id"] = doc_id
+
+        index = self._partition_index(new_doc["date"])
+        # ids are only unique within a partition, the date might differ.
+        if not self._claim_location(doc_id, index):
+            return {"result": "existing", "_id": doc_id}
+
+        try:
+            res = self.es.create(index=index,
+                                 doc_type=self.defaults.doc_type(),
+                                 id=doc_id, body=new_doc)
+        except es.ConflictError:
+            return {"result": "existing", "_id": doc_id}
+        except es.ElasticsearchException:
+            self._release_location(doc_id)
+            raise
+
+        # link new versions to their predecessor, this also diffs them.
+        links = self.lineage.link(new_doc, doc_id)
+        if links:
+            self.es.update(index=index, doc_type=self.defaults.doc_type(),
+                           id=doc_id, body={"doc": links})
+        self._insert_passages(new_doc, doc_id)
         return res
 
     def remove_document(self, doc_id, **kwargs):
         """Removes the document with the given id.
 
+        Its blobs might be shared with other documents, hence they are left
+        to the garbage collection, see `collect_garbage`.
+
         Args:
             doc_id (str): the document's id, that will be removed.
 
         Returns:
             es.Response: the response object of elastic search
         """
-        index = self.defaults.other(kwargs).docs_index()
         doc_type = self.defaults.other(kwargs).doc_type()
+        index = self._locate_documents([doc_id], **kwargs).get(doc_id)
+        if index is None:
+            return {"found": False, "_id": doc_id}
 
-        result = self.es.get(index=index, doc_type=doc_type, id=doc_id,
-                             _source=["content"])
+        res = self.es.delete(index=index, doc_type=doc_type, id=doc_id)
+        self._release_location(doc_id)
+        self._remove_passages(doc_id)
+        return res
 
-        if result["found"] is False:
-            return result
+    def collect_garbage(self):
+        """Removes unreferenced blobs of the next few filestore shards.
 
-        self.fs.remove(sda(result, ["_source", "content"]))
+        Meant to be run periodically, see `collector.BlobCollector`.
 
-        res = self.es.delete(index=self.defaults.docs_index(),
-                             doc_type=self.defaults.doc_type(),
-                             id=doc_id)
-        return res
+        Returns:
+            int: the number of removed blobs.
+        """
+        return self.collector.run()
 
     def exist_document(self, doc_id=None, doc_hash=None, source_url=None,
                        **kwargs):
@@ -344,6 +1074,16 @@ class Elastic():
             str: the id of the existing document or None.
         """
         index = self.defaults.other(kwargs).docs_index()
+        # a realtime check, if only the id is given.
+        if doc_id and not (doc_hash or source_url):
+            doc_type = self.defaults.other(kwargs).doc_type()
+            index = self._locate_documents([doc_id], **kwargs).get(doc_id)
+            if index is not None and self.es.exists(index=index,
+                                                    doc_type=doc_type,
+                                                    id=doc_id):
+                return doc_id
+            return None
+
         criteria = [("_id", doc_id), ("hash", doc_hash),
                     ("source.url", source_url)]
         criteria = [{"term": {c[0]: c[1]}} for c in criteria if c[1]]
@@ -368,27 +1108,83 @@ class Elastic():
             update (dict): a dict of properties that should be updated.
 
         Returns:
-            dict: an elastic result dict.
+            dict: the result of `mutate_documents`.
+        """
+        return self.mutate_documents([doc_id], properties=update, **kwargs)
+
+    def mutate_documents(self, doc_ids, add_tags=None, remove_tags=None,
+                         properties=None, **kwargs):
+        """Applies tag and property changes to one or many documents at once.
+
+        All documents are changed by a single scripted `_bulk` update,
+        the index is not refreshed, hence the changes become visible for
+        searches with the next regular refresh. The passages of the changed
+        documents get the new `PASSAGE_FIELDS`. Documents, whose new `date`
+        belongs to another partition, are moved there afterwards.
+
+        Args:
+            doc_ids (list): the ids of the documents that should be changed.
+            add_tags (list): tags that should be added. Defaults to None.
+            remove_tags (list): tags that should be removed. Defaults to None.
+            properties (dict): properties that should be set, only properties
+                which already exist on a document are changed. Lists given
+                for map-properties (`keywords`, `entities`) set the keys of
+                the map and keep the existing weights. Defaults to None.
+            **kwargs (dict): keyword arguments to override the defaults.
+
+        Returns:
+            dict: a dict holding the keys `result` ("updated" or "failed"),
+                `updated` and `failed`, which list the respective ids.
         """
-        index = self.defaults.other(kwargs).docs_index()
         doc_type = self.defaults.other(kwargs).doc_type()
 
-        if self.exist_document(doc_id=doc_id) is None:
-            return {"result": "failed"}
+        body, map_keys = etrans.transform_mutation(properties or {})
+        params = {
+            "add_tags": list(add_tags or []),
+            "remove_tags": list(remove_tags or []),
+            "body": body,
+            "map_keys": map_keys
+        }
 
-        body = etrans.transform_input(update)
+        located = self._locate_documents(doc_ids, **kwargs)
+        missing = [doc_id for doc_id in doc_ids if doc_id not in located]
+
+        actions = []
+        for doc_id, index in located.items():
+            actions.append({"update": {"_index": index, "_type": doc_type,
+                                       "_id": doc_id}})
+            actions.append({"script": {"id": "mutate_document",
+                                       "params": params}})
+        if not actions:
+            return {"result": "failed", "updated": [], "failed": missing}
+
+        res = self.es.bulk(body=actions)
+
+        updated, failed = [], missing
+        for item in res.get("items", []):
+            item = item.get("update", {})
+            if item.get("error") is None:
+                updated.append(item.get("_id"))
+            else:
+                logger.warning(f"Couldn't mutate document {item.get('_id')}"
+                               f": {item.get('error')}")
+                failed.append(item.get("_id"))
 
-        u_body = {
-            "script": {
-                "id": "update_body",
-                "params": {
-                    "body": body
-                }
-            }
+        # passages carry copies of some properties, they aren't partitioned.
+        self._update_passages(updated, body)
+
+        if self.defaults.partition() is not None and "date" in body:
+            new_index = self._partition_index(body["date"])
+            for doc_id in updated:
+                if located[doc_id] != new_index:
+                    self._move_document(doc_id, located[doc_id], new_index,
+                                        **kwargs)
+
+        return {
+            "result": "updated" if updated else "failed",
+            "updated": updated,
+            "failed": failed
         }
-        res = self.es.update(index=index, doc_type=doc_type,
-                             id=doc_id, body=u_body)
-        return res
 
     def remove_tag(self, tag, doc_id):
         """Removes tag `tag` from document `doc_id`.
@@ -397,26 +1193,7 @@ class Elastic():
             tag (str): the tag to remove.
             doc_id (str): the document id.
         """
-        index = self.defaults.docs_index()
-        doc_type = self.defaults.doc_type()
-
-        document = self.es.get(index=index, doc_type=doc_type, id=doc_id)
-
-        tags_list = document['_source']['tags']
-        tags_list.remove(tag)
-
-        doc = {
-            "script": "ctx._source.remove('tags')"
-        }
-        self.es.update(index=index, doc_type=doc_type, id=doc_id, body=doc)
-
-        doc = {
-            "script": "ctx._source.tags = []"
-        }
-        self.es.update(index=index, doc_type=doc_type, id=doc_id, body=doc)
-
-        for tag in tags_list:
-            self.update_tag(tag, doc_id)
+        return self.mutate_documents([doc_id], remove_tags=[tag])
 
     def update_tag(self, tag, doc_id):
         """Adds tag `tag` to document `doc_id`.
@@ -425,20 +1202,7 @@ class Elastic():
             tag (str): the tag to remove.
             doc_id (str): the document id.
         """
-        index = self.defaults.docs_index()
-        doc_type = self.defaults.doc_type()
-
-        doc = {
-            "script": {
-                "inline": "ctx._source.tags.add(params.tag)",
-                "params": {
-                    "tag": tag
-                }
-            }
-        }
-
-        self.es.update(index=index, doc_type=doc_type, id=doc_id, body=doc)
-        self.es.indices.refresh(index=index)
+        return self.mutate_documents([doc_id], add_tags=[tag])
 
     def get_seeds(self):
         """Returns the seeds.
@@ -630,41 +1394,42 @@ class Elastic():
 
         return etrans.transform_agg_filters(results["aggregations"], active)
 
-    def get_document(self, doc_id, fields=None):
+    def get_document(self, doc_id, fields=None, **kwargs):
         """Returns the document with the given id, displaying only `fields`.
 
+        Uses a realtime get, see `get_documents_by_ids`.
+
         Args:
             doc_id (str): the `_id` of the given document.
             fields (list): a list of fields that should be returned.
                 Defaults to None, which means all fields.
 
         Returns:
-            dict: the document.
+            dict: the document or None, if it doesn't exist.
         """
-        index = self.defaults.docs_index()
-        s_body = {
-            "size": 1,
-            "query": {
-                "match": {
-                    "_id": doc_id,
-                }
-            },
-            "_source": True
-        }
+        return self.get_documents_by_ids([doc_id], fields, **kwargs)[0]
 
-        source, scripted = etrans.transform_fields(fields)
-        if source is not None:
-            s_body["_source"] = source
-        if scripted is not None:
-            s_body["script_fields"] = scripted
+    def get_text(self, doc_id):
+        """Returns the full text of the given document.
 
-        results = self.es.search(index=index, body=s_body)
-        # construct the document
-        docs = etrans.transform_output(results)
+        The text isn't returned with the documents, it's loaded from the
+        filestore instead. Documents without a saved text fall back to their
+        `_source`.
 
-        if len(docs) == 0:
+        Args:
+            doc_id (str): the `_id` of the given document.
+
+        Returns:
+            str: the document's text or None, if the document doesn't exist.
+        """
+        doc = self.get_document(doc_id, fields=["text_hash", "text"])
+        if doc is None:
             return None
-        return docs[0]
+
+        text = self.fs.get_text(doc.get("text_hash"))
+        if text is None:
+            text = doc.get("text", "")
+        return text
 
     def get_calendar(self, cur_date):
         """Returns the calendar for the given date in a efficient way.
@@ -676,8 +1441,8 @@ class Elastic():
         Returns:
             list: a list of date-dicts.
         """
-        index = self.defaults.docs_index()
         start, end = utility.get_year_range(cur_date)
+        index = self._date_indices(start, end)
         s_body = {
             # doesn't need results, just aggregations
             "_source": False,
@@ -713,8 +1478,9 @@ class Elastic():
                 }
             }
         }
-        results = self.es.search(index=index, body=s_body)
-        return etrans.transform_calendar_aggs(results["aggregations"])
+        results = self.es.search(index=index, body=s_body,
+                                 ignore_unavailable=True)
+        return etrans.transform_calendar_aggs(results.get("aggregations"))
 
     def get_date(self, cur_date):
         """Returns the date aggregation for the given date in a efficient way.
@@ -727,7 +1493,7 @@ class Elastic():
             dict: a calendar date, containing the number of open, waiting and
                 assigned documents.
         """
-        index = self.defaults.docs_index()
+        index = self._date_indices(cur_date - dt.timedelta(days=1), cur_date)
         s_body = {
             "_source": False,
             "size": 0,
@@ -762,7 +1528,8 @@ class Elastic():
                 }
             }
         }
-        results = self.es.search(index=index, body=s_body)
+        results = self.es.search(index=index, body=s_body,
+                                 ignore_unavailable=True)
 
         date_dict = {
             "date": cur_date,
@@ -771,7 +1538,7 @@ class Elastic():
             "n_finished": 0
         }
 
-        res_aggs = etrans.transform_calendar_aggs(results["aggregations"])
+        res_aggs = etrans.transform_calendar_aggs(results.get("aggregations"))
         if len(res_aggs) > 0:
             return res_aggs[0]
         # if no result was found...
@@ -886,7 +1653,7 @@ class Elastic():
         Returns:
             list: a list of documents in an easy processable format.
         """
-        index = self.defaults.other(kwargs).docs_index()
+        index = self._date_indices(cur_date - dt.timedelta(days=1), cur_date)
         doc_type = self.defaults.other(kwargs).doc_type()
         size = self.defaults.other(kwargs).size()
 
@@ -919,7 +1686,8 @@ class Elastic():
         if scripted is not None:
             s_body["script_fields"] = scripted
 
-        results = self.es.search(index=index, doc_type=doc_type, body=s_body)
+        results = self.es.search(index=index, doc_type=doc_type, body=s_body,
+                                 ignore_unavailable=True)
         docs = etrans.transform_output(results)
         return docs
 
@@ -977,26 +1745,34 @@ class Elastic():
     def get_versions(self, doc_id, fields=None, **kwargs):
         """Returns all documents, that are a version of the given doc_id.
 
+        Versions share the `lineage` of the document, newest first.
+
         Args:
             doc_id (str): the document, whose versions should be retrieved.
             fields (list): a list of fields that should be queried.
-                Defaults to `["date", "impact", "type", "category", "document",
-                "reading_time", "status", "fingerprint", "connections"]`
+                Defaults to `["date", "fingerprint", "document"]`
 
         Returns:
             list: a list of documents, which are versions of each other.
         """
         index = self.defaults.other(kwargs).docs_index()
+        size = self.defaults.other(kwargs).version_size(100)
 
         if fields is None:
             fields = ["date", "fingerprint", "document"]
 
+        doc = self.get_document(doc_id, fields=["lineage"], **kwargs)
+        lineage = (doc or {}).get("lineage")
+        if lineage is None:
+            return []
+
         s_body = {
+            "size": size,
             "query": {
                 "bool": {
-                    "must": {
+                    "filter": {
                         "term": {
-                            "version_key": doc_id
+                            "lineage": lineage
                         }
                     },
                     # exclude self
@@ -1006,7 +1782,8 @@ class Elastic():
                         }
                     }
                 }
-            }
+            },
+            "sort": [{"version": {"order": "desc"}}]
         }
         # append additional fields
         source, scripted = etrans.transform_fields(fields)
@@ -1019,6 +1796,145 @@ class Elastic():
         docs = etrans.transform_output(results)
         return docs
 
+    def get_diff(self, doc_id, other_id=None):
+        """Returns the diff between a document and another version.
+
+        The diff to the predecessor is read from the filestore, others are
+        computed from the texts.
+
+        Args:
+            doc_id (str): the `_id` of the current document.
+            other_id (str): the `_id` of the former document.
+                Defaults to None, which means the predecessor.
+
+        Returns:
+            tuple: the diff blocks (list or generator) and changes (dict) as
+                returned by `diff.get_unified_diff` or None, if there is
+                nothing to compare to.
+        """
+        doc = self.get_document(doc_id, fields=["predecessor", "diff"])
+        if doc is None:
+            return None
+        if other_id is None:
+            other_id = doc.get("predecessor")
+        if other_id is None:
+            return None
+
+        cached = self.lineage.get_diff(doc, other_id)
+        if cached is not None:
+            return cached
+        # the blocks are built while rendering.
+        return diff.get_unified_diff({"text": self.get_text(doc_id) or ""},
+                                     {"text": self.get_text(other_id) or ""},
+                                     lazy=True)
+
+    def _render_content(self, index, doc_id, doc, **kwargs):
+        """Converts the raw content of a document, whose conversion was
+        deferred (see `DeferredConverter`), and saves it.
+
+        Runs in the background, see `_render_async`.
+
+        Args:
+            index (str): the index of the document.
+            doc_id (str): the id of the document.
+            doc (dict): the document, holding `content_type`, `raw_content`
+                and `source`.
+
+        Returns:
+            str: the filename (hash) of the content or None.
+        """
+        converter = CONVERTERS.get(doc.get("content_type"))
+        if converter is None or not converter.deferred:
+            return None
+        raw_content = self.fs.get(doc.get("raw_content"))
+        if raw_content is None:
+            return None
+
+        content = converter(raw_content, base_url=sda(doc, ["source", "url"]))
+        if content is None:
+            return None
+        content_hash = self.fs.set(content, content_type="application/pdf")
+        # cache the content for the next request.
+        doc_type = self.defaults.other(kwargs).doc_type()
+        self.es.update(index=index, doc_type=doc_type, id=doc_id,
+                       body={"doc": {"content": content_hash}})
+        return content_hash
+
+    def _render_async(self, index, doc_id, doc, **kwargs):
+        """Renders the content of a document in the background.
+
+        Concurrent requests for the same document share a single render.
+
+        Args:
+            index (str): the index of the document.
+            doc_id (str): the id of the document.
+            doc (dict): the document, see `_render_content`.
+
+        Returns:
+            concurrent.futures.Future: the pending filename of the content.
+        """
+        with self.renders_lock:
+            future = self.renders.get(doc_id)
+            if future is not None:
+                return future
+            future = self.renderer.submit(self._render_content, index,
+                                          doc_id, doc, **kwargs)
+            self.renders[doc_id] = future
+
+        def done(finished):
+            # a later render of the same document might be stored already.
+            with self.renders_lock:
+                if self.renders.get(doc_id) is finished:
+                    del self.renders[doc_id]
+
+        # might run right away, hence outside of the lock.
+        future.add_done_callback(done)
+        return future
+
+    def is_rendering(self, doc_id):
+        """Returns whether the content of the document is being rendered.
+
+        Args:
+            doc_id (str): the id of the document.
+
+        Returns:
+            bool: True, while a deferred conversion is running.
+        """
+        return doc_id in self.renders
+
+    def _get_content_hash(self, doc_id, **kwargs):
+        """Returns the filename (hash) of the given document's content.
+
+        Starts the conversion first, if it was deferred, but waits for it at
+        most `render_wait` seconds, see `is_rendering`.
+        """
+        doc_type = self.defaults.other(kwargs).doc_type()
+        index = self._locate_documents([doc_id], **kwargs).get(doc_id)
+        if index is None:
+            return None
+
+        result = self.es.get(index=index, doc_type=doc_type, id=doc_id,
+                             _source=["content", "content_type", "raw_content",
+                                      "source.url"])
+
+        if result["found"] is False:
+            return None
+
+        content_hash = sda(result, ["_source", "content"])
+        if content_hash is None:
+            future = self._render_async(index, doc_id, result["_source"],
+                                        **kwargs)
+            try:
+                content_hash = future.result(
+                    self.defaults.other(kwargs).render_wait())
+            except futures.TimeoutError:
+                return None
+            except Exception:
+                logger.exception(f"Couldn't render the content of "
+                                 f"'{doc_id}'.")
+                return None
+        return content_hash
+
     def get_content(self, doc_id, **kwargs):
         """Returns the content of the given document.
 
@@ -1028,24 +1944,76 @@ class Elastic():
         Returns:
             bytes: content of the saved file.
         """
-        index = self.defaults.other(kwargs).docs_index()
-        doc_type = self.defaults.other(kwargs).doc_type()
+        return self.fs.get(self._get_content_hash(doc_id, **kwargs))
 
-        result = self.es.get(index=index, doc_type=doc_type, id=doc_id,
-                             _source=["content"])
+    def open_content(self, doc_id, **kwargs):
+        """Opens the given document's content for streaming.
 
-        if result["found"] is False:
+        Allows serving the content without loading it into memory.
+
+        Args:
+            doc_id (str): the document, whose content should be retrieved.
+
+        Returns:
+            dict: the `source` (a path or a decompressing file object, see
+                `FileStore.open`), the decoded `size`, the `hash` and the
+                `modified` date of the saved file or None, if there is none.
+        """
+        content_hash = self._get_content_hash(doc_id, **kwargs)
+        opened = self.fs.open(content_hash)
+        if opened is None:
             return None
+        source, size = opened
+        modified = dt.datetime.utcfromtimestamp(
+            os.path.getmtime(self.fs.path(content_hash)))
+        return {
+            "source": source,
+            "size": size,
+            "hash": content_hash,
+            "modified": modified
+        }
 
-        return self.fs.get(sda(result, ["_source", "content"]))
+    def _search_query(self, search_text, filters={}):
+        """Returns the query context for a full text search with filters.
+
+        Args:
+            search_text (str): the text to search for, matches all documents
+                when empty or None.
+            filters (dict): the filters for fields of the documents.
+
+        Returns:
+            dict: an elasticsearch query context.
+        """
+        search = {
+            "simple_query_string": {
+                "query": search_text,
+                "default_operator": "and"
+            }
+        }
+        # if search_text is empty or None
+        if not search_text:
+            search = {"match_all": {}}
+
+        return {
+            "bool": {
+                "must": search,
+                "filter": etrans.transform_filters(filters)
+            }
+        }
 
     def search_documents(self, search_text, page=1, fields=None, filters={},
-                         sort_by=None, highlight=True):
+                         sort_by=None, highlight=True, cursor=None,
+                         track_total_hits=None, passages=False):
         """Returns all documents, that contain the `search_text`.
 
         The results can be filtered by the filters defined in the `filters`
         dict. It assumes an OR connection for multiple values.
 
+        Paging happens either by `page` (`from`/`size`, which gets slower
+        for deep pages and is bound by `index.max_result_window`) or by an
+        opaque `cursor`, as returned in a previous result, which uses
+        `search_after` and takes precedence over `page`.
+
         Args:
             search_text (str): the text to search for.
             page (int): the page of the results that should be shown.
@@ -1056,60 +2024,259 @@ class Elastic():
                 `args`.
             highlight (boolean): Whether text highlights for the query should
                 be done.
+            cursor (str): a cursor pointing behind the last hit of the
+                previous page. Defaults to None.
+            track_total_hits (bool): whether the hits should be counted
+                exactly, `False` skips counting. Defaults to the
+                `track_total_hits` default or `True`.
+            passages (bool): whether the passages should be searched instead
+                of the whole texts, see `search_passages`. Defaults to False.
 
         Returns:
             dict: a dictionary containing the following keys:
-                `num_results`, `total_pages` and `results`.
+                `num_results`, `total_relation`, `total_pages`, `results`,
+                `aggs` and `cursor` (for the next page, None on the last).
         """
+        if passages and search_text:
+            if set(filters) <= etrans.PASSAGE_FILTERS:
+                return self.search_passages(search_text, page, fields,
+                                            filters, highlight)
+            logger.debug("Filters not available on passages, searching the "
+                         "documents instead.")
+
         index = self.defaults.docs_index()
+        size = self.defaults.size()
+        if track_total_hits is None:
+            track_total_hits = self.defaults.track_total_hits(True)
         logger.debug(f"Searching for {search_text} on '{index}'")
 
-        start = (page - 1) * self.defaults.size()
-        search = {
-            "simple_query_string": {
-                "query": search_text,
-                "default_operator": "and"
-            }
-        }
-        # if search_text is empty or None
-        if not search_text:
-            search = {"match_all": {}}
-
         highlighter = {}
         if highlight:
-            highlighter = {"fields": {"*": {"pre_tags": ["<b>"],
-                                            "post_tags": ["</b>"]}}}
+            highlighter = etrans.transform_highlight(
+                self.defaults.highlight_fields())
 
         s_body = {
-            "from": start,
-            "size": self.defaults.size(),
-            "query": {
-                "bool": {
-                    "must": search,
-                    "filter": etrans.transform_filters(filters)
-                }
-            },
-            "sort": etrans.transform_sortby(sort_by),
+            "size": size,
+            "query": self._search_query(search_text, filters),
+            # sort with a tiebreaker, such that every hit yields a cursor.
+            "sort": etrans.transform_cursor_sort(
+                etrans.transform_sortby(sort_by)),
             "highlight": highlighter,
             "aggs": etrans.transform_aggs(fields),
+            "track_total_hits": track_total_hits,
         }
+        search_after = etrans.decode_cursor(cursor)
+        if search_after is not None:
+            s_body["search_after"] = search_after
+        else:
+            s_body["from"] = (page - 1) * size
         # inserts the fields, if necessary.
         source, scripted = etrans.transform_fields(fields)
-        if source is not None:
-            s_body["_source"] = source
+        if source is None:
+            source = {"excludes": self.SOURCE_EXCLUDES}
+        s_body["_source"] = source
         if scripted is not None:
             s_body["script_fields"] = scripted
 
         results = self.es.search(index=index, body=s_body)
         docs = etrans.transform_output(results)
 
-        num_pages, rem = divmod(results["hits"]["total"], self.defaults.size())
+        num_results, relation = etrans.transform_total(
+            sda(results, ["hits", "total"]))
+        num_pages = None
+        if num_results is not None:
+            num_pages, rem = divmod(num_results, size)
+            if rem > 0:
+                num_pages += 1
+
+        hits = sda(results, ["hits", "hits"], [])
+        next_cursor = None
+        # a full page indicates, that there might be more results.
+        if len(hits) == size:
+            next_cursor = etrans.encode_cursor(hits[-1].get("sort"))
+
+        return {
+            "num_results": num_results,
+            "total_relation": relation,
+            "total_pages": num_pages,
+            "results": docs,
+            "aggs": etrans.transform_agg_filters(results.get("aggregations")),
+            "cursor": next_cursor
+        }
+
+    def search_passages(self, search_text, page=1, fields=None, filters={},
+                        highlight=True):
+        """Returns all documents, that contain the `search_text` in a passage.
+
+        The passages are scored on their own and collapsed by their parent,
+        such that each document shows up once, ranked by its best passage.
+        Each document holds the best `passage_hits` passages as `passages`,
+        a list of dicts with the `page` and the `highlight` fragments.
+        Paging happens by `page` only, collapsing doesn't allow a cursor.
+
+        Args:
+            search_text (str): the text to search for.
+            page (int): the page of the results that should be shown.
+            fields (list): a list of fields that should be returned.
+                Defaults to None, which means all fields.
+            filters (dict): the filters, restricted to `PASSAGE_FILTERS`.
+            highlight (boolean): Whether text highlights for the query should
+                be done.
+
+        Returns:
+            dict: a dictionary like the one of `search_documents`.
+        """
+        index = self.defaults.passages_index()
+        size = self.defaults.size()
+
+        inner_hits = {
+            "name": "passages",
+            "size": self.defaults.passage_hits(3),
+            "_source": ["page"]
+        }
+        if highlight:
+            inner_hits["highlight"] = etrans.transform_highlight(["text"])
+
+        s_body = {
+            "size": size,
+            "from": (page - 1) * size,
+            "query": {
+                "bool": {
+                    "must": {
+                        "simple_query_string": {
+                            "query": search_text,
+                            "fields": ["text"],
+                            "default_operator": "and"
+                        }
+                    },
+                    "filter": etrans.transform_filters(filters)
+                }
+            },
+            "collapse": {"field": "parent", "inner_hits": inner_hits},
+            "_source": ["parent"],
+            "aggs": {
+                "parents": {
+                    "cardinality": {
+                        "field": "parent",
+                        "precision_threshold": 40000
+                    }
+                }
+            }
+        }
+        results = self.es.search(index=index, body=s_body)
+
+        hits = sda(results, ["hits", "hits"], [])
+        parents = [sda(hit, ["_source", "parent"]) for hit in hits]
+        docs = self.get_documents_by_ids(parents, fields)
+        for hit, doc in zip(hits, docs):
+            if doc is None:
+                continue
+            doc["passages"] = [
+                {"page": sda(p, ["_source", "page"]),
+                 "highlight": sda(p, ["highlight", "text"], [])}
+                for p in sda(hit, ["inner_hits", "passages", "hits", "hits"],
+                             [])
+            ]
+
+        num_results = sda(results, ["aggregations", "parents", "value"], 0)
+        num_pages, rem = divmod(num_results, size)
         if rem > 0:
             num_pages += 1
 
         return {
-            "num_results": results["hits"]["total"],
+            "num_results": num_results,
+            "total_relation": "eq",
             "total_pages": num_pages,
-            "results": docs,
-            "aggs": etrans.transform_agg_filters(results.get("aggregations"))
+            "results": [doc for doc in docs if doc is not None],
+            "aggs": {},
+            "cursor": None
         }
+
+    def get_documents_by_ids(self, doc_ids, fields=None, **kwargs):
+        """Returns the documents with the given ids in the given order.
+
+        Uses a single realtime `mget` instead of a search, hence only the
+        shards holding the documents are asked and fresh documents are
+        found immediately. Partitions are located first, as `mget` needs
+        concrete indices.
+
+        Args:
+            doc_ids (list): the `_id`s of the documents.
+            fields (list): a list of fields that should be returned.
+                Defaults to None, which means all fields.
+
+        Returns:
+            list: the documents, None for each id, that doesn't exist.
+        """
+        if not doc_ids:
+            return []
+        doc_type = self.defaults.other(kwargs).doc_type()
+        indices = self._locate_documents(doc_ids, **kwargs)
+        docs = [{"_index": indices[doc_id], "_type": doc_type, "_id": doc_id}
+                for doc_id in doc_ids if doc_id in indices]
+        if not docs:
+            return [None] * len(doc_ids)
+
+        # scripts can't run on gets, they are computed from the _source.
+        source, computed = etrans.transform_get_fields(fields)
+        params = {}
+        if source is not None:
+            params["_source"] = source
+        else:
+            params["_source_exclude"] = self.SOURCE_EXCLUDES
+
+        results = self.es.mget(body={"docs": docs}, **params)
+        found = {doc["_id"]: etrans.transform_get_output(doc, fields,
+                                                         computed)
+                 for doc in results.get("docs", []) if doc.get("found")}
+        return [found.get(doc_id) for doc_id in doc_ids]
+
+    def export_documents(self, search_text, fields=None, filters={},
+                         **kwargs):
+        """Yields all documents, that match the search, batch by batch.
+
+        Uses a scroll context sorted by `_doc`, such that only one batch is
+        held in memory at any time, regardless of the number of results.
+
+        Args:
+            search_text (str): the text to search for.
+            fields (list): a list of fields that should be returned.
+                Defaults to None, which means all fields.
+            filters (dict): the filters for fields of the documents.
+            **kwargs (dict): keyword arguments to override the defaults,
+                e.g. `export_size` and `scroll`.
+
+        Yields:
+            list: a batch of documents, as returned by `transform_output`.
+        """
+        index = self.defaults.other(kwargs).docs_index()
+        size = self.defaults.other(kwargs).export_size(500)
+        scroll = self.defaults.other(kwargs).scroll("2m")
+        logger.debug(f"Exporting {search_text} from '{index}'")
+
+        s_body = {
+            "size": size,
+            "query": self._search_query(search_text, filters),
+            "sort": ["_doc"]
+        }
+        source, scripted = etrans.transform_fields(fields)
+        if source is None:
+            source = {"excludes": self.SOURCE_EXCLUDES}
+        s_body["_source"] = source
+        if scripted is not None:
+            s_body["script_fields"] = scripted
+
+        results = self.es.search(index=index, body=s_body, scroll=scroll)
+        scroll_id = results.get("_scroll_id")
+        try:
+            while sda(results, ["hits", "hits"]):
+                yield etrans.transform_output(results)
+                results = self.es.scroll(scroll_id=scroll_id, scroll=scroll)
+                scroll_id = results.get("_scroll_id", scroll_id)
+        finally:
+            # free the scroll context, also when the consumer stops early.
+            if scroll_id is not None:
+                try:
+                    self.es.clear_scroll(scroll_id=scroll_id)
+                except es.ElasticsearchException as e:
+                    logger.warning(f"Couldn't clear the scroll context. {e}")
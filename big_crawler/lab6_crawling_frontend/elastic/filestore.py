@@ -7,13 +7,74 @@ Author: Johannes Müller <j.mueller@reply.de>
 """
 
 import os
+import sys
+import gzip
+import struct
 import hashlib
 import logging
+import tempfile
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: nocover
+    zstandard = None
 
 import utility
 
 logger = logging.getLogger(__name__)
 
+HEADER = struct.Struct(">4sBQ")
+"""Header of encoded files: magic, codec id and the decoded size."""
+MAGIC = b"\x00SFS"
+
+
+def _open_gzip(fl):
+    """Returns a gzip reader for fl, which also closes fl."""
+    reader = gzip.GzipFile(fileobj=fl, mode="rb")
+    reader.myfileobj = fl
+    return reader
+
+
+CODECS = {
+    "gzip": {
+        "id": 1,
+        "compress": lambda data: gzip.compress(data, compresslevel=6),
+        "decompress": gzip.decompress,
+        "open": _open_gzip
+    }
+}
+"""Available codecs by name, zstd is used when installed."""
+if zstandard is not None:
+    CODECS["zstd"] = {
+        "id": 2,
+        "compress": lambda data: zstandard.ZstdCompressor(
+            level=10).compress(data),
+        "decompress": lambda data: zstandard.ZstdDecompressor().decompress(
+            data),
+        "open": lambda fl: zstandard.ZstdDecompressor().stream_reader(fl)
+    }
+CODEC_IDS = {codec["id"]: codec for codec in CODECS.values()}
+
+DECODE_ERRORS = (EOFError, zlib.error) + (
+    (zstandard.ZstdError,) if zstandard is not None else ())
+"""Errors of the codecs, besides IOError, on corrupt contents."""
+
+COMPRESSED_MAGICS = (
+    b"\x1f\x8b",  # gzip
+    b"PK\x03\x04",  # zip, docx, xlsx, ...
+    b"\x28\xb5\x2f\xfd",  # zstd
+    b"\x89PNG",
+    b"\xff\xd8\xff",  # jpeg
+    b"GIF8",
+)
+"""File signatures of contents, which are compressed already."""
+
+INCOMPRESSIBLE_TYPES = ("image/", "video/", "audio/", "application/zip",
+                        "application/gzip", "application/x-gzip",
+                        "application/vnd.openxmlformats")
+"""Content types, which aren't worth compressing."""
+
 
 def _create_dir(dirpath):
     """Creates a directory if it's not already existant.
@@ -46,10 +107,33 @@ def _hash_content(content):
     return hash_obj.hexdigest()
 
 
+def _write_atomic(path, content):
+    """Writes the content to path, such that readers never see a partial file.
+
+    Args:
+        path (str): the path of the file.
+        content (bytes): the file contents.
+    """
+    directory = os.path.dirname(path)
+    _create_dir(directory)
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as fl:
+            fl.write(content)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 class FileStore():
     """The filestore simply takes contents and saves them to file.
 
     For saving space they are saved using the sha256 hashes as filenames.
+    The files are sharded into two levels of directories by the first
+    characters of their hash (`ab/cd/abcd...`), such that no directory grows
+    too large. Files of the former flat layout are still found, use
+    `migrate_layout` to move them.
     """
 
     def __init__(self, directory=None):
@@ -60,7 +144,13 @@ class FileStore():
                 saved.
         """
         self.defaults = utility.DefaultDict({
-            "mode": "b"
+            "mode": "b",
+            "codec": "zstd" if "zstd" in CODECS else "gzip",
+            # blobs smaller than this are stored as they are.
+            "min_size": 1024,
+            # a sample has to shrink below this ratio to be compressed.
+            "sample_size": 65536,
+            "min_ratio": 0.9
         })
         self.dir = directory
 
@@ -71,15 +161,144 @@ class FileStore():
         if not _create_dir(self.dir):
             raise IOError(f"Couldn't create the upload folder: {self.dir}")
 
-    def set(self, content, mode="b"):
+    def _shard_path(self, filename):
+        """Returns the sharded path of the file, regardless of its existence.
+        """
+        return os.path.join(self.dir, filename[0:2], filename[2:4], filename)
+
+    def path(self, filename):
+        """Returns the absolute path of the given file.
+
+        Args:
+            filename (str): the filename (hash) of the file.
+
+        Returns:
+            str: the path of the file or None, if it doesn't exist.
+        """
+        if filename is None or len(filename) == 0:
+            return None
+        path = self._shard_path(filename)
+        if os.path.exists(path):
+            return path
+        # files of the flat layout.
+        path = os.path.join(self.dir, filename)
+        if os.path.exists(path):
+            return path
+        return None
+
+    def substore(self, name):
+        """Returns a filestore in a subdirectory of this one.
+
+        The subdirectory isn't one of the shards, hence its files are never
+        listed (or collected) with the files of this filestore.
+
+        Args:
+            name (str): the name of the subdirectory.
+
+        Returns:
+            FileStore: the filestore of the subdirectory.
+        """
+        return FileStore(os.path.join(self.dir, name))
+
+    def shards(self):
+        """Returns the names of the top level shards (hash prefixes)."""
+        return [f"{i:02x}" for i in range(256)]
+
+    def list(self, shard):
+        """Yields all files of the given top level shard.
+
+        Args:
+            shard (str): the shard, a two character hash prefix.
+
+        Yields:
+            tuple: the filename (hash) and its modification time (float).
+        """
+        top = os.path.join(self.dir, shard)
+        if not os.path.isdir(top):
+            return
+        for sub in os.scandir(top):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.is_file() and not entry.name.startswith("."):
+                    yield entry.name, entry.stat().st_mtime
+
+    def migrate_layout(self):
+        """Moves all files of the flat layout into their shards.
+
+        Returns:
+            int: the number of moved files.
+        """
+        moved = 0
+        with os.scandir(self.dir) as entries:
+            for entry in entries:
+                if not entry.is_file() or entry.name.startswith("."):
+                    continue
+                path = self._shard_path(entry.name)
+                _create_dir(os.path.dirname(path))
+                os.replace(entry.path, path)
+                moved += 1
+        logger.info(f"Moved {moved} files into shards.")
+        return moved
+
+    def _choose_codec(self, content, content_type=None):
+        """Returns the name of the codec for the content or None.
+
+        Contents, which are small or compressed already, are skipped.
+        Unless it's text, a sample has to compress well.
+        """
+        if len(content) < self.defaults.min_size():
+            return None
+        content_type = (content_type or "").split(";")[0].strip().lower()
+        if content_type.startswith(INCOMPRESSIBLE_TYPES) or \
+                content.startswith(COMPRESSED_MAGICS):
+            return None
+        if not content_type.startswith("text/"):
+            sample = content[:self.defaults.sample_size()]
+            ratio = len(zlib.compress(sample, 1)) / len(sample)
+            if ratio > self.defaults.min_ratio():
+                return None
+        return self.defaults.codec()
+
+    def _encode(self, content, codec):
+        """Returns the content encoded by codec, prefixed with a header."""
+        if codec is None:
+            return content
+        codec = CODECS[codec]
+        header = HEADER.pack(MAGIC, codec["id"], len(content))
+        return header + codec["compress"](content)
+
+    def _decode(self, contents):
+        """Returns the decoded contents and whether they were encoded.
+
+        Raises:
+            IOError: if the codec is unknown or the contents are corrupt.
+        """
+        if not contents.startswith(MAGIC) or len(contents) < HEADER.size:
+            return contents, False
+        _, codec_id, _ = HEADER.unpack_from(contents)
+        codec = CODEC_IDS.get(codec_id)
+        if codec is None:
+            raise IOError(f"Unknown codec {codec_id}, is zstandard missing?")
+        try:
+            return codec["decompress"](contents[HEADER.size:]), True
+        except DECODE_ERRORS as e:
+            raise IOError(f"Couldn't decompress the contents. {e}")
+
+    def set(self, content, mode="b", content_type=None, codec=False):
         """Saves the given content into a file.
 
         The filename will equal the hash of the content, if the file is already
         saved, just return the bytes object.
+        The content is compressed transparently, depending on its type.
 
         Args:
             content (bytes): a bytes object.
             mode (str): 'b' binary or 't' text reading mode. Defaults to 'b'.
+            content_type (str): the mimetype of the content, helps choosing
+                a codec. Defaults to None.
+            codec (str): forces a codec, None stores the content as it is.
+                Defaults to False, which chooses the codec by the content.
 
         Returns:
             str: the relative name of this file.
@@ -89,17 +308,83 @@ class FileStore():
         mode = self.defaults.mode.also(mode)
 
         filename = _hash_content(content)
-        path = os.path.join(self.dir, filename)
         # early exit, when file path does already exist.
-        if os.path.exists(path):
+        path = self.path(filename)
+        if path is not None:
+            # renew the grace period of the garbage collection.
+            os.utime(path)
             return filename
 
-        with open(path, "w" + mode) as fl:
-            fl.write(content)
+        if codec is False:
+            codec = self._choose_codec(content, content_type)
+        _write_atomic(self._shard_path(filename),
+                      self._encode(content, codec))
 
         logger.debug(f"Created file '{filename}'.")
         return filename
 
+    def put(self, filename, content, content_type=None):
+        """Saves the given content under the given filename.
+
+        Unlike `set`, the filename isn't derived from the content, hence an
+        existing file is replaced. The content is compressed like in `set`.
+
+        Args:
+            filename (str): the filename, a hex string of at least four
+                characters, e.g. a hash.
+            content (bytes): a bytes object.
+            content_type (str): the mimetype of the content, helps choosing
+                a codec. Defaults to None.
+
+        Returns:
+            str: the relative name of this file.
+        """
+        if content is None:
+            return None
+        codec = self._choose_codec(content, content_type)
+        _write_atomic(self._shard_path(filename),
+                      self._encode(content, codec))
+        return filename
+
+    def set_stream(self, stream, chunk_size=1024 * 1024):
+        """Saves the content of a stream into a file, chunk by chunk.
+
+        The content is hashed while writing, such that it never has to be
+        held in memory completely. It's stored as it is.
+
+        Args:
+            stream (file): a readable binary file object.
+            chunk_size (int): the size of the read chunks in bytes.
+
+        Returns:
+            str: the relative name of this file.
+        """
+        hash_obj = hashlib.sha256()
+        fd, tmp_path = tempfile.mkstemp(prefix=".tmp_", dir=self.dir)
+        try:
+            with os.fdopen(fd, "wb") as fl:
+                for chunk in iter(lambda: stream.read(chunk_size), b""):
+                    hash_obj.update(chunk)
+                    fl.write(chunk)
+            filename = hash_obj.hexdigest()
+
+            path = self.path(filename)
+            if path is not None:
+                os.utime(path)
+                os.remove(tmp_path)
+                return filename
+
+            path = self._shard_path(filename)
+            _create_dir(os.path.dirname(path))
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        logger.debug(f"Created file '{filename}' from a stream.")
+        return filename
+
     def get(self, filename, mode="b"):
         """Returns the content of the given file.
 
@@ -112,20 +397,84 @@ class FileStore():
         """
         mode = self.defaults.mode.also(mode)
 
-        if filename is None or len(filename) == 0:
+        path = self.path(filename)
+        if path is None:
             return None
 
-        path = os.path.join(self.dir, filename)
         contents = None
 
         try:
-            with open(path, "r" + mode) as fl:
-                contents = fl.read()
+            with open(path, "rb") as fl:
+                contents, _ = self._decode(fl.read())
         except EnvironmentError as ee:
             pass
 
+        if contents is not None and mode == "t":
+            contents = contents.decode("utf-8")
         return contents
 
+    def open(self, filename):
+        """Opens the given file for streaming its decoded content.
+
+        Args:
+            filename (str): the filename (hash) of the file.
+
+        Returns:
+            tuple: the path (str) of files stored as they are, otherwise a
+                decompressing file object, and the decoded size (int).
+                None, if the file doesn't exist.
+        """
+        path = self.path(filename)
+        if path is None:
+            return None
+
+        with open(path, "rb") as fl:
+            header = fl.read(HEADER.size)
+        if not header.startswith(MAGIC) or len(header) < HEADER.size:
+            return path, os.path.getsize(path)
+
+        _, codec_id, size = HEADER.unpack(header)
+        fl = open(path, "rb")
+        fl.seek(HEADER.size)
+        return CODEC_IDS[codec_id]["open"](fl), size
+
+    def set_text(self, text):
+        """Saves the given text compressed into a file.
+
+        The filename equals the hash of the utf-8 encoded text, such that
+        equal texts are only saved once.
+
+        Args:
+            text (str): some text.
+
+        Returns:
+            str: the relative name of this file.
+        """
+        if text is None:
+            return None
+        return self.set(text.encode("utf-8"), codec=self.defaults.codec())
+
+    def get_text(self, filename):
+        """Returns the text saved by `set_text`.
+
+        Args:
+            filename (str): the filename (hash) of the text.
+
+        Returns:
+            str: the decompressed text or None.
+        """
+        path = self.path(filename)
+        if path is None:
+            return None
+
+        try:
+            with open(path, "rb") as fl:
+                contents, _ = self._decode(fl.read())
+            return contents.decode("utf-8")
+        except EnvironmentError as ee:
+            logger.error(f"Couldn't read the text file '{filename}'. {ee}")
+        return None
+
     def remove(self, filename):
         """Removes a file from the file-store.
 
@@ -135,7 +484,10 @@ class FileStore():
         Returns:
             bool: True when the deletion succeeded, False otherwise.
         """
-        path = os.path.join(self.dir, filename)
+        path = self.path(filename)
+        if path is None:
+            logger.error(f"Failed to delete missing file '{filename}'.")
+            return False
 
         try:
             os.remove(path)
@@ -145,3 +497,9 @@ class FileStore():
 
         logger.debug(f"Deleted file '{path}'.")
         return True
+
+
+if __name__ == "__main__":
+    # moves the files of a flat filestore into shards.
+    logging.basicConfig(level=logging.INFO)
+    FileStore(sys.argv[1] if len(sys.argv) > 1 else None).migrate_layout()
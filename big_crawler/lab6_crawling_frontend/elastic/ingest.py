@@ -0,0 +1,303 @@
+"""Ingest module, which analyzes uploaded documents in the background.
+
+Uploads are written to the filestore right away and registered as jobs in
+an elasticsearch index, which makes the queue durable across restarts.
+A pool of worker threads claims the jobs one by one and inserts the
+documents, the state of each job can be queried by its id.
+"""
+import datetime as dt
+import logging
+import threading
+
+import elasticsearch as es
+
+import utility
+
+logger = logging.getLogger(__name__)
+
+# shortcut for safe_dict_access
+sda = utility.safe_dict_access
+
+
+class JobClaim():
+    """A job claimed by a worker and the version of its last write."""
+
+    def __init__(self, job_id, job, version):
+        """Initializes the claim.
+
+        Args:
+            job_id (str): the id of the job.
+            job (dict): the job, as written by the claim.
+            version (int): the version of the job document.
+        """
+        self.job_id = job_id
+        self.job = job
+        self.version = version
+        self.lock = threading.Lock()
+
+
+class IngestQueue():
+    """A durable queue of ingest jobs, processed by a pool of workers.
+
+    A job is `queued`, `running`, `done` or `failed`. Workers claim jobs
+    using optimistic concurrency control and renew the lease of running
+    jobs, jobs of crashed workers are claimed again, once their lease
+    expired.
+    """
+    MAPPING = {
+        "properties": {
+            "status": {"type": "keyword"},
+            "blob": {"type": "keyword"},
+            "filename": {"type": "keyword"},
+            "mimetype": {"type": "keyword"},
+            "created": {"type": "date"},
+            "updated": {"type": "date"},
+            "attempts": {"type": "integer"},
+            "result": {"type": "object", "enabled": False},
+            "error": {"type": "text", "index": False}
+        }
+    }
+
+    def __init__(self, elastic, index="ingest", doc_type="job", **kwargs):
+        """Initializes the queue for the given `Elastic` instance.
+
+        Args:
+            elastic (Elastic): the client inserting the documents.
+            index (str): the index of the jobs. Defaults to "ingest".
+            doc_type (str): the doc_type of the jobs. Defaults to "job".
+            **kwargs (dict): keyword arguments to update the defaults,
+                `workers` (number of threads), `poll_interval` (seconds),
+                `lease` (seconds, after which running jobs are claimed
+                again) and `max_attempts`.
+        """
+        self.elastic = elastic
+        self.es = elastic.es
+        self.fs = elastic.fs
+        self.index = index
+        self.doc_type = doc_type
+        self.defaults = utility.DefaultDict(dict({
+            "workers": 2,
+            "poll_interval": 2,
+            "lease": 10 * 60,
+            "max_attempts": 3
+        }, **kwargs))
+        self.workers = []
+        self.stopped = threading.Event()
+
+        self.es.indices.create(index=self.index, body={
+            "mappings": {self.doc_type: self.MAPPING}
+        }, ignore=400)
+        # the uploads of pending jobs aren't referenced by documents yet.
+        elastic.collector.add_references(self.index, ["blob"], {
+            "terms": {"status": ["queued", "running"]}
+        })
+
+    def submit(self, stream, filename=None, mimetype=None):
+        """Saves the uploaded stream and registers an ingest job for it.
+
+        Args:
+            stream (file): a readable binary file object.
+            filename (str): the name of the uploaded file.
+            mimetype (str): the mimetype of the uploaded file.
+
+        Returns:
+            str: the id of the job.
+        """
+        blob = self.fs.set_stream(stream)
+        now = dt.datetime.utcnow()
+        job = {
+            "status": "queued",
+            "blob": blob,
+            "filename": filename,
+            "mimetype": mimetype,
+            "created": now,
+            "updated": now,
+            "attempts": 0
+        }
+        res = self.es.index(index=self.index, doc_type=self.doc_type,
+                            body=job)
+        return res["_id"]
+
+    def status(self, job_id):
+        """Returns the state of the given job.
+
+        Args:
+            job_id (str): the id of the job.
+
+        Returns:
+            dict: the job with `status`, `result` and `error` or None.
+        """
+        try:
+            res = self.es.get(index=self.index, doc_type=self.doc_type,
+                              id=job_id)
+        except es.NotFoundError:
+            return None
+        return dict(res["_source"], _id=job_id)
+
+    def _claim(self):
+        """Claims the oldest available job.
+
+        Returns:
+            JobClaim: the claimed job or None.
+        """
+        expired = dt.datetime.utcnow() - dt.timedelta(
+            seconds=self.defaults.lease())
+        s_body = {
+            "size": self.defaults.workers() * 2,
+            "query": {
+                "bool": {
+                    "should": [
+                        {"term": {"status": "queued"}},
+                        {"bool": {"filter": [
+                            {"term": {"status": "running"}},
+                            {"range": {"updated": {"lt": expired}}}
+                        ]}}
+                    ],
+                    "minimum_should_match": 1
+                }
+            },
+            "sort": [{"created": {"order": "asc"}}],
+            "version": True
+        }
+        results = self.es.search(index=self.index, doc_type=self.doc_type,
+                                 body=s_body)
+        for hit in sda(results, ["hits", "hits"], []):
+            job = dict(hit["_source"], status="running",
+                       updated=dt.datetime.utcnow(),
+                       attempts=hit["_source"].get("attempts", 0) + 1)
+            try:
+                # fails, if another worker claimed it in the meantime.
+                res = self.es.index(index=self.index, doc_type=self.doc_type,
+                                    id=hit["_id"], body=job,
+                                    version=hit["_version"])
+            except es.ConflictError:
+                continue
+            return JobClaim(hit["_id"], job, res["_version"])
+        return None
+
+    def _write(self, claim, **update):
+        """Updates the claimed job, unless another worker claimed it since.
+
+        Args:
+            claim (JobClaim): the claimed job.
+            **update (dict): the changed fields of the job.
+
+        Returns:
+            bool: False, if the job was claimed by another worker.
+        """
+        with claim.lock:
+            job = dict(claim.job, updated=dt.datetime.utcnow(), **update)
+            try:
+                res = self.es.index(index=self.index, doc_type=self.doc_type,
+                                    id=claim.job_id, body=job,
+                                    version=claim.version)
+            except es.ConflictError:
+                logger.warning(f"Lost the lease of ingest job "
+                               f"'{claim.job_id}', dropping its update.")
+                return False
+            claim.job = job
+            claim.version = res["_version"]
+        return True
+
+    def _renew(self, claim, done):
+        """Renews the lease of the claimed job, until done is set.
+
+        Args:
+            claim (JobClaim): the claimed job.
+            done (threading.Event): set, when the job is finished.
+        """
+        interval = self.defaults.lease() / 3
+        while not done.wait(interval):
+            try:
+                if not self._write(claim):
+                    return
+            except es.ElasticsearchException as e:
+                logger.warning(f"Couldn't renew the lease of ingest job "
+                               f"'{claim.job_id}'. {e}")
+
+    def _finish(self, claim, **update):
+        """Saves the final state of a job, unless it was claimed again."""
+        self._write(claim, **update)
+
+    def process(self, claim):
+        """Inserts the document of the given job.
+
+        Renews the lease of the job meanwhile, such that long running jobs
+        aren't claimed again.
+
+        Args:
+            claim (JobClaim): the claimed job.
+        """
+        done = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(claim, done),
+                                   daemon=True,
+                                   name=f"ingest-lease-{claim.job_id}")
+        renewer.start()
+        try:
+            self._process(claim)
+        finally:
+            done.set()
+            renewer.join()
+
+    def _process(self, claim):
+        """Inserts the document of the given job, see `process`."""
+        job = claim.job
+        if job["attempts"] > self.defaults.max_attempts():
+            self._finish(claim, status="failed", error="Too many attempts.")
+            return
+
+        content = self.fs.get(job["blob"])
+        if content is None:
+            self._finish(claim, status="failed",
+                         error="The uploaded file is missing.")
+            return
+
+        try:
+            # the same structure, the crawlers insert.
+            res = self.elastic.insert_document({
+                "raw_content": content,
+                "content_type": job.get("mimetype"),
+                "metadata": {
+                    "filename": job.get("filename"),
+                    "mimetype": job.get("mimetype")
+                }
+            })
+        except Exception as e:
+            logger.exception(f"Ingest job '{claim.job_id}' failed.")
+            failed = job["attempts"] >= self.defaults.max_attempts()
+            self._finish(claim, error=str(e),
+                         status="failed" if failed else "queued")
+            return
+
+        self._finish(claim, status="done", error=None,
+                     result={"result": res.get("result"),
+                             "_id": res.get("_id")})
+
+    def _work(self):
+        """The loop of a worker thread."""
+        while not self.stopped.is_set():
+            try:
+                claimed = self._claim()
+            except es.ElasticsearchException as e:
+                logger.warning(f"Couldn't claim an ingest job. {e}")
+                claimed = None
+            if claimed is None:
+                self.stopped.wait(self.defaults.poll_interval())
+                continue
+            self.process(claimed)
+
+    def start(self):
+        """Starts the worker threads."""
+        self.stopped.clear()
+        for num in range(self.defaults.workers()):
+            worker = threading.Thread(target=self._work, daemon=True,
+                                      name=f"ingest-{num}")
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self):
+        """Stops the worker threads, after their current jobs."""
+        self.stopped.set()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
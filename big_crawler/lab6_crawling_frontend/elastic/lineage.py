@@ -0,0 +1,125 @@
+"""Lineage module, which links the versions of a document at ingest time.
+
+All versions of a document share a `lineage` (its source url). When a new
+version is inserted, its predecessor is looked up once, the changes are
+counted and the processed diff is saved to the filestore, such that the
+diff view only needs to read it.
+"""
+import json
+import logging
+
+import diff
+import utility
+
+logger = logging.getLogger(__name__)
+
+# shortcut for safe_dict_access
+sda = utility.safe_dict_access
+
+
+class Lineage():
+    """Links new documents to their predecessors and caches their diffs."""
+
+    def __init__(self, client, fs, index, doc_type, **kwargs):
+        """Initializes the lineage for the given docs index.
+
+        Args:
+            client (elasticsearch.Elasticsearch): the elasticsearch client.
+            fs (filestore.FileStore): the filestore holding texts and diffs.
+            index (str): the docs index (or alias).
+            doc_type (str): the doc_type of the documents.
+            **kwargs (dict): keyword arguments to update the defaults.
+        """
+        self.es = client
+        self.fs = fs
+        self.defaults = utility.DefaultDict(dict({
+            "index": index,
+            "doc_type": doc_type
+        }, **kwargs))
+
+    def predecessor(self, lineage, exclude=None):
+        """Returns the latest document of the given lineage.
+
+        Args:
+            lineage (str): the lineage (source url) of the document.
+            exclude (str): a document id, that should be skipped.
+
+        Returns:
+            dict: the `_id`, `version` and `text_hash` of the predecessor or
+                None, if there is no predecessor.
+        """
+        s_body = {
+            "size": 1,
+            "query": {
+                "bool": {
+                    "filter": {"term": {"lineage": lineage}},
+                    "must_not": {"ids": {"values": [exclude] if exclude
+                                         else []}}
+                }
+            },
+            "sort": [{"version": {"order": "desc"}}],
+            "_source": ["version", "text_hash"]
+        }
+        results = self.es.search(index=self.defaults.index(), body=s_body)
+        hit = sda(results, ["hits", "hits", 0])
+        if hit is None:
+            return None
+        return dict(hit["_source"], _id=hit["_id"])
+
+    def link(self, doc, doc_id):
+        """Links a document to its predecessor and saves the diff.
+
+        Meant to be called, once the document was created, such that no diff
+        is saved for a document, that already existed.
+
+        Args:
+            doc (dict): the prepared document, holding `lineage` and `text`.
+            doc_id (str): the id of the document.
+
+        Returns:
+            dict: the `predecessor`, `change` and `diff` (the filename of the
+                cached diff), which should be set on the document, empty if
+                there is no predecessor.
+        """
+        if not doc.get("lineage"):
+            return {}
+        prev = self.predecessor(doc["lineage"], exclude=doc_id)
+        if prev is None:
+            return {}
+
+        prev_text = self.fs.get_text(prev.get("text_hash"))
+        if prev_text is None:
+            logger.warning(f"Missing text of '{prev['_id']}', couldn't diff "
+                           f"'{doc_id}'.")
+            return {"predecessor": prev["_id"]}
+
+        blocks, change = diff.get_unified_diff({"text": doc.get("text", "")},
+                                               {"text": prev_text})
+        return {
+            "predecessor": prev["_id"],
+            "change": {
+                "lines_added": change["+"],
+                "lines_removed": change["-"]
+            },
+            "diff": self.fs.set_text(json.dumps({"blocks": blocks,
+                                                 "change": change}))
+        }
+
+    def get_diff(self, doc, other_id):
+        """Returns the cached diff of a document to its predecessor.
+
+        Args:
+            doc (dict): the document, holding `predecessor` and `diff`.
+            other_id (str): the id of the compared document.
+
+        Returns:
+            tuple: the diff blocks (list) and changes (dict) as returned by
+                `diff.get_unified_diff` or None, if it's not cached.
+        """
+        if not doc.get("diff") or doc.get("predecessor") != other_id:
+            return None
+        cached = self.fs.get_text(doc["diff"])
+        if cached is None:
+            return None
+        cached = json.loads(cached)
+        return cached["blocks"], cached["change"]
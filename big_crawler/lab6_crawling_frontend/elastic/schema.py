@@ -0,0 +1,184 @@
+"""Schema registry module, which keeps track of the applied schema versions.
+
+Every process used to put all scripts, mappings and settings on startup.
+The registry stores the applied version in elasticsearch instead, such that
+a startup only needs a single lookup and migrations run exactly once, even
+when several replicas start at the same time.
+"""
+import logging
+import time
+import datetime as dt
+
+import elasticsearch as es
+
+import utility
+
+logger = logging.getLogger(__name__)
+
+
+class SchemaRegistry():
+    """Stores the schema state of an index in an elasticsearch registry.
+
+    Each registered index owns a document holding the applied `version` and
+    additional properties (like the partitioning). Migrations are guarded
+    by a lock document, which is created atomically using `op_type=create`.
+    """
+    MAPPING = {
+        "properties": {
+            "version": {"type": "integer"},
+            "applied": {"type": "date"},
+            "locked": {"type": "date"}
+        },
+        "dynamic": True
+    }
+
+    def __init__(self, client, index="schema", doc_type="schema", **kwargs):
+        """Initializes the registry for a given elasticsearch client.
+
+        Args:
+            client (elasticsearch.Elasticsearch): the elasticsearch client.
+            index (str): the index of the registry. Defaults to "schema".
+            doc_type (str): the doc_type of the registry entries.
+            **kwargs (dict): keyword arguments to update the defaults,
+                `lock_timeout` (seconds, after which a lock counts as stale)
+                and `wait_timeout` (seconds, to wait for another migration).
+        """
+        self.es = client
+        self.index = index
+        self.doc_type = doc_type
+        self.defaults = utility.DefaultDict(dict({
+            "lock_timeout": 300,
+            "wait_timeout": 600,
+            "poll_interval": 1
+        }, **kwargs))
+
+    def get(self, key):
+        """Returns the registry entry for the given key.
+
+        Args:
+            key (str): the key of the entry, usually an index name.
+
+        Returns:
+            dict: the entry, an empty dict if the key is not registered yet.
+        """
+        try:
+            result = self.es.get(index=self.index, doc_type=self.doc_type,
+                                 id=key)
+        except es.NotFoundError:
+            return {}
+        return result.get("_source", {})
+
+    def set(self, key, version, **properties):
+        """Records the applied version and properties for the given key.
+
+        Args:
+            key (str): the key of the entry, usually an index name.
+            version (int): the applied schema version.
+            **properties (dict): further properties, that should be saved.
+        """
+        body = dict(properties, version=version,
+                    applied=dt.datetime.utcnow())
+        self.es.index(index=self.index, doc_type=self.doc_type, id=key,
+                      body=body, refresh=True)
+
+    def update(self, key, **properties):
+        """Updates some properties of an existing registry entry.
+
+        Args:
+            key (str): the key of the entry.
+            **properties (dict): the properties, that should be changed.
+        """
+        self.es.update(index=self.index, doc_type=self.doc_type, id=key,
+                       body={"doc": properties}, refresh=True)
+
+    def ensure(self, key, version, migrate):
+        """Runs `migrate` if the registered version is older than `version`.
+
+        Only one process migrates, others wait until the migration is
+        recorded (or the lock becomes stale).
+
+        Args:
+            key (str): the key of the entry, usually an index name.
+            version (int): the schema version of the current code.
+            migrate (callable): a function taking the registry entry (dict)
+                and returning a dict of properties, that should be recorded.
+
+        Returns:
+            dict: the registry entry after the check.
+        """
+        entry = self._get_or_create(key)
+        if entry.get("version", 0) >= version:
+            return entry
+
+        deadline = time.time() + self.defaults.wait_timeout()
+        while time.time() < deadline:
+            if self._acquire(key):
+                try:
+                    # another process might have finished in the meantime.
+                    entry = self.get(key)
+                    if entry.get("version", 0) >= version:
+                        return entry
+                    logger.info(f"Migrating schema of '{key}' from version "
+                                f"{entry.get('version', 0)} to {version}.")
+                    properties = migrate(entry) or {}
+                    self.set(key, version, **properties)
+                    return self.get(key)
+                finally:
+                    self._release(key)
+            time.sleep(self.defaults.poll_interval())
+            entry = self.get(key)
+            if entry.get("version", 0) >= version:
+                return entry
+        raise TimeoutError(f"Timed out waiting for the schema migration of "
+                           f"'{key}'.")
+
+    def _get_or_create(self, key):
+        """Returns the entry for key, creates the registry index if needed."""
+        entry = self.get(key)
+        if entry:
+            return entry
+        # the entry or the whole registry is missing, ignore existing ones.
+        self.es.indices.create(index=self.index, body={
+            "mappings": {self.doc_type: self.MAPPING}
+        }, ignore=400)
+        return {}
+
+    def _acquire(self, key):
+        """Tries to acquire the migration lock for key.
+
+        Returns:
+            bool: whether the lock was acquired.
+        """
+        lock_id = f"{key}.lock"
+        try:
+            self.es.create(index=self.index, doc_type=self.doc_type,
+                           id=lock_id, body={"locked": time.time() * 1000},
+                           refresh=True)
+            return True
+        except es.ConflictError:
+            pass
+
+        # remove stale locks of crashed processes.
+        try:
+            lock = self.es.get(index=self.index, doc_type=self.doc_type,
+                               id=lock_id)
+        except es.NotFoundError:
+            return False
+        age = time.time() - lock["_source"].get("locked", 0) / 1000
+        if age > self.defaults.lock_timeout():
+            logger.warning(f"Removing stale schema lock of '{key}'.")
+            try:
+                # only delete the very lock, that was found stale.
+                self.es.delete(index=self.index, doc_type=self.doc_type,
+                               id=lock_id, version=lock["_version"])
+            except (es.ConflictError, es.NotFoundError):
+                pass
+        return False
+
+    def _release(self, key):
+        """Releases the migration lock for key."""
+        try:
+            self.es.delete(index=self.index, doc_type=self.doc_type,
+                           id=f"{key}.lock", refresh=True)
+        except es.NotFoundError:
+            logger.warning(f"The schema lock of '{key}' vanished.")
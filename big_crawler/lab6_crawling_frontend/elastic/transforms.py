@@ -4,6 +4,9 @@ searches from some keywords.
 Author: Johannes Mueller <j.mueller@reply.de>
 """
 import re
+import json
+import base64
+import binascii
 import datetime
 
 import utility as ut
@@ -146,6 +149,9 @@ FILTER_KEYS = {
 }
 """Special rules when filtering for fields. `KEY_range` for range filters."""
 
+PASSAGE_FILTERS = {"date_from", "date_to", "type", "category", "source"}
+"""Filter keys, which are also available on passages."""
+
 
 SCRIPT_FIELDS = {
     "reading_time": lambda x: {
@@ -159,6 +165,13 @@ SCRIPT_FIELDS = {
 }
 """Script fields, that should be included in the search results."""
 
+GET_FIELDS = {
+    "reading_time": (["quantity.words", "type"], lambda doc: int(
+        ut.safe_dict_access(doc, ["quantity", "words"], 0) * 0.4 *
+        ut.TIME_FACTORS.get(doc.get("type"), 1.0) / 60))
+}
+"""Replacements for `SCRIPT_FIELDS` on gets, computed from the `_source`."""
+
 
 SORT_KEYS = {
     "_default": lambda k, o, a: {
@@ -226,6 +239,39 @@ SORT_KEYS = {
 }
 
 
+HIGHLIGHT_FIELDS = {
+    "_default": {"fragment_size": 150, "number_of_fragments": 1},
+    # uses the term vectors of the text, when available.
+    "text": {"fragment_size": 150, "number_of_fragments": 3,
+             "no_match_size": 0},
+    "document": {"number_of_fragments": 0},
+}
+"""Bounded highlighting options per field."""
+
+
+def transform_highlight(fields=None):
+    """Transforms a list of fields into an elastic highlight context.
+
+    Args:
+        fields (list): the fields that should be highlighted.
+            Defaults to None, which means all fields in `HIGHLIGHT_FIELDS`.
+
+    Returns:
+        dict: a valid elasticsearch highlight-dictionary.
+    """
+    if fields is None:
+        fields = [f for f in HIGHLIGHT_FIELDS if f != "_default"]
+
+    return {
+        "pre_tags": ["<b>"],
+        "post_tags": ["</b>"],
+        # the fragments are rendered as html.
+        "encoder": "html",
+        "fields": {f: HIGHLIGHT_FIELDS.get(f, HIGHLIGHT_FIELDS["_default"])
+                   for f in fields}
+    }
+
+
 def transform_aggs(fields):
     """Transforms a given list of fields into an elastic aggregation context.
 
@@ -278,6 +324,59 @@ def transform_fields(fields):
     return source, scripts
 
 
+def transform_get_fields(fields):
+    """Transforms a given list of fields into _source and computed fields.
+
+    Gets can't run scripts, hence script fields are replaced by the
+    `_source` fields they depend on, see `GET_FIELDS`.
+
+    Args:
+        fields (list): a list of field names, which should be transformed.
+
+    Returns:
+        tuple: a list of `_source` fields (or None for all fields) and a
+            dict of computed fields and their functions.
+    """
+    if fields is None:
+        return None, {}
+
+    source = []
+    computed = {}
+
+    for field in fields:
+        if len(field) == 0:
+            continue
+        rule = GET_FIELDS.get(field, None)
+        if rule is None:
+            source.append(field)
+        else:
+            source.extend(rule[0])
+            computed[field] = rule[1]
+
+    return list(set(source)), computed
+
+
+def transform_get_output(doc, fields=None, computed={}):
+    """Transforms the result of a get into a document with computed fields.
+
+    Args:
+        doc (dict): a single document as returned by `get` or `mget`.
+        fields (list): the requested fields, others are dropped.
+            Defaults to None, which means all fields.
+        computed (dict): the computed fields, see `transform_get_fields`.
+
+    Returns:
+        dict: the cleaned document.
+    """
+    ret = _transform_document(doc)
+    for field, func in computed.items():
+        ret[field] = func(ret)
+    if fields is not None:
+        wanted = {f.split(".")[0] for f in fields} | {"_id"}
+        ret = {k: v for k, v in ret.items() if k in wanted}
+    return ret
+
+
 def transform_filters(filters):
     """Transforms a given dict of filters into an elastic filter context.
 
@@ -336,6 +435,84 @@ def transform_sortby(sortby):
     return [sorter(sortby["keyword"], sortby["order"], sortby["args"])]
 
 
+def transform_cursor_sort(sort):
+    """Makes a sort context usable for `search_after` cursors.
+
+    A cursor needs a total order, hence the documents `doc_id` (a copy of
+    the `_id`, but a keyword with doc values) is appended as tiebreaker,
+    relevance sorts are made explicit. Unlike the `hash`, it stays unique,
+    when documents are inserted under other ids.
+
+    Args:
+        sort (list): an elasticsearch sort context, as returned by
+            `transform_sortby`.
+
+    Returns:
+        list: a sort context with a unique tiebreaker as last entry.
+    """
+    if not sort:
+        sort = ["_score"]
+    return sort + [{"doc_id": {"order": "asc"}}]
+
+
+def encode_cursor(sort_values):
+    """Encodes the sort values of a hit into an opaque, url-safe cursor.
+
+    Args:
+        sort_values (list): the `sort` values of the last hit of a page.
+
+    Returns:
+        str: the cursor or None, if no sort values are given.
+    """
+    if not sort_values:
+        return None
+    raw = json.dumps({"s": sort_values}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor as created by `encode_cursor`.
+
+    Args:
+        cursor (str): the opaque cursor.
+
+    Returns:
+        list: the sort values for `search_after` or None, if the cursor is
+            invalid.
+    """
+    if not cursor:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode("ascii"))
+        values = json.loads(raw.decode("utf-8")).get("s")
+    except (ValueError, TypeError, AttributeError, binascii.Error):
+        return None
+    if not isinstance(values, list):
+        return None
+    return values
+
+
+def transform_total(total):
+    """Returns the number of hits and whether this number is exact.
+
+    Handles the plain integer of elasticsearch 6 (`-1` when the hits were not
+    tracked) as well as the `{"value": ..., "relation": ...}` dict of later
+    versions.
+
+    Args:
+        total (int or dict): the `hits.total` of a search response.
+
+    Returns:
+        tuple: the number of hits (int or None) and the relation ("eq" or
+            "gte").
+    """
+    if isinstance(total, dict):
+        return total.get("value"), total.get("relation", "eq")
+    if total is None or total < 0:
+        return None, "gte"
+    return total, "eq"
+
+
 def transform_calendar_aggs(aggregations):
     """Transforms the given aggregations into a simple calendar-date.
 
@@ -423,6 +600,9 @@ def _transform_document(doc):
     # append all other fields + run OUTPUT_CONVerters
     ret.update({k: OUTPUT_CONV.get(k, OUTPUT_CONV["_default"])(v)
                 for k, v in doc.get("fields", {}).items()})
+    # append the highlighted fragments
+    if "highlight" in doc:
+        ret["highlight"] = doc["highlight"]
     return ret
 
 
@@ -439,7 +619,8 @@ def transform_output(results):
 
     if res["_source"]:
         return _transform_document(results)
-    if res["hits.total"] > 0:
+    # don't rely on hits.total, it isn't tracked for every search.
+    if res["hits.hits"]:
         return [_transform_document(doc) for doc in res["hits.hits"]]
     # otherwise
     return []
@@ -463,6 +644,30 @@ def transform_input(update):
     return filtered
 
 
+MAP_FIELDS = ["keywords", "entities"]
+"""Fields that hold a map of weights, their keys can be set using lists."""
+
+
+def transform_mutation(properties):
+    """Splits a dict of property changes for the `mutate_document` script.
+
+    Lists given for a map-field (see `MAP_FIELDS`) are treated as the new
+    set of keys, all other values are checked as in `transform_input`.
+
+    Args:
+        properties (dict): the properties and the values that should be set.
+
+    Returns:
+        tuple: a dict of checked values and a dict mapping map-fields to a
+            list of keys.
+    """
+    map_keys = {k: list(v) for k, v in properties.items()
+                if k in MAP_FIELDS and isinstance(v, (list, tuple))}
+    body = transform_input({k: v for k, v in properties.items()
+                            if k not in map_keys})
+    return body, map_keys
+
+
 def transform_search(search):
     """Prepares a search dict for inserting it into the database.
 
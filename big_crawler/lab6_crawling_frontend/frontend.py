@@ -1,16 +1,18 @@
+import atexit
 import logging
-import io
 import datetime as dt
 import re
 
 import elastic
 from flask import (Flask, request, redirect, render_template, url_for,
-                   send_file, jsonify, flash)
+                   send_file, jsonify, flash, Response, stream_with_context)
 
 import settings
 import utility as ut
 import diff
 import scheduler
+from analyzers import conversion
+from converters import office_converter, cache as conversion_cache
 
 
 app = Flask(__name__)
@@ -18,7 +20,7 @@ app.config.from_object(settings)
 
 
 def setup_globals():
-    global es, sched, logger
+    global es, sched, ingest, logger
     # set the logging level according to the config
     logging.basicConfig(level=app.config["LOGGING_LEVEL"],
                         format=("%(asctime)s %(name)s [%(threadName)s]: "
@@ -29,6 +31,12 @@ def setup_globals():
 
     logger = logging.getLogger(__name__)
 
+    # limit the concurrent conversion processes
+    conversion.configure(app.config["CONVERSION_WORKERS"],
+                         timeout=app.config["CONVERSION_TIMEOUT"])
+    office_converter.configure(app.config["OFFICE_INSTANCES"],
+                               timeout=app.config["CONVERSION_TIMEOUT"])
+
     # connect to the elasticDB
     es = elastic.Elastic(app.config["ELASTICSEARCH_HOST"],
                          app.config["ELASTICSEARCH_PORT"],
@@ -36,10 +44,28 @@ def setup_globals():
                          app.config["ELASTICSEARCH_PASSWORD"]),
                          cert=app.config["ELASTICSEARCH_CAFILE"],
                          docs_index=app.config["ELASTICSEARCH_DOCS_INDEX"],
-                         fs_dir=app.config["UPLOAD_DIR"])
+                         partition=app.config["ELASTICSEARCH_DOCS_PARTITION"],
+                         fs_dir=app.config["UPLOAD_DIR"],
+                         track_total_hits=app.config["TRACK_TOTAL_HITS"])
+    # convert the same content once only
+    conversion_cache.configure(
+        es.fs, max_size=app.config["CONVERSION_CACHE_SIZE"] * 1024 ** 2)
+    es.collector.add_cache(conversion_cache.CACHE)
     # start the scheduler
+    lease = None
+    if app.config["SCHEDULER_LEASE_TTL"] > 0:
+        # only one replica runs the jobs.
+        lease = scheduler.ElasticLease(es.es)
     sched = scheduler.Scheduler(es.es, crawler_args={"elastic": es},
+                                lease=lease,
+                                lease_ttl=app.config["SCHEDULER_LEASE_TTL"],
                                 hour=2, minute=0)
+    atexit.register(sched.shutdown)
+    sched.add_maintenance_job("collect_garbage", es.collect_garbage,
+                              minutes=app.config["GC_INTERVAL"])
+    # analyze uploads in the background
+    ingest = elastic.IngestQueue(es, workers=app.config["INGEST_WORKERS"])
+    ingest.start()
 
 
 # setup the global objects
@@ -123,6 +149,10 @@ def search(page=1):
         sortby (str): category to sort by, defaults to date.
         desc (str): whether the search should be descending or ascending,
             defaults to 'True'.
+        cursor (str): an opaque cursor for the next page, as returned by a
+            previous search, takes precedence over `page`.
+        mode (str): "passages" searches the pages of the documents and links
+            the best matching ones, defaults to searching whole documents.
     """
     # which columns are displayed?
     columns = ["date", "type", "category", "document", "source",
@@ -135,12 +165,24 @@ def search(page=1):
     desc = req_args.pop("desc", "true").lower() == "true"
     # retrieve search keyword
     query = req_args.pop("q", "")
+    cursor = req_args.pop("cursor", None)
+    passages = req_args.pop("mode", None) == "passages"
     sortby = {
         "keyword": sort_by,
         "order": "desc" if desc else "asc",
         "args": {"fingerprint": 12341234}
     }
-    search_res = es.search_documents(query, page, columns, req_args, sortby)
+    search_res = es.search_documents(query, page, columns, req_args, sortby,
+                                     cursor=cursor, passages=passages)
+
+    # json consumers page using the returned cursor.
+    if request.is_xhr:
+        return jsonify(success=True,
+                       num_results=search_res["num_results"],
+                       total_relation=search_res["total_relation"],
+                       results=search_res["results"],
+                       cursor=search_res["cursor"])
+
     filters = es.get_field_values(query, columns, active=req_args)
 
     documents = search_res["results"]
@@ -151,43 +193,131 @@ def search(page=1):
                            columntitles=columns,
                            page=page,
                            num_results=search_res["num_results"],
+                           total_relation=search_res["total_relation"],
                            max_page=search_res["total_pages"],
+                           next_cursor=search_res["cursor"],
                            q=query,
                            sort_by=(sort_by, desc),)
 
 
+@app.route("/search/export")
+def search_export():
+    """Streams all documents matching the search as NDJSON or CSV.
+
+    Takes the same query and filters as `search`, but returns every match.
+    The documents are fetched and serialized batch by batch, hence memory
+    stays constant regardless of the size of the result set.
+
+    Request Args:
+        q (str): the query string
+        format (str): either "ndjson" or "csv", defaults to "ndjson".
+        fields (str): comma separated list of fields to export, defaults to
+            the columns of the search view plus "_id".
+    """
+    req_args = ut.flatten_multi_dict(request.args)
+    req_args = ut.convert_filter_types(req_args)
+    # the order doesn't matter for an export.
+    for key in ["sortby", "desc", "cursor", "mode"]:
+        req_args.pop(key, None)
+    query = req_args.pop("q", "")
+    out_format = req_args.pop("format", "ndjson").lower()
+    fields = req_args.pop("fields", None)
+    if fields:
+        if isinstance(fields, str):
+            fields = fields.split(",")
+        fields = [f.strip() for f in fields if f.strip()]
+    else:
+        fields = ["date", "type", "category", "document", "source",
+                  "reading_time", "impact"]
+
+    batches = es.export_documents(query, fields, req_args)
+
+    if out_format == "csv":
+        columns = ["_id"] + [f for f in fields if f != "_id"]
+
+        def _generate():
+            yield ut.to_csv([], columns, header=True)
+            for docs in batches:
+                yield ut.to_csv(docs, columns)
+
+        mimetype = "text/csv"
+    else:
+        out_format = "ndjson"
+
+        def _generate():
+            for docs in batches:
+                yield ut.to_ndjson(docs)
+
+        mimetype = "application/x-ndjson"
+
+    headers = {
+        "Content-Disposition": f"attachment; filename=export.{out_format}"
+    }
+    return Response(stream_with_context(_generate()), mimetype=mimetype,
+                    headers=headers)
+
+
 @app.route("/upload", methods=["GET", "POST"])
 def upload():
+    """Receives uploaded files and queues them for the analysis.
+
+    The files are only saved, the analysis runs in the background. Use
+    `upload_status` to follow the jobs.
+    """
     is_ajax = request.form.get("__ajax", "").lower() == "true"
 
     files = request.files.getlist("file_input")
-    for fl in files:
-        res = es.insert_document({
-            "content": fl.stream.read(),
-            "metadata": {
-                "filename": fl.filename,
-                "mimetype": fl.mimetype
-            }
-        })
+    jobs = [ingest.submit(fl.stream, fl.filename, fl.mimetype)
+            for fl in files]
 
     docs = []
     if is_ajax:
-        if res.get("result") == "created":
+        if jobs:
             return jsonify(success=True,
                            message="Received files!",
-                           href=url_for("document", doc_id=res["_id"]))
-        elif res.get("result") == "existing":
-            return jsonify(success=False,
-                           message="Couldn't insert existing doc!",
-                           href=url_for("document", doc_id=res["_id"]))
+                           jobs=jobs,
+                           status=[url_for("upload_status", job_id=job)
+                                   for job in jobs],
+                           href=None)
         return jsonify(success=False,
-                       message="Error while inserting document.",
+                       message="No files received.",
                        href=None)
     else:
         docs = es.get_uploads(ut.from_date())
     return render_template("upload.html", documents=docs)
 
 
+@app.route("/upload/<job_id>")
+def upload_status(job_id):
+    """Returns the state of an upload's ingest job.
+
+    Args:
+        job_id (str): the id of the job, as returned by `upload`.
+    """
+    job = ingest.status(job_id)
+    if job is None:
+        return jsonify(success=False, message="Unknown upload.", href=None)
+
+    result = job.get("result") or {}
+    href = None
+    if result.get("_id"):
+        href = url_for("document", doc_id=result["_id"])
+
+    message = {
+        "queued": "Waiting for the analysis.",
+        "running": "Analyzing the document.",
+        "failed": f"Error while inserting document. {job.get('error')}",
+    }.get(job["status"], "Inserted the document.")
+    if result.get("result") == "existing":
+        message = "Couldn't insert existing doc!"
+
+    return jsonify(success=job["status"] != "failed"
+                   and result.get("result") != "existing",
+                   status=job["status"],
+                   message=message,
+                   href=href)
+
+
 @app.route("/document/<doc_id>/download")
 def document_download(doc_id):
     """Should return the document as saved in the database.
@@ -195,14 +325,28 @@ def document_download(doc_id):
     Args:
         doc_id (str): the id of the document to reutrn.
     """
-    content = es.get_content(doc_id)
+    content = es.open_content(doc_id)
     if content is None:
+        if es.is_rendering(doc_id):
+            # the pdf is still rendered in the background.
+            return Response("The document is being rendered, please retry.",
+                            status=503, headers={"Retry-After": "5"},
+                            mimetype="text/plain")
         # right now, just sends some dummy pdf-file
         return send_file("static/dummy.pdf")
 
-    return send_file(io.BytesIO(content),
-                     attachment_filename="source.pdf",
-                     mimetype="application/pdf")
+    # plain files are sent by the server, compressed ones are streamed.
+    res = send_file(content["source"], attachment_filename="source.pdf",
+                    mimetype="application/pdf", add_etags=False,
+                    last_modified=content["modified"])
+    res.content_length = content["size"]
+    # the content of a document might change, but its hash identifies it.
+    res.set_etag(content["hash"])
+    # revalidated on every use, unchanged contents cost a 304 only.
+    res.headers["Cache-Control"] = "private, no-cache"
+    # answers If-None-Match, If-Modified-Since, Range and If-Range.
+    return res.make_conditional(request, accept_ranges=True,
+                                complete_length=content["size"])
 
 
 @app.route("/document/<doc_id>/")
@@ -289,15 +433,23 @@ def document_diff(doc_id):
 
     versions = es.get_versions(doc_id)
 
-    compare_to = request.args.get("compare_to", None)
-    other = None
-    # when nothing is given for comparison, take the latest document
+    # when nothing is given for comparison, take the predecessor.
+    compare_to = request.args.get("compare_to", doc.get("predecessor"))
+    if compare_to is None and versions:
+        compare_to = versions[0]["_id"]
     if compare_to is None:
-        other = versions[0]
-    else:
-        # otherwise get the one with the right id
-        other = [d for d in versions if str(d["_id"]) == compare_to][0]
-    diffs, change = diff.get_unified_diff(doc, other)
+        # nothing to compare with.
+        return redirect(url_for("document", doc_id=doc_id))
+    other = next((d for d in versions if str(d["_id"]) == compare_to), None)
+    if other is None:
+        other = es.get_document(compare_to)
+    # the diff to the predecessor was computed while inserting.
+    result = es.get_diff(doc_id, compare_to)
+    if result is None:
+        result = diff.get_unified_diff(
+            {"text": es.get_text(doc_id) or ""},
+            {"text": es.get_text(compare_to) or ""}, lazy=True)
+    diffs, change = result
 
     return render_template("diff.html",
                            calendar=calendar,
@@ -317,27 +469,35 @@ def document_set_properties(doc_id):
         doc_id (str): the id of the document to return.
 
     Request Args:
-
+        (json): a list of `{"name": "...", "value": "..."}` dicts.
     """
-    doc = es.get_document(doc_id)
-    if doc is None:
+    update = {item["name"]: item["value"] for item in request.get_json()}
+
+    res = es.mutate_documents([doc_id], properties=update)
+    if res["result"] == "failed":
         return jsonify(success=False)
+    return jsonify(success=True, update=update)
 
-    update = {}
-    for item in request.get_json():
-        if item["name"] not in doc:
-            # don't allow keys, that weren't there.
-            continue
-        orig = doc.get(item["name"])
-        # special treatment for dictionaries ("keywords", "entities")
-        if isinstance(orig, dict):
-            val = ut.update_existing(dict.fromkeys(item["value"], 1), orig)
-            update[item["name"]] = val
-        else:
-            update[item["name"]] = item["value"]
 
-    es.update_document(doc_id, update)
-    return jsonify(success=True, update=update)
+@app.route("/documents/mutate", methods=["POST"])
+def documents_mutate():
+    """Applies tag and property changes to a selection of documents.
+
+    Request Args:
+        (json): a dict holding the keys `ids` (list of document ids) and
+            optionally `add_tags`, `remove_tags` (lists of tags) and
+            `properties` (dict of properties).
+    """
+    mutation = request.get_json() or {}
+    doc_ids = mutation.get("ids") or []
+
+    res = es.mutate_documents(doc_ids,
+                              add_tags=mutation.get("add_tags"),
+                              remove_tags=mutation.get("remove_tags"),
+                              properties=mutation.get("properties"))
+    return jsonify(success=res["result"] == "updated",
+                   updated=res["updated"],
+                   failed=res["failed"])
 
 
 @app.route("/searchdialog")
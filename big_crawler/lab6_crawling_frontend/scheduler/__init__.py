@@ -1,3 +1,4 @@
 from .scheduler import Scheduler
+from .leader import ElasticLease
 
-__all__ = [Scheduler]
+__all__ = [Scheduler, ElasticLease]
@@ -1,7 +1,11 @@
 from __future__ import absolute_import
 import warnings
 import base64
+import heapq
 import logging
+import threading
+import time
+import uuid
 
 from apscheduler.jobstores.base import (
     BaseJobStore, JobLookupError, ConflictingIdError
@@ -18,6 +22,7 @@ except ImportError:  # pragma: nocover
 
 try:
     import elasticsearch
+    from elasticsearch import helpers as es_helpers
 except ImportError:  # pragma: nocover
     raise ImportError("ElasticJobStore needs elasticsearch to be installed.")
 
@@ -180,26 +185,26 @@ class ElasticJobStore(BaseJobStore):
         self._fix_paused_jobs_sorting(jobs)
         return jobs
 
-    def add_job(self, job):
-        doc = {
+    def _job_doc(self, job):
+        """Returns the document, which saves the job."""
+        return {
             "id": job.id,
             "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
             "job_state":
                 base64.b64encode(pickle.dumps(job.__getstate__(),
                                               self.pickle_protocol)).decode()
-            }
+        }
+
+    def add_job(self, job):
+        doc = self._job_doc(job)
         result = self.client.index(index=self.index, doc_type=self.doc_type,
                                    id=job.id, body=doc, refresh=True)
         if SDA(result, 0)["_shards.successful"] == 0:
             raise ConflictingIdError(job.id)
 
     def update_job(self, job):
-        changes = {
-            "next_run_time": datetime_to_utc_timestamp(job.next_run_time),
-            "job_state":
-                base64.b64encode(pickle.dumps(job.__getstate__(),
-                                              self.pickle_protocol)).decode()
-        }
+        changes = self._job_doc(job)
+        del changes["id"]
         upd_body = {
             "doc": changes
         }
@@ -313,3 +318,340 @@ class InjectorJobStore(ElasticJobStore):
         copy.kwargs = {k: v for k, v in copy.kwargs.items()
                        if k not in self.kwargs}
         return copy
+
+
+class CachedJobStore(InjectorJobStore):
+    """An InjectorJobStore, which serves all lookups from memory.
+
+    The jobs are kept in a heap ordered by their next run time. Changes are
+    written behind to elasticsearch in batches by a background thread. Each
+    batch replaces a version token, when another store changed the token,
+    the jobs are reloaded. The writes are versioned, a job changed by
+    another store in the meantime is reloaded instead of overwritten.
+    """
+
+    def __init__(self, flush_interval=1, check_interval=30, **js_args):
+        """Initializes a new cached JobStore.
+
+        Args:
+            flush_interval (float): seconds between two batches of writes.
+                Defaults to 1.
+            check_interval (float): seconds between two version checks.
+                Defaults to 30.
+            **js_args (dict): additional arguments for the InjectorJobStore.
+
+        Returns:
+            `CachedJobStore`: a new CachedJobStore.
+        """
+        super().__init__(**js_args)
+        self.flush_interval = flush_interval
+        self.check_interval = check_interval
+        self.version_index = f"{self.index}_version"
+        # the jobs by id, their next run times and the unwritten changes.
+        self._jobs = {}
+        self._heap = []
+        self._pending = {}
+        # the elasticsearch versions of the written jobs.
+        self._versions = {}
+        self._token = None
+        self._lock = threading.RLock()
+        self._sync_lock = threading.RLock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self, scheduler, alias):
+        super().start(scheduler, alias)
+        self.client.indices.create(index=self.version_index, ignore=400)
+        self.reload()
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name="jobstore-sync")
+        self._thread.start()
+
+    def shutdown(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _rebuild_heap(self):
+        """Rebuilds the heap of next run times, the lock must be held."""
+        self._heap = [(datetime_to_utc_timestamp(job.next_run_time), job.id)
+                      for job in self._jobs.values()
+                      if job.next_run_time is not None]
+        heapq.heapify(self._heap)
+
+    def _is_current(self, entry):
+        """Returns whether a heap entry matches its job's next run time."""
+        job = self._jobs.get(entry[1])
+        if job is None:
+            return False
+        return datetime_to_utc_timestamp(job.next_run_time) == entry[0]
+
+    def _put(self, job):
+        """Saves a job in memory and marks it to be written."""
+        stripped = self._job_doc(self._remove_rtargs(job))
+        with self._lock:
+            # keep the job in the same state, a reload would yield.
+            job = self._reconstitute_job(stripped["job_state"])
+            self._jobs[job.id] = job
+            self._pending[job.id] = stripped
+            if job.next_run_time is not None:
+                heapq.heappush(self._heap, (stripped["next_run_time"],
+                                            job.id))
+            # drop outdated entries from time to time.
+            if len(self._heap) > 2 * len(self._jobs) + 16:
+                self._rebuild_heap()
+
+    def lookup_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_due_jobs(self, now):
+        timestamp = datetime_to_utc_timestamp(now)
+        due = []
+        with self._lock:
+            popped = []
+            while self._heap and self._heap[0][0] <= timestamp:
+                entry = heapq.heappop(self._heap)
+                if not self._is_current(entry) or entry in popped:
+                    continue
+                popped.append(entry)
+                due.append(self._jobs[entry[1]])
+            # the scheduler updates the jobs after running them.
+            for entry in popped:
+                heapq.heappush(self._heap, entry)
+        return due
+
+    def get_next_run_time(self):
+        with self._lock:
+            while self._heap and not self._is_current(self._heap[0]):
+                heapq.heappop(self._heap)
+            if not self._heap:
+                return None
+            return utc_timestamp_to_datetime(self._heap[0][0])
+
+    def get_all_jobs(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        scheduled = sorted(
+            [job for job in jobs if job.next_run_time is not None],
+            key=lambda job: datetime_to_utc_timestamp(job.next_run_time))
+        paused = [job for job in jobs if job.next_run_time is None]
+        return scheduled + paused
+
+    def add_job(self, job):
+        with self._lock:
+            if job.id in self._jobs:
+                raise ConflictingIdError(job.id)
+            self._put(job)
+
+    def update_job(self, job):
+        with self._lock:
+            if job.id not in self._jobs:
+                raise JobLookupError(job.id)
+            self._put(job)
+
+    def remove_job(self, job_id):
+        with self._lock:
+            if self._jobs.pop(job_id, None) is None:
+                raise JobLookupError(job_id)
+            self._pending[job_id] = None
+
+    def remove_all_jobs(self):
+        with self._lock:
+            for job_id in self._jobs:
+                self._pending[job_id] = None
+            self._jobs = {}
+            self._heap = []
+
+    def _get_token(self):
+        """Returns the version token and its version or None."""
+        try:
+            result = self.client.get(index=self.version_index,
+                                     doc_type=self.doc_type, id="version")
+        except elasticsearch.NotFoundError:
+            return None, None
+        return SDA(result)["_source.token"], result["_version"]
+
+    def _replace_token(self):
+        """Replaces the version token after writing a batch.
+
+        Returns:
+            bool: whether another store changed the jobs in the meantime.
+        """
+        token, version = self._get_token()
+        changed = token != self._token
+        new_token = uuid.uuid4().hex
+        try:
+            if version is None:
+                self.client.create(index=self.version_index,
+                                   doc_type=self.doc_type, id="version",
+                                   body={"token": new_token})
+            else:
+                self.client.index(index=self.version_index,
+                                  doc_type=self.doc_type, id="version",
+                                  body={"token": new_token}, version=version)
+        except elasticsearch.ConflictError:
+            return True
+        self._token = new_token
+        return changed
+
+    def _actions(self, pending):
+        """Yields the versioned bulk actions of the pending changes."""
+        for job_id, doc in pending.items():
+            action = {"_index": self.index, "_type": self.doc_type,
+                      "_id": job_id}
+            version = self._versions.get(job_id)
+            if version is not None:
+                action["_version"] = version
+            if doc is None:
+                action["_op_type"] = "delete"
+            else:
+                # fails, if another store created the job meanwhile.
+                if version is None:
+                    action["_op_type"] = "create"
+                action["_source"] = doc
+            yield action
+
+    def flush(self):
+        """Writes the pending changes to elasticsearch in one batch.
+
+        Changes of jobs, which another store changed since they were read,
+        are dropped and the jobs are reloaded, see `_reload_job`. Failed
+        changes are retried with the next batch.
+
+        Returns:
+            bool: whether another store changed the jobs in the meantime.
+        """
+        with self._sync_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                actions = list(self._actions(pending))
+            if not pending:
+                return False
+
+            failed, conflicts = {}, []
+            try:
+                for ok, item in es_helpers.streaming_bulk(
+                        self.client, actions, refresh=True,
+                        raise_on_error=False):
+                    op_type, result = item.popitem()
+                    job_id = result["_id"]
+                    status = result.get("status")
+                    if ok or (op_type == "delete" and status == 404):
+                        with self._lock:
+                            if op_type == "delete":
+                                self._versions.pop(job_id, None)
+                            else:
+                                self._versions[job_id] = result["_version"]
+                    elif status == 409:
+                        conflicts.append(job_id)
+                    else:
+                        logger.warning(f"Couldn't write job change: {item}")
+                        failed[job_id] = pending[job_id]
+            except elasticsearch.ElasticsearchException:
+                with self._lock:
+                    # retry the changes, that weren't changed again.
+                    self._pending = dict(pending, **self._pending)
+                raise
+            if failed:
+                with self._lock:
+                    self._pending = dict(failed, **self._pending)
+            for job_id in conflicts:
+                self._reload_job(job_id)
+            if conflicts:
+                self._scheduler.wakeup()
+            return self._replace_token()
+
+    def _reload_job(self, job_id):
+        """Replaces a job by its state in elasticsearch.
+
+        Drops the pending change of the job, as it's based on an outdated
+        state.
+
+        Args:
+            job_id (str): the id of the job.
+        """
+        try:
+            result = self.client.get(index=self.index, doc_type=self.doc_type,
+                                     id=job_id)
+        except elasticsearch.NotFoundError:
+            result = None
+        job = None
+        if result is not None:
+            try:
+                job = self._reconstitute_job(
+                    SDA(result)["_source.job_state"])
+            except BaseException:
+                self._logger.exception(
+                    "Unable to restore job '%s' -- skipping it", job_id)
+        logger.info(f"Job '{job_id}' was changed by another store, "
+                    "reloaded it.")
+
+        with self._lock:
+            self._pending.pop(job_id, None)
+            if job is None:
+                self._jobs.pop(job_id, None)
+                self._versions.pop(job_id, None)
+            else:
+                self._jobs[job_id] = job
+                self._versions[job_id] = result["_version"]
+            self._rebuild_heap()
+
+    def reload(self, wakeup=False):
+        """Loads all jobs from elasticsearch, keeping the pending changes.
+
+        Args:
+            wakeup (bool): whether to wake up the scheduler afterwards.
+        """
+        with self._sync_lock:
+            token, _ = self._get_token()
+            jobs = {}
+            versions = {}
+            query = {"query": {"exists": {"field": "job_state"}}}
+            for doc in es_helpers.scan(self.client, index=self.index,
+                                       doc_type=self.doc_type, query=query,
+                                       version=True):
+                try:
+                    job = self._reconstitute_job(
+                        SDA(doc)["_source.job_state"])
+                except BaseException:
+                    self._logger.exception(
+                        "Unable to restore job '%s' -- skipping it",
+                        doc["_id"]
+                    )
+                    continue
+                jobs[job.id] = job
+                versions[job.id] = doc["_version"]
+
+            with self._lock:
+                for job_id, doc in self._pending.items():
+                    if doc is None:
+                        jobs.pop(job_id, None)
+                    else:
+                        jobs[job_id] = self._reconstitute_job(
+                            doc["job_state"])
+                self._jobs = jobs
+                self._versions = versions
+                self._rebuild_heap()
+                self._token = token
+        logger.debug(f"Reloaded {len(jobs)} jobs from the jobstore.")
+        if wakeup:
+            self._scheduler.wakeup()
+
+    def _run(self):
+        """The loop of the background thread, writing and checking."""
+        next_check = time.time() + self.check_interval
+        while not self._stopped.wait(self.flush_interval):
+            check = time.time() >= next_check
+            try:
+                changed = self.flush()
+                if check:
+                    next_check = time.time() + self.check_interval
+                    changed = changed or self._get_token()[0] != self._token
+                if changed:
+                    self.reload(wakeup=True)
+            except elasticsearch.ElasticsearchException as e:
+                logger.warning(f"Couldn't synchronize the jobstore. {e}")
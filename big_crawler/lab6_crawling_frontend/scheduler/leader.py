@@ -0,0 +1,201 @@
+"""This module provides a leader election based on expiring leases.
+
+Several replicas of the frontend share the jobs index, but only one of them
+should run the scheduled jobs. Each replica tries to acquire a lease
+periodically, the holder renews it before it expires. When the leader dies,
+its lease expires and another replica takes over.
+"""
+from abc import abstractmethod
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+import elasticsearch as es
+
+import utility
+
+logger = logging.getLogger(__name__)
+
+
+class LeaseBackend():
+    """Base Class for storing leases."""
+
+    @abstractmethod
+    def acquire(self, name, holder, ttl):
+        """Acquires or renews a lease.
+
+        Args:
+            name (str): the name of the lease.
+            holder (str): the id of the candidate.
+            ttl (float): seconds until the lease expires.
+
+        Returns:
+            bool: whether the candidate holds the lease.
+        """
+
+    @abstractmethod
+    def release(self, name, holder):
+        """Releases a lease, if the candidate holds it.
+
+        Args:
+            name (str): the name of the lease.
+            holder (str): the id of the candidate.
+        """
+
+
+class ElasticLease(LeaseBackend):
+    """Stores leases in an elasticsearch index.
+
+    Updates use optimistic concurrency control, such that only one
+    candidate wins, when several try to acquire an expired lease.
+    """
+
+    def __init__(self, client, index="leases", doc_type="lease"):
+        """Initializes the backend.
+
+        Args:
+            client (elasticsearch.Elasticsearch): the elasticsearch client.
+            index (str): the index of the leases. Defaults to "leases".
+            doc_type (str): the doc_type of the leases. Defaults to "lease".
+        """
+        self.es = client
+        self.index = index
+        self.doc_type = doc_type
+        self.es.indices.create(index=self.index, ignore=400)
+
+    def acquire(self, name, holder, ttl):
+        lease = {"holder": holder, "expires": time.time() + ttl}
+        try:
+            result = self.es.get(index=self.index, doc_type=self.doc_type,
+                                 id=name)
+        except es.NotFoundError:
+            result = None
+
+        try:
+            if result is None:
+                self.es.create(index=self.index, doc_type=self.doc_type,
+                               id=name, body=lease, refresh=True)
+                return True
+            current = result["_source"]
+            expired = current["expires"] <= time.time()
+            if current["holder"] != holder and not expired:
+                return False
+            # fails, if another candidate acquired it in the meantime.
+            self.es.index(index=self.index, doc_type=self.doc_type, id=name,
+                          body=lease, version=result["_version"],
+                          refresh=True)
+        except es.ConflictError:
+            return False
+        return True
+
+    def release(self, name, holder):
+        try:
+            result = self.es.get(index=self.index, doc_type=self.doc_type,
+                                 id=name)
+            if result["_source"]["holder"] != holder:
+                return
+            self.es.delete(index=self.index, doc_type=self.doc_type,
+                           id=name, version=result["_version"])
+        except (es.NotFoundError, es.ConflictError):
+            pass
+
+
+class LeaderElection():
+    """Takes part in the election of a leader in a background thread.
+
+    Calls `on_elected`, when this candidate becomes the leader and
+    `on_revoked`, when it loses the lease.
+    """
+
+    def __init__(self, backend, name, on_elected=None, on_revoked=None,
+                 **kwargs):
+        """Initializes the election.
+
+        Args:
+            backend (LeaseBackend): the storage of the lease.
+            name (str): the name of the lease.
+            on_elected (callable): called, when this becomes the leader.
+            on_revoked (callable): called, when this isn't the leader anymore.
+            **kwargs (dict): keyword arguments to update the defaults,
+                `ttl` (seconds, until the lease of a dead leader expires)
+                and `renew_interval` (seconds, between two attempts).
+        """
+        self.backend = backend
+        self.name = name
+        self.on_elected = on_elected
+        self.on_revoked = on_revoked
+        self.defaults = utility.DefaultDict(dict({
+            "ttl": 15,
+            "renew_interval": 5
+        }, **kwargs))
+        self.holder = (f"{socket.gethostname()}-{os.getpid()}-"
+                       f"{uuid.uuid4().hex[:8]}")
+        self.is_leader = False
+        self.valid_until = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def _set_leader(self, is_leader):
+        """Updates the state and calls the callbacks on changes."""
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        if is_leader:
+            logger.info(f"'{self.holder}' is the leader of '{self.name}'.")
+        else:
+            logger.info(f"'{self.holder}' isn't the leader of '{self.name}' "
+                        "anymore.")
+        callback = self.on_elected if is_leader else self.on_revoked
+        if callback is not None:
+            callback()
+
+    def campaign(self):
+        """Acquires or renews the lease once.
+
+        Returns:
+            bool: whether this is the leader.
+        """
+        ttl = self.defaults.ttl()
+        started = time.time()
+        try:
+            is_leader = self.backend.acquire(self.name, self.holder, ttl)
+        except es.ElasticsearchException as e:
+            logger.warning(f"Couldn't renew the lease '{self.name}'. {e}")
+            # step down, before another candidate could take over.
+            next_attempt = time.time() + self.defaults.renew_interval()
+            is_leader = self.is_leader and next_attempt < self.valid_until
+        else:
+            if is_leader:
+                self.valid_until = started + ttl
+        self._set_leader(is_leader)
+        return is_leader
+
+    def _run(self):
+        """The loop of the background thread."""
+        while not self.stopped.is_set():
+            self.campaign()
+            self.stopped.wait(self.defaults.renew_interval())
+
+    def start(self):
+        """Starts taking part in the election."""
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self._run, daemon=True,
+                                       name=f"election-{self.name}")
+        self.thread.start()
+
+    def stop(self):
+        """Stops taking part and releases the lease for a fast failover."""
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.is_leader:
+            try:
+                self.backend.release(self.name, self.holder)
+            except es.ElasticsearchException as e:
+                logger.warning(f"Couldn't release the lease '{self.name}'. "
+                               f"{e}")
+        self._set_leader(False)
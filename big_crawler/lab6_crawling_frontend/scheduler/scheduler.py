@@ -14,7 +14,8 @@ import cerberus
 import crawlers
 import utility
 import logging
-from scheduler.elasticjobstore import InjectorJobStore
+from scheduler.elasticjobstore import CachedJobStore
+from scheduler.leader import LeaderElection
 
 logger = logging.getLogger(__name__)
 
@@ -191,7 +192,7 @@ class Scheduler:
     """Predefined triggers and their argument checks."""
 
     def __init__(self, elastic, crawler_dir="crawlers",
-                 crawler_args={}, **cron_defaults):
+                 crawler_args={}, lease=None, lease_ttl=15, **cron_defaults):
         """Initializes the scheduler by binding it to it's elasticsearch db.
 
         Args:
@@ -201,15 +202,21 @@ class Scheduler:
                 Defaults to "crawlers".
             job_defaults (dict): a dictionary of keyword arguments for
                 the schedulers job_defaults.
+            lease (leader.LeaseBackend): the storage of the leadership
+                lease. When given, only the elected replica runs the jobs,
+                otherwise this instance always runs them. Defaults to None.
+            lease_ttl (float): seconds, until the lease of a dead leader
+                expires. Defaults to 15.
             **cron_defaults (dict): a dictionary of keyword arguments for
                 the schedulers job_defaults.
 
         Returns:
             Scheduler: a fresh Scheduler instance.
         """
+        self.jobstore = CachedJobStore(kwargs=crawler_args, client=elastic)
         jobstores = {
             "default": {"type": "memory"},
-            "elastic": InjectorJobStore(kwargs=crawler_args, client=elastic)
+            "elastic": self.jobstore
         }
 
         executors = {
@@ -239,7 +246,68 @@ class Scheduler:
         self.job_validator = cerberus.Validator(SCHEMATA["job"]({
             "trigger_ids": list(self.TRIGGERS)
         }), allow_unknown=True)
-        self.scheduler.start()
+
+        self.election = None
+        if lease is None:
+            self.scheduler.start()
+        else:
+            # the jobs can be managed, but only the leader runs them.
+            self.scheduler.start(paused=True)
+            self.election = LeaderElection(
+                lease, "scheduler", on_elected=self._on_elected,
+                on_revoked=self._on_revoked, ttl=lease_ttl,
+                renew_interval=lease_ttl / 3)
+            self.election.start()
+
+    def _on_elected(self):
+        """Resumes the jobs, once this replica became the leader.
+
+        The cached jobs might be older than the last runs of the former
+        leader, hence they are reloaded first, such that no job runs twice.
+        """
+        try:
+            self.jobstore.reload()
+        except Exception as e:
+            logger.warning(f"Couldn't reload the jobs, resuming the cached "
+                           f"ones. {e}")
+        self.scheduler.resume()
+
+    def _on_revoked(self):
+        """Pauses the jobs, once this replica isn't the leader anymore.
+
+        Pausing only prevents new runs, crawls that are running already
+        continue until they finish. The pending changes are written, such
+        that the next leader continues with them.
+        """
+        self.scheduler.pause()
+        try:
+            self.jobstore.flush()
+        except Exception as e:
+            logger.warning(f"Couldn't save the jobs for the next leader. {e}")
+
+    def shutdown(self):
+        """Stops running jobs, hands over the leadership and saves the jobs."""
+        if self.election is not None:
+            # saves the jobs, before another replica can take over.
+            self._on_revoked()
+            self.election.stop()
+        self.scheduler.shutdown()
+
+    def add_maintenance_job(self, job_id, func, **interval):
+        """Runs `func` periodically, not persisted like the crawling jobs.
+
+        Args:
+            job_id (str): the id of the job.
+            func (callable): the function, that should be run.
+            **interval (dict): keyword arguments for the interval trigger,
+                e.g. `minutes=10`.
+
+        Returns:
+            apscheduler.job.Job: the scheduled job.
+        """
+        return self.scheduler.add_job(func, "interval", id=job_id,
+                                      jobstore="default", max_instances=1,
+                                      replace_existing=True, **interval)
 
     def upsert_job(self, job_dict, **runtime_args):
         """Adds or updates a job using the provided user_input.
@@ -16,10 +16,40 @@ ELASTICSEARCH_PORT = os.environ.get("SHERLOCK_ES_PORT", 31791)
 ELASTICSEARCH_CAFILE = os.environ.get(
     "SHERLOCK_ES_CAFILE", cert_path)
 ELASTICSEARCH_DOCS_INDEX = os.environ.get("SHERLOCK_ES_DOCS_INDEX", "sherlock")
+ELASTICSEARCH_DOCS_PARTITION = os.environ.get("SHERLOCK_ES_DOCS_PARTITION",
+                                              None)
+"""Splits the docs index by 'month' or 'year', None keeps a single index."""
 LOGGING_LEVEL = logging.DEBUG
 
+TRACK_TOTAL_HITS = os.environ.get("SHERLOCK_TRACK_TOTAL_HITS",
+                                  "true").lower() == "true"
+"""Whether searches count their hits exactly, 'false' skips counting."""
+
 SECRET_KEY = os.environ.get("SHERLOCK_SECRET", "pl34se change th1s!")
 """The secret key for csrf-protection and so on. Please change."""
 
 UPLOAD_DIR = os.environ.get("SHERLOCK_UPLOAD_DIR", r"D:\Sherlock_upload")
 """The relative folder, the uploaded and scraped files should be stored."""
+
+GC_INTERVAL = int(os.environ.get("SHERLOCK_GC_INTERVAL", 10))
+"""Minutes between two runs of the filestore garbage collection."""
+
+INGEST_WORKERS = int(os.environ.get("SHERLOCK_INGEST_WORKERS", 2))
+"""Number of threads, which analyze uploaded documents."""
+
+CONVERSION_WORKERS = int(os.environ.get("SHERLOCK_CONVERSION_WORKERS", 4))
+"""Maximum number of concurrent conversion processes (e.g. pdftotext)."""
+
+CONVERSION_TIMEOUT = int(os.environ.get("SHERLOCK_CONVERSION_TIMEOUT", 120))
+"""Seconds, after which a conversion process is killed."""
+
+OFFICE_INSTANCES = int(os.environ.get("SHERLOCK_OFFICE_INSTANCES", 2))
+"""Number of headless LibreOffice instances converting office files."""
+
+CONVERSION_CACHE_SIZE = int(os.environ.get("SHERLOCK_CONVERSION_CACHE_SIZE",
+                                           512))
+"""Megabytes of conversion results, which are kept by the cache."""
+
+SCHEDULER_LEASE_TTL = int(os.environ.get("SHERLOCK_SCHEDULER_LEASE_TTL", 15))
+"""Seconds, until another replica runs the jobs, when the leader died.
+Set to 0 to run the jobs in every replica."""
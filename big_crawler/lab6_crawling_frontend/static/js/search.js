@@ -53,9 +53,39 @@ function invalidateInputs(event) {
     $form.find("input:not([name=q])").attr("disabled", "disabled");
 }
 
+function selectAllDocuments(event) {
+    // toggles the selection of all documents in the table.
+    // `event` refers to the change event of the header checkbox.
+    $(".document-select").prop("checked", $(event.target).prop("checked"));
+}
+
+function mutateSelection(event) {
+    // adds or removes the entered tag for all selected documents at once.
+    // `event` refers to the original click event.
+    var $link = $(event.currentTarget);
+    var $input = $("#bulkTagInput");
+    var tag = $input.val().trim();
+    var ids = $(".document-select:checked").map(function() {
+        return $(this).val();
+    }).get();
+    event.preventDefault();
+    if (!tag || ids.length === 0) return;
+
+    var mutation = {ids: ids};
+    mutation[$link.data("action")] = [tag];
+    jsonPost($link.prop("href"), mutation, function (response) {
+        if (response.success) {
+            $input.val("");
+        }
+    });
+}
+
 // set a listener for the range sliders
 $(document).on("input", "input[type='range']", updateOutputs);
 // and trigger it once
 $("input[type='range']").trigger("input");
 // before triggering the search button invalidate all other inputs
-$("#searchButton").click(invalidateInputs);
\ No newline at end of file
+$("#searchButton").click(invalidateInputs);
+// bulk tagging of the selected documents
+$("#selectAllDocuments").change(selectAllDocuments);
+$("#bulkTagForm [data-action]").click(mutateSelection);
@@ -110,7 +110,35 @@ function uploadProgress(event) {
 }
 
 function uploadSuccess(response) {
-    // handle the success.
+    // handle the success, follows the ingest job until it's finished.
+    // `this` should contain the `key` of the file.
+    if (response.success && response.status && response.status.length) {
+        var self = this;
+        setTimeout(function() {
+            $.ajax({url: response.status[0], cache: false})
+             .done(uploadStatus.bind(self, response.status[0]));
+        }, 1000);
+        return;
+    }
+    uploadFinished.call(this, response);
+}
+
+function uploadStatus(url, response) {
+    // polls the state of an ingest job, until it's done or failed.
+    // `this` should contain the `key` of the file.
+    if (response.status == "queued" || response.status == "running") {
+        var self = this;
+        setTimeout(function() {
+            $.ajax({url: url, cache: false})
+             .done(uploadStatus.bind(self, url));
+        }, 1000);
+        return;
+    }
+    uploadFinished.call(this, response);
+}
+
+function uploadFinished(response) {
+    // displays the final state of an upload.
     // `this` should contain the `key` of the file.
     var $item = $($("li.file-progress-item")[this.key + 1]);
     var $progressBar = $item.find(".progress-bar");
@@ -6,6 +6,9 @@ Author: Johannes Mueller <j.mueller@reply.de>
 
 import functools
 import hashlib
+import json
+import csv
+import io
 import datetime as dt
 import time
 import re
@@ -566,6 +569,39 @@ def calculate_quantity(text):
     return lines, words
 
 
+def split_passages(text, size=3000):
+    """Splits a text into numbered passages.
+
+    Pages, as separated by form feeds (like `pdftotext` does), become
+    passages. Texts without form feeds are split at paragraphs into
+    passages of roughly `size` characters.
+
+    Args:
+        text (str): the text to split.
+        size (int): the approximate number of characters of a passage, if
+            the text has no pages. Defaults to 3000.
+
+    Returns:
+        list: tuples of the passage's number (starting at 1) and its text,
+            empty passages are skipped.
+    """
+    if not text:
+        return []
+    if "\f" in text:
+        chunks = text.split("\f")
+    else:
+        chunks = []
+        cur = ""
+        for paragraph in re.split(r"\n\s*\n", text):
+            if cur and len(cur) + len(paragraph) > size:
+                chunks.append(cur)
+                cur = ""
+            cur = f"{cur}\n\n{paragraph}" if cur else paragraph
+        chunks.append(cur)
+    return [(num, chunk) for num, chunk in enumerate(chunks, 1)
+            if chunk.strip()]
+
+
 def add_reading_time(doc):
     """Adds the reading time to a document.
 
@@ -892,3 +928,58 @@ def path_in_project(path, is_executable=False):
                             path + EXEC_SUFFIXES[PLATFORM])
     else:
         return path + EXEC_SUFFIXES[PLATFORM]
+
+
+def _json_default(obj):
+    """Serializes dates and timedeltas, which json can't handle natively."""
+    if isinstance(obj, (dt.date, dt.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, dt.timedelta):
+        return obj.total_seconds()
+    raise TypeError(f"Object of type {type(obj).__name__} is not "
+                    "JSON serializable")
+
+
+def to_ndjson(docs):
+    """Serializes a batch of documents as newline delimited json.
+
+    Args:
+        docs (list): a list of document dicts.
+
+    Returns:
+        str: one json object per line, terminated by a newline.
+    """
+    return "".join(json.dumps(doc, default=_json_default) + "\n"
+                   for doc in docs)
+
+
+def to_csv(docs, fields, header=False):
+    """Serializes a batch of documents as csv-rows.
+
+    Nested fields can be given in dot-notation, (see `SDA`), values that are
+    no scalars are written as json.
+
+    Args:
+        docs (list): a list of document dicts.
+        fields (list): the columns, that should be written.
+        header (bool): whether a header row should be written first.
+            Defaults to False.
+
+    Returns:
+        str: the csv-rows.
+    """
+    def _cell(value):
+        if isinstance(value, (dict, list, tuple)):
+            return json.dumps(value, default=_json_default)
+        if isinstance(value, (dt.date, dt.datetime, dt.timedelta)):
+            return _json_default(value)
+        return value
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(fields)
+    for doc in docs:
+        doc = SDA(doc)
+        writer.writerow([_cell(doc[field]) for field in fields])
+    return buffer.getvalue()